@@ -6,10 +6,17 @@ import json
 import multiprocessing
 import logging
 import itertools
+import asyncio
 
 from bitstream_mode0.utils import *
 from bitstream_mode0.model import BitstreamMode0
+from bitstream_mode0.modelutils import MODEL_REGISTRY
+from bitstream_mode0.modelutils import init_worker
 from bitstream_mode0.generic import *
+from bitstream_mode0.manifest import is_manifest
+from bitstream_mode0.manifest import predict_manifests
+from bitstream_mode0.manifest import predict_variants
+from bitstream_mode0.manifest import supported_variants
 
 
 def predict_quality(
@@ -20,8 +27,9 @@ def predict_quality(
     viewing_distance="1.5xH",
     display_size=55,
     temporary_folder="tmp",
+    cache_features=True,
 ):
-    return BitstreamMode0().predict_quality(
+    return MODEL_REGISTRY.model(BitstreamMode0).predict_quality(
         videofilename,
         model_config_filename,
         device_type,
@@ -29,6 +37,147 @@ def predict_quality(
         viewing_distance,
         display_size,
         temporary_folder,
+        cache_features,
+    )
+
+
+def _predict(params):
+    return MODEL_REGISTRY.model(BitstreamMode0)._predict_probed(*params)
+
+
+async def predict_quality_async(
+    videofilename,
+    model_config_filename,
+    device_type="pc",
+    device_resolution="3840x2160",
+    viewing_distance="1.5xH",
+    display_size=55,
+    temporary_folder="tmp",
+    cache_features=True,
+    scheduler=None,
+    executor=None,
+):
+    """
+    asyncio version of predict_quality, ffprobe is run by scheduler (utils.ProbeScheduler.default() if None),
+    feature extraction and scoring run in executor, e.g. a small concurrent.futures.ProcessPoolExecutor
+    (the default executor of the event loop if None)
+    """
+    model = MODEL_REGISTRY.model(BitstreamMode0)
+    device_type = model._check_settings(
+        videofilename, model_config_filename, device_type, device_resolution, viewing_distance, display_size
+    )
+    loop = asyncio.get_running_loop()
+
+    feature_cache = model._feature_cache(temporary_folder) if cache_features else None
+    cached = await loop.run_in_executor(None, feature_cache.get, videofilename) if feature_cache is not None else None
+    if cached is not None:
+        logging.info("features are already cached, extraction skipped")
+        params = (videofilename, model_config_filename, device_type, device_resolution, cached["ffprobe_result"], cached["features"])
+        return await loop.run_in_executor(executor, _predict, params)
+
+    ffprobe_result = await ffprobe_async(videofilename, temporary_folder, scheduler)
+    params = (videofilename, model_config_filename, device_type, device_resolution, ffprobe_result, None, feature_cache)
+    return await loop.run_in_executor(executor, _predict, params)
+
+
+def _predict_quality(params):
+    # one video that can not be processed must not stop the whole batch
+    try:
+        return predict_quality(*params)
+    except ModelError as e:
+        logging.error(f"{params[0]} could not be processed: {e}")
+        return error_record(params[0], e)
+    except Exception as e:
+        logging.exception(f"{params[0]} could not be processed")
+        return error_record(params[0], e)
+
+
+def iter_predict(
+    videofilenames,
+    model_config_filename=DEFAULT_MODEL,
+    device_type="pc",
+    device_resolution="3840x2160",
+    viewing_distance="1.5xH",
+    display_size=55,
+    temporary_folder="tmp",
+    cache_features=True,
+    cpu_count=multiprocessing.cpu_count(),
+):
+    """
+    predict the quality of many videos with cpu_count worker processes
+    @return generator of the results (see predict_quality) in completion order,
+        for videos that could not be processed an error record (see utils.error_record) is yielded
+    """
+    params = [
+        (video, model_config_filename, device_type, device_resolution, viewing_distance, display_size, temporary_folder, cache_features)
+        for video in videofilenames
+    ]
+    if cpu_count > 1 and len(params) > 1:
+        # each worker loads and compiles the model config once
+        with multiprocessing.Pool(min(cpu_count, len(params)), init_worker, (model_config_filename,)) as pool:
+            yield from pool.imap_unordered(_predict_quality, params)
+    else:
+        yield from map(_predict_quality, params)
+
+
+def _predict_manifests(manifests, model_config_filename, device_type, device_resolution, viewing_distance, display_size):
+    # one manifest that can not be parsed must not stop the whole batch, the variants of all other manifests are scored in one batch
+    variants = []
+    for manifest in manifests:
+        try:
+            manifest_variants = supported_variants(manifest)
+            assert_msg(len(manifest_variants) > 0, f"{manifest} has no video variant that is supported", UnsupportedVideoError)
+            variants.extend(manifest_variants)
+        except ModelError as e:
+            logging.error(f"{manifest} could not be processed: {e}")
+            yield error_record(manifest, e)
+        except Exception as e:
+            logging.exception(f"{manifest} could not be processed")
+            yield error_record(manifest, e)
+    yield from predict_variants(variants, model_config_filename, device_type, device_resolution, viewing_distance, display_size)
+
+
+def predict_batch(
+    codec,
+    bitrate_kbps,
+    resolution,
+    framerate,
+    device_type="pc",
+    display_res=3840 * 2160,
+    model_config_filename=DEFAULT_MODEL,
+):
+    return MODEL_REGISTRY.model(BitstreamMode0).predict_batch(
+        codec,
+        bitrate_kbps,
+        resolution,
+        framerate,
+        device_type,
+        display_res,
+        model_config_filename,
+    )
+
+
+def required_bitrate(
+    target_mos,
+    codec,
+    resolution,
+    framerate,
+    device_type="pc",
+    display_res=3840 * 2160,
+    model_config_filename=DEFAULT_MODEL,
+    bitrate_range=(10, 1000000),
+    iterations=50,
+):
+    return MODEL_REGISTRY.model(BitstreamMode0).required_bitrate(
+        target_mos,
+        codec,
+        resolution,
+        framerate,
+        device_type,
+        display_res,
+        model_config_filename,
+        bitrate_range,
+        iterations,
     )
 
 
@@ -39,12 +188,14 @@ def main(_=[]):
         epilog="rrao, stg7 2022",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
-    parser.add_argument("video", type=str, nargs="+", help="input video to estimate quality")
+    parser.add_argument(
+        "video", type=str, nargs="+", help="input video or HLS/DASH manifest (.m3u8/.mpd, all variants are scored) to estimate quality"
+    )
     parser.add_argument("--result_folder", type=str, default="reports", help="folder to store video quality results")
     parser.add_argument(
         "--model",
         type=str,
-        default=os.path.join(os.path.dirname(__file__), "models/bitstream_mode0/config.json"),
+        default=DEFAULT_MODEL,
         help="model config file to be used for prediction",
     )
     parser.add_argument("--cpu_count", type=int, default=multiprocessing.cpu_count(), help="thread/cpu count")
@@ -70,39 +221,54 @@ def main(_=[]):
         default="./tmp",
         help="temporary folder to store bitstream stats and other intermediate results",
     )
+    parser.add_argument(
+        "--no_feature_cache",
+        action="store_true",
+        help="do not read or store extracted features in the feature cache of the temporary folder",
+    )
+    parser.add_argument(
+        "--rerun",
+        action="store_true",
+        help="process all inputs again, also the ones that are already recorded in the journal of the result folder",
+    )
 
     a = vars(parser.parse_args())
     logging.basicConfig(level=logging.DEBUG)
 
     assert_file(a["model"], "model folder is not valid")
     logging.info(f"handle the following videos (# {len(a['video'])}): \n  " + "\n  ".join(a["video"]))
-    params = [
-        (
-            video,
+    # inputs that are already processed with the same settings and did not change since are skipped
+    settings = {k: a[k] for k in ["device_type", "device_resolution", "viewing_distance", "display_size"]}
+    settings["model"] = list(file_identity(a["model"]))
+    settings["version"] = __version__
+    journal = Journal(a["result_folder"], settings)
+    # manifests are scored directly, without probing any media file
+    manifests = journal.pending([video for video in a["video"] if is_manifest(video)], not a["rerun"])
+    results = _predict_manifests(
+        manifests,
+        a["model"],
+        a["device_type"],
+        a["device_resolution"],
+        a["viewing_distance"],
+        a["display_size"],
+    )
+    results = itertools.chain(
+        results,
+        iter_predict(
+            journal.pending([video for video in a["video"] if not is_manifest(video)], not a["rerun"]),
             a["model"],
             a["device_type"],
             a["device_resolution"],
             a["viewing_distance"],
             a["display_size"],
             a["tmp"],
-        )
-        for video in a["video"]
-    ]
-    if a["cpu_count"] > 1:
-        pool = multiprocessing.Pool(a["cpu_count"])
-        results = pool.starmap(predict_quality, params)
-    else:
-        results = list(itertools.starmap(predict_quality, params))
-
-    print(json.dumps(results, indent=4, sort_keys=True))
+            not a["no_feature_cache"],
+            a["cpu_count"],
+        ),
+    )
+    # results are printed and stored as soon as a video is processed
     logging.info(f"""store all results to {a["result_folder"]}""")
-    os.makedirs(a["result_folder"], exist_ok=True)
-    for result in results:
-        if result == {} or "video_basename" not in result:
-            # in case the video could not be processed, just ignore it
-            continue
-        reportname = os.path.join(a["result_folder"], os.path.splitext(result["video_basename"])[0] + ".json")
-        json_store(reportname, result)
+    stream_reports(journal.track(results), a["result_folder"])
 
 
 if __name__ == "__main__":
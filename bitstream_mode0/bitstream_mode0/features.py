@@ -9,6 +9,11 @@ import scipy.stats
 from bitstream_mode0.utils import assert_msg
 from bitstream_mode0.utils import file_open
 
+
+# version of the extracted features, it has to be increased whenever the feature extraction changes, see utils.FeatureCache
+FEATURE_VERSION = 1
+
+
 def extract_features(videofilename, used_features, ffprobe_result):#, bitstream_parser_result_file):
     """ extract all specified features for a given video file """
     features = {}
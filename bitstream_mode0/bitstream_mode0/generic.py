@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
+import os
 
 DEVICE_TYPES = ["pc", "tv", "tablet", "mobile"]
+# model coefficients are only available for these device classes, pc is used for tv, mobile for tablet
+DEVICE_CLASSES = ["pc", "mobile"]
 DEVICE_RESOLUTIONS = ["3840x2160", "2560x1440"]
 
 VIEWING_DISTANCES = ["1.5xH", "4xH", "6xH"]
@@ -8,3 +11,7 @@ DISPLAY_SIZES = [10, 32, 37, 5.1, 5.5, 5.8, 55, 65, 75]
 
 # ffmpeg names of codecs are used
 CODECS_SUPPORTED = ["h264", "hevc", "vp9"]
+# maximum quantization parameter of each codec
+QP_MAX = {"h264": 63, "hevc": 63, "vp9": 255}
+
+DEFAULT_MODEL = os.path.join(os.path.dirname(__file__), "models/bitstream_mode0/config.json")
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+bitrate ladder evaluation based on the bitstream mode 0 model
+
+style: black -l 140 ladder.py
+"""
+import numpy as np
+import pandas as pd
+
+from bitstream_mode0.generic import *
+from bitstream_mode0.model import BitstreamMode0
+from bitstream_mode0.utils import assert_msg
+
+# columns that describe one rung of a ladder, bitrate in kbit/s
+RUNG_COLUMNS = ["codec", "bitrate", "width", "height", "fps"]
+
+
+def ladders_to_dataframe(ladders):
+    """
+    convert candidate ladders to one dataframe,
+    ladders is either a list of rungs or a dictionary `ladder name -> list of rungs`,
+    each rung is a dictionary with the keys of RUNG_COLUMNS
+    """
+    if isinstance(ladders, pd.DataFrame):
+        rungs = ladders.copy()
+    elif isinstance(ladders, dict):
+        rungs = pd.DataFrame([dict(rung, ladder=name) for name, ladder in ladders.items() for rung in ladder])
+    else:
+        rungs = pd.DataFrame(list(ladders))
+    if "ladder" not in rungs.columns:
+        rungs["ladder"] = ""
+    missing = set(RUNG_COLUMNS) - set(rungs.columns)
+    assert_msg(len(missing) == 0, f"the following rung properties are missing: {sorted(missing)}")
+    return rungs
+
+
+def evaluate_ladders(ladders, device_types=["pc"], display_res=3840 * 2160, model_config_filename=DEFAULT_MODEL):
+    """
+    score every rung of all ladders for all device types in one vectorized pass
+
+    @param ladders list of rungs or dictionary `ladder name -> list of rungs`, see ladders_to_dataframe
+    @param device_types list of device types, see DEVICE_TYPES
+    @param display_res display width * height in pixels
+    @return dataframe with one row per rung and device type, including final_pred and the degradations
+    """
+    rungs = ladders_to_dataframe(ladders)
+    scored = pd.concat([rungs.assign(device_type=device_type) for device_type in device_types], ignore_index=True)
+
+    res = BitstreamMode0().predict_batch(
+        scored["codec"].values,
+        scored["bitrate"].values,
+        scored["width"].values * scored["height"].values,
+        scored["fps"].values,
+        scored["device_type"].values,
+        display_res,
+        model_config_filename,
+    )
+    for k in ["final_pred", "coding_deg", "upscaling_deg", "temporal_deg"]:
+        scored[k] = res[k]
+    return scored
+
+
+def pareto_front(scored, group_by=["ladder", "codec", "device_type"], quality="final_pred"):
+    """
+    quality-vs-bitrate pareto front per group of a scored dataframe (see evaluate_ladders),
+    a rung is part of the front if no other rung of the group reaches at least the same quality with a lower bitrate
+    """
+    scored = scored.sort_values(group_by + ["bitrate", quality], ascending=[True] * len(group_by) + [True, False])
+    best = scored.groupby(group_by, sort=False)[quality].cummax()
+    previous_best = scored.assign(best=best).groupby(group_by, sort=False)["best"].shift(fill_value=-np.inf)
+    return scored[scored[quality] > previous_best].reset_index(drop=True)
+
+
+def _upper_hull(bitrate, quality):
+    # monotone chain, points are sorted by bitrate and already pareto optimal
+    hull = []
+    for i in range(len(bitrate)):
+        while len(hull) >= 2:
+            a, b = hull[-2], hull[-1]
+            cross = (bitrate[b] - bitrate[a]) * (quality[i] - quality[a]) - (quality[b] - quality[a]) * (bitrate[i] - bitrate[a])
+            if cross < 0:
+                break
+            hull.pop()
+        hull.append(i)
+    return hull
+
+
+def convex_hull(scored, group_by=["ladder", "codec", "device_type"], quality="final_pred"):
+    """
+    upper convex hull of the quality-vs-bitrate pareto front per group of a scored dataframe (see evaluate_ladders)
+    """
+    front = pareto_front(scored, group_by, quality)
+    selected = []
+    for _, group in front.groupby(group_by, sort=False):
+        hull = _upper_hull(group["bitrate"].values.astype(float), group[quality].values)
+        selected.extend(group.index[hull])
+    return front.loc[selected].reset_index(drop=True)
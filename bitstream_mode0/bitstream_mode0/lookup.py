@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+precomputed quality surfaces of the bitstream mode 0 model
+
+style: black -l 140 lookup.py
+"""
+import argparse
+import itertools
+import logging
+import os
+import sys
+
+import numpy as np
+
+from bitstream_mode0 import __version__
+from bitstream_mode0.generic import *
+from bitstream_mode0.model import BitstreamMode0
+from bitstream_mode0.modelutils import batch_inputs
+from bitstream_mode0.utils import assert_file
+from bitstream_mode0.utils import assert_msg
+from bitstream_mode0.utils import json_load
+from bitstream_mode0.utils import json_store
+
+
+# default grid axes as (min, max, number of log-spaced points),
+# bitrate in kbit/s, resolution in pixels (width * height), framerate in frames per second
+GRID_AXES = {
+    "bitrate": (50, 100000, 160),
+    "resolution": (320 * 180, 7680 * 4320, 64),
+    "framerate": (5, 120, 48),
+}
+
+
+class QualityLookup:
+    """
+    mode 0 `final_pred` surfaces precomputed on a log-spaced bitrate x resolution x framerate grid
+    for each device class and codec and one display resolution;
+    scores are trilinearly interpolated in log space, inputs outside of the grid are clipped to its borders.
+
+    The maximum absolute error against the exact model (BitstreamMode0.predict_batch) is estimated
+    on random grid points during the build and stored as `max_abs_error` in the header.
+    """
+
+    def __init__(self, table, header):
+        # table is indexed by [device class id, codec id, bitrate, resolution, framerate]
+        self.table = table
+        self.header = header
+        self._log_min = np.array([np.log(header["axes"][a][0]) for a in GRID_AXES])
+        self._log_step = np.array(
+            [(np.log(header["axes"][a][1]) - np.log(header["axes"][a][0])) / (header["axes"][a][2] - 1) for a in GRID_AXES]
+        )
+
+    @classmethod
+    def build(cls, model_config_filename=DEFAULT_MODEL, display_res=3840 * 2160, axes=GRID_AXES, validation_samples=100000):
+        """
+        evaluate the exact mode 0 model on the full grid for all device classes and codecs
+        """
+        assert_file(model_config_filename, f"{model_config_filename} does not exist, please check")
+        grid = np.meshgrid(*[np.geomspace(*axes[a]) for a in GRID_AXES], indexing="ij")
+        table = np.empty((len(DEVICE_CLASSES), len(CODECS_SUPPORTED)) + grid[0].shape)
+
+        model = BitstreamMode0()
+        for (i, device_class), (j, codec) in itertools.product(enumerate(DEVICE_CLASSES), enumerate(CODECS_SUPPORTED)):
+            logging.info(f"build quality surface for {device_class}/{codec}")
+            res = model.predict_batch(codec, grid[0], grid[1], grid[2], device_class, display_res, model_config_filename)
+            table[i, j] = res["final_pred"].reshape(grid[0].shape)
+
+        header = {
+            "model": "bitstream_mode0",
+            "version": __version__,
+            "model_config": os.path.abspath(model_config_filename),
+            "display_res": float(display_res),
+            "device_classes": DEVICE_CLASSES,
+            "codecs": CODECS_SUPPORTED,
+            "axes": {a: list(axes[a]) for a in GRID_AXES},
+        }
+        lookup = cls(table, header)
+        lookup.header["max_abs_error"] = lookup.max_abs_error(model_config_filename, validation_samples)
+        return lookup
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """
+        load a table stored with `save`, the table is memory-mapped by default
+        """
+        basename = os.path.splitext(filename)[0]
+        assert_file(basename + ".npy", f"{basename}.npy does not exist, please build the lookup table first")
+        header = json_load(basename + ".json")
+        assert_msg(
+            header["device_classes"] == DEVICE_CLASSES and header["codecs"] == CODECS_SUPPORTED,
+            f"lookup table {basename} does not match the supported device classes and codecs, please rebuild it",
+        )
+        return cls(np.load(basename + ".npy", mmap_mode="r" if mmap else None), header)
+
+    def save(self, filename):
+        """
+        store the table as `<filename>.npy` and its header (grid, display resolution, error) as `<filename>.json`
+        """
+        basename = os.path.splitext(filename)[0]
+        os.makedirs(os.path.dirname(os.path.abspath(basename)), exist_ok=True)
+        np.save(basename + ".npy", self.table)
+        json_store(basename + ".json", self.header)
+
+    def _interpolate(self, device_id, codec_id, values):
+        # flat index of the lower grid corner and the offsets of all 8 corners of the surrounding cell
+        strides = np.array(self.table.strides) // self.table.itemsize
+        flat_index = device_id * strides[0] + codec_id * strides[1]
+        fractions = []
+        for axis, x in enumerate(values):
+            points = self.table.shape[2 + axis]
+            t = np.clip((np.log(x) - self._log_min[axis]) / self._log_step[axis], 0, points - 1)
+            i = np.minimum(t.astype(np.intp), points - 2)
+            flat_index += i * strides[2 + axis]
+            fractions.append(t - i)
+
+        table = self.table.reshape(-1)
+        result = np.zeros(len(device_id))
+        for corner in itertools.product([0, 1], repeat=3):
+            weight = np.ones(len(device_id))
+            for axis, c in enumerate(corner):
+                weight *= fractions[axis] if c else 1 - fractions[axis]
+            result += weight * table[flat_index + np.dot(corner, strides[2:])]
+        return result
+
+    def predict(self, codec, bitrate_kbps, resolution, framerate, device_type="pc"):
+        """
+        interpolated `final_pred` for many rendition descriptors, arguments as for BitstreamMode0.predict_batch,
+        the display resolution is fixed by the table
+        """
+        codec_id, device_id, bitrate, resolution, framerate = batch_inputs(codec, device_type, bitrate_kbps, resolution, framerate)
+        return self._interpolate(device_id, codec_id, [bitrate, resolution, framerate])
+
+    def max_abs_error(self, model_config_filename=DEFAULT_MODEL, samples=100000, seed=0):
+        """
+        maximum absolute difference to the exact model for random log-uniform samples inside of the grid
+        """
+        rng = np.random.default_rng(seed)
+        values = [np.exp(rng.uniform(np.log(self.header["axes"][a][0]), np.log(self.header["axes"][a][1]), samples)) for a in GRID_AXES]
+        codec = rng.choice(CODECS_SUPPORTED, samples)
+        device_type = rng.choice(DEVICE_CLASSES, samples)
+        exact = BitstreamMode0().predict_batch(
+            codec, values[0], values[1], values[2], device_type, self.header["display_res"], model_config_filename
+        )
+        return float(np.max(np.abs(exact["final_pred"] - self.predict(codec, values[0], values[1], values[2], device_type))))
+
+
+def main(_=[]):
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        description="build precomputed quality lookup tables for the bitstream mode 0 model",
+        epilog="rrao, stg7 2022",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("output", type=str, help="filename of the table, `.npy` and `.json` will be created")
+    parser.add_argument("--model", type=str, default=DEFAULT_MODEL, help="model config file to be used for prediction")
+    parser.add_argument(
+        "--device_resolution",
+        choices=DEVICE_RESOLUTIONS,
+        default="3840x2160",
+        help="resolution of the output device (width x height)",
+    )
+    for axis, (minimum, maximum, points) in GRID_AXES.items():
+        parser.add_argument(
+            f"--{axis}_grid",
+            type=float,
+            nargs=3,
+            default=[minimum, maximum, points],
+            metavar=("MIN", "MAX", "POINTS"),
+            help=f"log-spaced {axis} grid",
+        )
+
+    a = vars(parser.parse_args())
+    logging.basicConfig(level=logging.INFO)
+
+    width, height = a["device_resolution"].split("x")
+    axes = {axis: (a[f"{axis}_grid"][0], a[f"{axis}_grid"][1], int(a[f"{axis}_grid"][2])) for axis in GRID_AXES}
+    lookup = QualityLookup.build(a["model"], float(width) * float(height), axes)
+    logging.info(f"maximum absolute error against the exact model: {lookup.header['max_abs_error']}")
+    lookup.save(a["output"])
+    logging.info(f"lookup table stored as {a['output']}")
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
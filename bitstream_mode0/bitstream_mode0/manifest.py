@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+scoring of HLS master playlists and DASH MPDs with the bitstream mode 0 model,
+all required information (bitrate, resolution, framerate and codec) is taken from the manifest,
+no media file is probed
+
+style: black -l 140 manifest.py
+"""
+import os
+import re
+import logging
+import datetime
+import xml.etree.ElementTree as ET
+from fractions import Fraction
+
+from bitstream_mode0 import __version__
+from bitstream_mode0.generic import *
+from bitstream_mode0.model import BitstreamMode0
+from bitstream_mode0.utils import assert_file
+from bitstream_mode0.utils import assert_msg
+
+MANIFEST_EXTENSIONS = [".m3u8", ".mpd"]
+
+# RFC 6381 codec prefixes of manifests mapped to ffmpeg codec names
+MANIFEST_CODECS = {
+    "avc1": "h264",
+    "avc3": "h264",
+    "hvc1": "hevc",
+    "hev1": "hevc",
+    "vp09": "vp9",
+    "vp9": "vp9",
+}
+
+
+def is_manifest(filename):
+    return os.path.splitext(filename)[1].lower() in MANIFEST_EXTENSIONS
+
+
+def video_codec(codecs):
+    """
+    ffmpeg name of the video codec of a manifest codecs attribute, e.g. "avc1.640028,mp4a.40.2" -> "h264"
+    """
+    for codec in codecs.split(","):
+        prefix = codec.strip().split(".")[0].lower()
+        if prefix in MANIFEST_CODECS:
+            return MANIFEST_CODECS[prefix]
+    return "unknown"
+
+
+def framerate(value):
+    """
+    framerate of a manifest (e.g. "29.970" or "30000/1001") rounded as done by utils.ffprobe, 60 if unknown (see features.Framerate)
+    """
+    if value in [None, ""]:
+        return 60.0
+    return float(round(Fraction(value)))
+
+
+def _variant(manifest, name, codecs, bandwidth, width, height, fps):
+    return {
+        "manifest": manifest,
+        "variant": name,
+        "codec": video_codec(codecs or ""),
+        # bitrate in kbit/s as calculated by features.Bitrate
+        "bitrate": float(bandwidth) / 1024,
+        "width": int(width),
+        "height": int(height),
+        "fps": framerate(fps),
+    }
+
+
+def parse_m3u8(filename):
+    """
+    extract all video variants of an HLS master playlist,
+    AVERAGE-BANDWIDTH is preferred over BANDWIDTH if it is available
+    """
+    variants = []
+    attributes = None
+    with open(filename) as playlist:
+        for line in playlist:
+            line = line.strip()
+            if line.startswith("#EXT-X-STREAM-INF:"):
+                attributes = dict(re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', line[len("#EXT-X-STREAM-INF:") :]))
+                attributes = {k: v.strip('"') for k, v in attributes.items()}
+                continue
+            if attributes is None or line == "" or line.startswith("#"):
+                continue
+            # the first uri line after #EXT-X-STREAM-INF is the variant
+            if "RESOLUTION" not in attributes:
+                logging.warning(f"variant {line} of {filename} has no resolution, it will be ignored")
+            elif "BANDWIDTH" not in attributes and "AVERAGE-BANDWIDTH" not in attributes:
+                logging.warning(f"variant {line} of {filename} has no bandwidth, it will be ignored")
+            else:
+                width, height = attributes["RESOLUTION"].split("x")
+                bandwidth = attributes.get("AVERAGE-BANDWIDTH", attributes.get("BANDWIDTH"))
+                variants.append(_variant(filename, line, attributes.get("CODECS"), bandwidth, width, height, attributes.get("FRAME-RATE")))
+            attributes = None
+    return variants
+
+
+def parse_mpd(filename):
+    """
+    extract all video representations of a DASH MPD,
+    codecs, width, height and frameRate are inherited from the AdaptationSet
+    """
+    variants = []
+    root = ET.parse(filename).getroot()
+    namespace = re.match(r"\{.*\}", root.tag)
+    namespace = namespace.group(0) if namespace else ""
+    for period in root.iter(namespace + "Period"):
+        for adaptation_set in period.iter(namespace + "AdaptationSet"):
+            for representation in adaptation_set.iter(namespace + "Representation"):
+
+                def attribute(name):
+                    return representation.get(name, adaptation_set.get(name))
+
+                content_type = adaptation_set.get("contentType", "") + (attribute("mimeType") or "")
+                if "video" not in content_type and attribute("width") is None:
+                    continue
+                if attribute("width") is None or attribute("height") is None:
+                    logging.warning(f"representation {representation.get('id')} of {filename} has no resolution, it will be ignored")
+                    continue
+                if representation.get("bandwidth") is None:
+                    logging.warning(f"representation {representation.get('id')} of {filename} has no bandwidth, it will be ignored")
+                    continue
+                variants.append(
+                    _variant(
+                        filename,
+                        representation.get("id"),
+                        attribute("codecs"),
+                        representation.get("bandwidth"),
+                        attribute("width"),
+                        attribute("height"),
+                        attribute("frameRate"),
+                    )
+                )
+    return variants
+
+
+def parse_manifest(filename):
+    """
+    extract all video variants of a local .m3u8 or .mpd file
+    @return list of dictionaries with manifest, variant, codec, bitrate (kbit/s), width, height and fps
+    """
+    assert_file(filename, f"{filename} does not exist, please check")
+    assert_msg(is_manifest(filename), f"{filename} is not a supported manifest, only {MANIFEST_EXTENSIONS} possible")
+    if filename.lower().endswith(".mpd"):
+        return parse_mpd(filename)
+    return parse_m3u8(filename)
+
+
+def supported_variants(manifest):
+    """
+    all video variants of a manifest (see parse_manifest) with a supported video codec
+    """
+    variants = []
+    for variant in parse_manifest(manifest):
+        if variant["codec"] not in CODECS_SUPPORTED:
+            logging.warning(f"variant {variant['variant']} of {manifest} uses a video codec that is not supported, it will be ignored")
+            continue
+        variants.append(variant)
+    return variants
+
+
+def predict_variants(
+    variants,
+    model_config_filename=DEFAULT_MODEL,
+    device_type="pc",
+    device_resolution="3840x2160",
+    viewing_distance="1.5xH",
+    display_size=55,
+):
+    """
+    score video variants of any number of manifests (see supported_variants) in one batch
+    @return list of reports, one per variant, in the order of the variants
+    """
+    device_type = device_type.lower()
+    assert_msg(
+        device_type in DEVICE_TYPES,
+        f"specified device_type '{device_type}' is not supported, only {DEVICE_TYPES} possible",
+    )
+    assert_msg(
+        device_resolution in DEVICE_RESOLUTIONS,
+        f"specified device_resolution '{device_resolution}' is not supported, only {DEVICE_RESOLUTIONS} possible",
+    )
+    assert_msg(
+        viewing_distance in VIEWING_DISTANCES,
+        f"specified viewing_distance '{viewing_distance}' is not supported, only {VIEWING_DISTANCES} possible",
+    )
+    assert_msg(
+        display_size in DISPLAY_SIZES,
+        f"specified display_size '{display_size}' is not supported, only {DISPLAY_SIZES} possible",
+    )
+    if len(variants) == 0:
+        return []
+
+    display_res = float(device_resolution.split("x")[0]) * float(device_resolution.split("x")[1])
+    per_sequence = BitstreamMode0().predict_batch(
+        [v["codec"] for v in variants],
+        [v["bitrate"] for v in variants],
+        [v["width"] * v["height"] for v in variants],
+        [v["fps"] for v in variants],
+        device_type,
+        display_res,
+        model_config_filename,
+    )
+
+    date = str(datetime.datetime.now())
+    results = []
+    for i, variant in enumerate(variants):
+        variant_name = re.sub(r"[^\w.-]+", "_", os.path.splitext(variant["variant"] or str(i))[0])
+        results.append(
+            {
+                "video_full_path": variant["manifest"],
+                "video_basename": os.path.splitext(os.path.basename(variant["manifest"]))[0] + "_" + variant_name,
+                "variant": variant,
+                "per_sequence": float(per_sequence["final_pred"][i]),
+                "debug": {
+                    "coding_deg": float(per_sequence["coding_deg"][i]),
+                    "upscaling_deg": float(per_sequence["upscaling_deg"][i]),
+                    "temporal_deg": float(per_sequence["temporal_deg"][i]),
+                },
+                "date": date,
+                "model": "bitstream_mode0",
+                "version": __version__,
+            }
+        )
+    return results
+
+
+def predict_manifests(
+    manifests,
+    model_config_filename=DEFAULT_MODEL,
+    device_type="pc",
+    device_resolution="3840x2160",
+    viewing_distance="1.5xH",
+    display_size=55,
+):
+    """
+    score all video variants of all given manifests in one batch
+    @return list of reports, one per variant
+    """
+    variants = [variant for manifest in manifests for variant in supported_variants(manifest)]
+    return predict_variants(variants, model_config_filename, device_type, device_resolution, viewing_distance, display_size)
@@ -7,10 +7,14 @@ import json
 import os
 import datetime
 
+import numpy as np
+
 from bitstream_mode0 import __version__
 from bitstream_mode0.utils import assert_file
 from bitstream_mode0.utils import assert_msg
+from bitstream_mode0.utils import UnsupportedVideoError
 from bitstream_mode0.utils import ffprobe
+from bitstream_mode0.utils import FeatureCache
 from bitstream_mode0.utils import json_load
 from bitstream_mode0.modelutils import map_to_45
 from bitstream_mode0.modelutils import map_to_5
@@ -20,6 +24,11 @@ from bitstream_mode0.modelutils import load_serialized
 from bitstream_mode0.modelutils import binarize_column
 from bitstream_mode0.modelutils import load_dict_values
 from bitstream_mode0.modelutils import per_sample_interval_function
+from bitstream_mode0.modelutils import load_coefficients
+from bitstream_mode0.modelutils import device_class_ids
+from bitstream_mode0.modelutils import predicted_qp
+from bitstream_mode0.modelutils import to_ids
+from bitstream_mode0.modelutils import batch_inputs
 from bitstream_mode0.generic import *
 
 import bitstream_mode0.features as features
@@ -34,150 +43,137 @@ class BitstreamMode0:
     def __init__(self):
         self.display_res = 3840 * 2160
 
-    def _calculate(self, prediction_features, params, display_res, device_type):
-        def mos_q_baseline_pc(features, a, b, c, d):
-            print("a = {}, b = {}, c = {}, d = {}".format(a, b, c, d))
-            quant = features["quant"]
-            mos_q = a + b * np.exp(c * quant + d)
-            mos_q = np.clip(mos_q, 1, 5)
-            mos_q = np.vectorize(r_from_mos)(mos_q)
-            cod_deg = 100 - mos_q
-            cod_deg = np.clip(cod_deg, 0, 100)
-            return cod_deg
-
-        prediction_features = prediction_features.copy()
-
-        print(params)
-        # SG: shouldn't all these coeffs be part of the model.json file?, if not what values are then in this json file?
-        #   in theory depending on the model and device all these coeffs should be part of params
-        #   but it doesnt look like this
-        # same confusion with mode 1
-
-        # SG: there seems to be also something too much with these files
-        # ./models/bitstream_mode0/config.json  <- has mobile and PC and is used..
-        # ./models/bitstream_mode0/mode0baseline_mobile_final_coeff.json
-        # ./models/bitstream_mode0/mode0baseline_pc_final_coeff.json
-
-        # change this to different things for mobile and pc
-        def predqp_pc(row):
-            if row["Codec"] not in ["h264", "hevc", "vp9"]:
-                return -1
-            if row["Codec"] == "h264":
-                d = 5.62309933
-                c = 4.19647182
-                b = -5.35863448
-                a = -5.72843619
-            if row["Codec"] == "hevc":
-                d = 4.08694769
-                c = 4.82981247
-                b = -6.02561845
-                a = -7.68665264
-
-            if row["Codec"] == "vp9":
-                d = 27.5875919
-                c = 37.5395453
-                b = -46.5290494
-                a = -140.838395
-            pred_qp = a + b * np.log(row["Bitrate"]) + c * np.log(row["Resolution"]) + d * np.log(row["Framerate"])
-            return pred_qp
-
-        def predqp_mobile(row):
-            if row["Codec"] not in ["h264", "hevc", "vp9"]:
-                return -1
-            if row["Codec"] == "h264":
-                d = 3.01147460
-                c = 4.37840851
-                b = -4.92630532
-                a = -1.46439015
-            if row["Codec"] == "hevc":
-                d = 2.34100646
-                c = 4.76721523
-                b = -5.86551697
-                a = -1.65354441
-            if row["Codec"] == "vp9":
-                d = 30.8075359
-                c = 28.7095166
-                b = -41.0775277
-                a = -65.7419925
-            pred_qp = a + b * np.log(row["Bitrate"]) + c * np.log(row["Resolution"]) + d * np.log(row["Framerate"])
-            return pred_qp
-
-        if device_type.lower() in ["pc", "tv"]:
-            prediction_features["pred_qp"] = prediction_features.apply(predqp_pc, axis=1)
-        else:
-            prediction_features["pred_qp"] = prediction_features.apply(predqp_mobile, axis=1)
-
-        def norm_qp(row):
-            if row["Codec"] == "h264":
-                return row["pred_qp"] / 63
-            if row["Codec"] == "hevc":
-                return row["pred_qp"] / 63
-            if row["Codec"] == "vp9":
-                return row["pred_qp"] / 255
-            return -1
-
-        prediction_features["quant"] = prediction_features.apply(norm_qp, axis=1)
-
-        prediction_features = binarize_column(prediction_features, "Codec")
-
-        codecs = prediction_features["Codec"].unique()
-
-        cod_deg = sum(
-            [
-                prediction_features[c]
-                * mos_q_baseline_pc(prediction_features, params[c + "_a"], params[c + "_b"], params[c + "_c"], params[c + "_d"])
-                for c in codecs
-            ]
-        )
-
-        if device_type.lower() in ["pc", "tv"]:
-            x = -12.8292
-            y = 2.4358
-            z = -41.0545
-            k = 3.7547
-        else:
-            x = -10.4174
-            y = 2.2679
-            z = -57.1618
-            k = 3.5766
-
-        print("x = {}, y = {}, z = {}, k = {}".format(x, y, z, k))
-        print("quant = {}".format(prediction_features["quant"]))
-        print("display_res = {}".format(display_res))
-        resolution = x * np.log(y * (prediction_features["Resolution"] / display_res))
-        resolution = np.clip(resolution, 0, 100)
-
-        framerate = z * np.log(k * prediction_features["Framerate"] / 60)
-        framerate = np.clip(framerate, 0, 100)
-
-        pred = 100 - (cod_deg + resolution + framerate)
-        pred = np.vectorize(mos_from_r)(pred)
+    def _predict(self, codec_id, bitrate, resolution, framerate, device_id, display_res, coefficients):
+        """
+        vectorized mode 0 model equations,
+        all inputs are 1-d numpy arrays of the same length, codec and device class are given as ids
+        (see CODECS_SUPPORTED and DEVICE_CLASSES) to gather the compiled model coefficients
+        """
+        quant = predicted_qp(coefficients, device_id, codec_id, [np.log(bitrate), np.log(resolution), np.log(framerate)])
+
+        a, b, c, d = coefficients.mos_q[device_id, codec_id].T
+        mos_q = a + b * np.exp(c * quant + d)
+        mos_q = np.clip(mos_q, 1, 5)
+        mos_q = r_from_mos(mos_q)
+        cod_deg = np.clip(100 - mos_q, 0, 100)
+
+        x, y, z, k = coefficients.degradation[device_id].T
+        resolution_deg = x * np.log(y * (resolution / display_res))
+        resolution_deg = np.clip(resolution_deg, 0, 100)
+
+        framerate_deg = z * np.log(k * framerate / 60)
+        framerate_deg = np.clip(framerate_deg, 0, 100)
+
+        pred = 100 - (cod_deg + resolution_deg + framerate_deg)
+        pred = mos_from_r(pred)
         pred = np.clip(pred, 1, 5)
-        # predicted_score = np.vectorize(map_to_5)(pred)
-        initial_predicted_score = np.vectorize(map_to_5)(pred)
+        initial_predicted_score = map_to_5(pred)
 
         return {
             "final_pred": initial_predicted_score,
             "coding_deg": cod_deg,
-            "upscaling_deg": resolution,
-            "temporal_deg": framerate,
+            "upscaling_deg": resolution_deg,
+            "temporal_deg": framerate_deg,
         }
-        # return predicted_score
 
-    def features_used(self):
-        return [features.Bitrate, features.Framerate, features.Resolution, features.Codec]
+    def _calculate(self, prediction_features, coefficients, display_res, device_type):
+        rows = len(prediction_features)
+        return self._predict(
+            to_ids(prediction_features["Codec"].values, CODECS_SUPPORTED),
+            prediction_features["Bitrate"].values.astype(float),
+            prediction_features["Resolution"].values.astype(float),
+            prediction_features["Framerate"].values.astype(float),
+            device_class_ids(np.full(rows, device_type)),
+            np.full(rows, float(display_res)),
+            coefficients,
+        )
 
-    def predict_quality(
+    def predict_batch(
         self,
-        videofilename,
-        model_config_filename,
+        codec,
+        bitrate_kbps,
+        resolution,
+        framerate,
         device_type="pc",
-        device_resolution="3840x2160",
-        viewing_distance="1.5xH",
-        display_size=55,
-        temporary_folder="tmp",
+        display_res=3840 * 2160,
+        model_config_filename=DEFAULT_MODEL,
     ):
+        """
+        predict the quality of many rendition descriptors at once without probing any file,
+        all arguments are numpy arrays (or scalars) that are broadcasted against each other
+
+        @param codec ffmpeg codec name, one of CODECS_SUPPORTED
+        @param bitrate_kbps video bitrate in kbit/s, as calculated by features.Bitrate
+        @param resolution width * height in pixels
+        @param framerate frames per second
+        @param device_type one of DEVICE_TYPES
+        @param display_res display width * height in pixels
+        @return dictionary with 1-d arrays for final_pred, coding_deg, upscaling_deg and temporal_deg
+        """
+        assert_file(model_config_filename, f"{model_config_filename} does not exist, please check")
+        codec_id, device_id, bitrate, resolution, framerate, display_res = batch_inputs(
+            codec, device_type, bitrate_kbps, resolution, framerate, display_res
+        )
+        coefficients = load_coefficients(model_config_filename)
+        return self._predict(codec_id, bitrate, resolution, framerate, device_id, display_res, coefficients)
+
+    def required_bitrate(
+        self,
+        target_mos,
+        codec,
+        resolution,
+        framerate,
+        device_type="pc",
+        display_res=3840 * 2160,
+        model_config_filename=DEFAULT_MODEL,
+        bitrate_range=(10, 1000000),
+        iterations=50,
+    ):
+        """
+        minimum bitrate in kbit/s for which the predicted per_sequence score reaches target_mos,
+        solved for all targets at once by a vectorized bisection of the log-bitrate,
+        all arguments are numpy arrays (or scalars) that are broadcasted against each other, see predict_batch;
+        final_pred is not strictly monotonic in the bitrate, the cubic of mos_from_r dips slightly below MOS_MIN for R < 3.2,
+        for targets below about 1.05 the returned bitrate reaches target_mos but is not necessarily the minimum
+
+        @param target_mos target per_sequence score (1..5)
+        @param bitrate_range search interval in kbit/s, if target_mos is already reached at the lower end, the lower end is returned
+        @param iterations number of bisection steps, 50 steps are far below any relevant bitrate resolution
+        @return 1-d array of bitrates in kbit/s, NaN where target_mos can not be reached within bitrate_range
+            (e.g. due to the upscaling or temporal degradation)
+        """
+        assert_file(model_config_filename, f"{model_config_filename} does not exist, please check")
+        codec_id, device_id, target_mos, resolution, framerate, display_res = batch_inputs(
+            codec, device_type, target_mos, resolution, framerate, display_res
+        )
+        coefficients = load_coefficients(model_config_filename)
+
+        def reaches_target(log_bitrate):
+            pred = self._predict(codec_id, np.exp(log_bitrate), resolution, framerate, device_id, display_res, coefficients)
+            return pred["final_pred"] >= target_mos
+
+        low = np.full(len(target_mos), np.log(bitrate_range[0]))
+        high = np.full(len(target_mos), np.log(bitrate_range[1]))
+        reachable = reaches_target(high)
+        already_reached = reaches_target(low)
+        for _ in range(iterations):
+            mid = (low + high) / 2
+            reached = reaches_target(mid)
+            high = np.where(reached, mid, high)
+            low = np.where(reached, low, mid)
+
+        bitrate = np.exp(high)
+        bitrate[already_reached] = bitrate_range[0]
+        bitrate[~reachable] = np.nan
+        return bitrate
+
+    def features_used(self):
+        return [features.Bitrate, features.Framerate, features.Resolution, features.Codec]
 
+    def _check_settings(self, videofilename, model_config_filename, device_type, device_resolution, viewing_distance, display_size):
+        """ validate all settings of a prediction
+        @return lower case device type
+        """
         assert_file(videofilename, f"{videofilename} does not exist, please check")
         assert_file(model_config_filename, f"{model_config_filename} does not exist, please check")
 
@@ -198,48 +194,82 @@ class BitstreamMode0:
             display_size in DISPLAY_SIZES,
             f"specified display_size '{display_size}' is not supported, only {DISPLAY_SIZES} possible",
         )
+        return device_type
+
+    def _feature_cache(self, temporary_folder):
+        # features only depend on the video, so they are reused for all device settings
+        return FeatureCache(os.path.join(temporary_folder, "features"), f"mode0_{__version__}_{FEATURE_VERSION}")
+
+    def predict_quality(
+        self,
+        videofilename,
+        model_config_filename,
+        device_type="pc",
+        device_resolution="3840x2160",
+        viewing_distance="1.5xH",
+        display_size=55,
+        temporary_folder="tmp",
+        cache_features=True,
+    ):
+        device_type = self._check_settings(
+            videofilename, model_config_filename, device_type, device_resolution, viewing_distance, display_size
+        )
+
+        feature_cache = self._feature_cache(temporary_folder) if cache_features else None
+        cached = feature_cache.get(videofilename) if feature_cache is not None else None
+        if cached is not None:
+            logging.info("features are already cached, extraction skipped")
+            return self._predict_probed(
+                videofilename, model_config_filename, device_type, device_resolution, cached["ffprobe_result"], extracted=cached["features"]
+            )
+
+        ffprobe_result = ffprobe(videofilename, temporary_folder)
+        return self._predict_probed(
+            videofilename, model_config_filename, device_type, device_resolution, ffprobe_result, feature_cache=feature_cache
+        )
 
-        ffprobe_result = ffprobe(videofilename)
+    def _predict_probed(
+        self, videofilename, model_config_filename, device_type, device_resolution, ffprobe_result, extracted=None, feature_cache=None
+    ):
+        """ predict the quality of a probed video, the features are extracted from the ffprobe result
+        and stored in the feature cache unless they are already extracted (e.g. cached)
+        """
         assert_msg(
             ffprobe_result["codec"] in CODECS_SUPPORTED,
             f"your video codec is not supported by the model: {ffprobe_result['codec']}",
+            UnsupportedVideoError,
         )
 
-        model_config = json_load(model_config_filename)
-
-        device_type = "pc" if device_type in ["pc", "tv"] else "mobile"
-
-        # select only the required config for the device type
-        model_config = model_config[device_type]
-
-        # assume the RF model part is locally stored in the path of model_config_filename
-        # rf_model = os.path.join(os.path.dirname(model_config_filename), model_config["rf"])
-
-        # load parametetric model coefficients
-        model_coefficients = model_config["params"]
+        # load the compiled parametric model coefficients of all device classes
+        coefficients = load_coefficients(model_config_filename)
 
         display_res = float(device_resolution.split("x")[0]) * float(device_resolution.split("x")[1])
 
         self.display_res = display_res
 
-        # calculate features
-        features = pd.DataFrame([extract_features(videofilename, self.features_used(), ffprobe_result)])
+        if extracted is None:
+            # calculate features
+            extracted = extract_features(videofilename, self.features_used(), ffprobe_result)
+            if feature_cache is not None:
+                feature_cache.put(videofilename, {"features": extracted, "ffprobe_result": ffprobe_result})
+        extracted["videofilename"] = videofilename
+        features = pd.DataFrame([extracted])
 
         logging.info("features extracted")
 
         # per_sequence = self._calculate(features, model_coefficients, rf_model, display_res, device_type)
-        per_sequence = self._calculate(features, model_coefficients, display_res, device_type)
+        per_sequence = self._calculate(features, coefficients, display_res, device_type)
 
-        per_second = per_sample_interval_function(per_sequence["final_pred"], features)
+        per_second = per_sample_interval_function(per_sequence["final_pred"][0], features)
         return {
             "video_full_path": videofilename,
             "video_basename": os.path.basename(videofilename),
             "per_second": [float(x) for x in per_second],
-            "per_sequence": float(per_sequence["final_pred"]),
+            "per_sequence": float(per_sequence["final_pred"][0]),
             "debug": {
-                "coding_deg": float(per_sequence["coding_deg"]),
-                "upscaling_deg": float(per_sequence["upscaling_deg"]),
-                "temporal_deg": float(per_sequence["temporal_deg"]),
+                "coding_deg": float(per_sequence["coding_deg"][0]),
+                "upscaling_deg": float(per_sequence["upscaling_deg"][0]),
+                "temporal_deg": float(per_sequence["temporal_deg"][0]),
             },
             "date": str(datetime.datetime.now()),
             "model": "bitstream_mode0",
@@ -2,6 +2,8 @@
 import os
 import json
 import logging
+import threading
+import collections
 
 import pandas as pd
 import numpy as np
@@ -9,6 +11,12 @@ import scipy.stats
 import sklearn_json as skljson
 
 from bitstream_mode0.utils import json_load
+from bitstream_mode0.utils import assert_msg
+from bitstream_mode0.utils import UnsupportedVideoError
+from bitstream_mode0.generic import CODECS_SUPPORTED
+from bitstream_mode0.generic import DEVICE_CLASSES
+from bitstream_mode0.generic import QP_MAX
+from bitstream_mode0.generic import DEVICE_TYPES
 
 
 MOS_MAX = 4.9
@@ -797,28 +805,30 @@ R_FROM_MOS_VALUES = [
 ]
 
 
+# numpy versions of the lookup table for vectorized interpolation
+R_FROM_MOS_KEYS_ARRAY = np.array(R_FROM_MOS_KEYS, dtype=np.float64)
+R_FROM_MOS_VALUES_ARRAY = np.array(R_FROM_MOS_VALUES, dtype=np.float64)
+
+
 def mos_from_r(Q):
-    if Q <= 0:
-        return MOS_MIN
-    if Q >= 100:
-        return MOS_MAX
-    MOS = (
-        MOS_MIN + float(MOS_MAX - MOS_MIN) * float(Q) / 100.0 + float(Q) * float(Q - 60.0) * float(100.0 - Q) * 0.000007
-    )
-    return MOS
+    """
+    convert R (0..100) to MOS (MOS_MIN..MOS_MAX), works for scalars and numpy arrays
+    """
+    Q = np.asarray(Q, dtype=np.float64)
+    MOS = MOS_MIN + float(MOS_MAX - MOS_MIN) * Q / 100.0 + Q * (Q - 60.0) * (100.0 - Q) * 0.000007
+    MOS = np.where(Q <= 0, MOS_MIN, np.where(Q >= 100, MOS_MAX, MOS))
+    return MOS[()]
 
 
 def r_from_mos(MOS):
-    if MOS < MOS_MIN:
-        MOS = MOS_MIN
-    if MOS > MOS_MAX:
-        MOS = MOS_MAX
-
-    if MOS in R_FROM_MOS_KEYS:
-        Q = R_FROM_MOS_VALUES[R_FROM_MOS_KEYS.index(MOS)]
-    else:
-        Q = np.interp(MOS, R_FROM_MOS_KEYS, R_FROM_MOS_VALUES)
-    return Q
+    """
+    convert MOS to R (0..100) using the lookup table R_FROM_MOS_KEYS/R_FROM_MOS_VALUES,
+    works for scalars and numpy arrays
+    """
+    MOS = np.clip(np.asarray(MOS, dtype=np.float64), MOS_MIN, MOS_MAX)
+    # np.interp returns the table value for exact key matches
+    Q = np.interp(MOS, R_FROM_MOS_KEYS_ARRAY, R_FROM_MOS_VALUES_ARRAY)
+    return Q[()]
 
 
 def map_to_45(x):
@@ -827,6 +837,7 @@ def map_to_45(x):
 
     output = output_start + ((output_end - output_start) / (input_end - input_start)) * (input - input_start)
 
+    works for scalars and numpy arrays
     """
 
     input_start = 1
@@ -834,10 +845,9 @@ def map_to_45(x):
     output_start = 1
     output_end = 4.5
 
-    if x >= 5:
-        return 4.5
-
-    return output_start + ((output_end - output_start) / (input_end - input_start)) * (x - input_start)
+    x = np.asarray(x, dtype=np.float64)
+    output = output_start + ((output_end - output_start) / (input_end - input_start)) * (x - input_start)
+    return np.where(x >= 5, 4.5, output)[()]
 
 
 def map_to_5(x):
@@ -846,6 +856,7 @@ def map_to_5(x):
 
     output = output_start + ((output_end - output_start) / (input_end - input_start)) * (input - input_start)
 
+    works for scalars and numpy arrays
     """
 
     input_start = 1
@@ -853,10 +864,9 @@ def map_to_5(x):
     output_start = 1
     output_end = 5
 
-    if x >= 4.5:
-        return 5
-
-    return output_start + ((output_end - output_start) / (input_end - input_start)) * (x - input_start)
+    x = np.asarray(x, dtype=np.float64)
+    output = output_start + ((output_end - output_start) / (input_end - input_start)) * (x - input_start)
+    return np.where(x >= 4.5, 5.0, output)[()]
 
 
 def load_serialized(filename_with_path):
@@ -928,4 +938,128 @@ def per_sample_interval_function(mos_O27, prediction_features, intervall=1):
         mos_per_sec = mos_O27
         mos_per_sec = np.clip(mos_per_sec, 1, 5)
         mos_O22.append(mos_per_sec)
-    return mos_O22
\ No newline at end of file
+    return mos_O22
+
+
+ModelCoefficients = collections.namedtuple("ModelCoefficients", ["predqp", "mos_q", "degradation", "qp_max"])
+
+
+def compile_coefficients(model_config):
+    """
+    compile all parametric coefficients of a model config to read-only numpy tables,
+    predqp (a, b, c, ...) of the predicted quantization parameter and mos_q (a, b, c, d) of the coding degradation
+    are indexed by [device class id, codec id], see DEVICE_CLASSES and CODECS_SUPPORTED,
+    degradation (x, y, z, k) of the upscaling and temporal degradation is indexed by device class id,
+    qp_max by codec id
+    """
+
+    def freeze(values):
+        table = np.array(values, dtype=np.float64)
+        table.flags.writeable = False
+        return table
+
+    params = [model_config[device_class]["params"] for device_class in DEVICE_CLASSES]
+    qp_terms = sorted(k[len("h264_") :] for k in params[0] if k.startswith("h264_qp_"))
+
+    return ModelCoefficients(
+        predqp=freeze([[[p[c + "_" + t] for t in qp_terms] for c in CODECS_SUPPORTED] for p in params]),
+        mos_q=freeze([[[p[c + "_" + t] for t in ["a", "b", "c", "d"]] for c in CODECS_SUPPORTED] for p in params]),
+        degradation=freeze([[p["upscaling_x"], p["upscaling_y"], p["temporal_z"], p["temporal_k"]] for p in params]),
+        qp_max=freeze([QP_MAX[c] for c in CODECS_SUPPORTED]),
+    )
+
+
+class ModelRegistry:
+    """
+    process-level registry of compiled model configs and model instances,
+    a model config is loaded and compiled once and only reloaded if the modification time of its file changed
+    """
+
+    def __init__(self):
+        self._coefficients = {}
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def coefficients(self, model_config_filename):
+        filename = os.path.realpath(model_config_filename)
+        mtime = os.stat(filename).st_mtime_ns
+        with self._lock:
+            entry = self._coefficients.get(filename)
+            if entry is None or entry[0] != mtime:
+                logging.debug(f"load model config {filename}")
+                entry = (mtime, compile_coefficients(json_load(filename)))
+                self._coefficients[filename] = entry
+        return entry[1]
+
+    def model(self, model_class):
+        """ one shared instance of a model class per process """
+        with self._lock:
+            if model_class not in self._models:
+                self._models[model_class] = model_class()
+            return self._models[model_class]
+
+
+MODEL_REGISTRY = ModelRegistry()
+
+
+def load_coefficients(model_config_filename):
+    """ load a model config file and compile its coefficients, only once per process (see ModelRegistry) """
+    return MODEL_REGISTRY.coefficients(model_config_filename)
+
+
+def init_worker(*model_config_filenames):
+    """ pool initializer, loads and compiles the given model configs once in each worker process """
+    for model_config_filename in model_config_filenames:
+        MODEL_REGISTRY.coefficients(model_config_filename)
+
+
+def to_ids(values, names):
+    """
+    map each value of an array to its index in names, -1 is used for values that are not part of names
+    """
+    values = np.asarray(values, dtype=str)
+    ids = np.full(values.shape, -1, dtype=np.intp)
+    for i, name in enumerate(names):
+        ids[values == name] = i
+    return ids
+
+
+def device_class_ids(device_types):
+    """
+    map device types to the id of the device class that is used for the model coefficients
+    """
+    device_types = np.char.lower(np.asarray(device_types, dtype=str))
+    return np.where(np.isin(device_types, ["pc", "tv"]), DEVICE_CLASSES.index("pc"), DEVICE_CLASSES.index("mobile"))
+
+
+def batch_inputs(codec, device_type, *values):
+    """
+    validate codecs and device types of a batch and broadcast them with all other values,
+    codecs and device types are mapped to codec and device class ids before broadcasting,
+    so that scalars are only checked once
+    @return codec ids, device class ids and all values as equally long 1-d float arrays
+    """
+    codec = np.asarray(codec, dtype=str)
+    codec_id = to_ids(codec, CODECS_SUPPORTED)
+    unsupported = sorted(set(codec[codec_id < 0]))
+    assert_msg(len(unsupported) == 0, f"the following video codecs are not supported by the model: {unsupported}", UnsupportedVideoError)
+    device_type = np.char.lower(np.asarray(device_type, dtype=str))
+    unsupported = sorted(set(device_type[to_ids(device_type, DEVICE_TYPES) < 0]))
+    assert_msg(len(unsupported) == 0, f"the following device types are not supported, only {DEVICE_TYPES} possible: {unsupported}")
+
+    return [
+        np.ravel(x)
+        for x in np.broadcast_arrays(codec_id, device_class_ids(device_type), *[np.asarray(v, dtype=float) for v in values])
+    ]
+
+
+def predicted_qp(coefficients, device_id, codec_id, log_features):
+    """
+    log-linear prediction of the normalized quantization parameter,
+    log_features are the log-scaled inputs in the order of the predqp coefficients b, c, ...
+    """
+    qp = coefficients.predqp[device_id, codec_id]
+    pred_qp = qp[:, 0]
+    for i, x in enumerate(log_features):
+        pred_qp = pred_qp + qp[:, i + 1] * x
+    return pred_qp / coefficients.qp_max[codec_id]
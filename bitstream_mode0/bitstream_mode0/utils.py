@@ -7,6 +7,18 @@ import subprocess
 import json
 import bz2
 import gzip
+import time
+import datetime
+import sqlite3
+import contextlib
+import hashlib
+import threading
+import tempfile
+import zipfile
+import asyncio
+import weakref
+
+import numpy as np
 
 
 color_codes = {
@@ -33,59 +45,496 @@ logging.addLevelName(logging.INFO, color_codes["green"] + logging.getLevelName(l
 logging.addLevelName(logging.DEBUG, color_codes["blue"] + logging.getLevelName(logging.DEBUG) + color_codes["end_code"])
 
 
-def shell_call(call):
-    """
-    Run a program via system call and return stdout + stderr.
-    @param call programm and command line parameter list, e.g shell_call("ls /")
-    @return stdout and stderr of programm call
-    """
-    try:
-        output = subprocess.check_output(call, universal_newlines=True, shell=True)
-    except Exception as e:
-        output = str(e.output)
-    return output
+class ModelError(Exception):
+    """ base class of all errors for inputs that can not be handled, one failing video never stops a batch """
+
+
+class InvalidInputError(ModelError, ValueError):
+    """ missing input file or invalid parameter """
+
+
+class UnsupportedVideoError(ModelError):
+    """ valid video that is not supported by the model, e.g. because of its video codec """
+
+
+class ProcessError(ModelError):
+    """ external program (e.g. ffprobe) failed or timed out, see run """
+
+    def __init__(self, message, cmd=None, returncode=None, timed_out=False, attempts=0, stderr=""):
+        super().__init__(message)
+        self.cmd = cmd
+        self.returncode = returncode
+        self.timed_out = timed_out
+        self.attempts = attempts
+        self.stderr = stderr
+
+    def details(self):
+        return {
+            "cmd": self.cmd,
+            "returncode": self.returncode,
+            "timed_out": self.timed_out,
+            "attempts": self.attempts,
+            "stderr": self.stderr,
+        }
+
 
+class ProbeError(ProcessError):
+    """ ffprobe is not available or could not extract the needed information """
 
-def assert_msg(check, fail_message):
+
+def assert_msg(check, fail_message, exception=InvalidInputError):
     if not check:
-        logging.error(fail_message)
-        sys.exit(0)
+        raise exception(fail_message)
 
 
 def assert_file(filename, fail_message):
     assert_msg(os.path.isfile(filename), fail_message)
 
 
+def error_record(videofilename, error):
+    """ result of an input that could not be processed, with status unsupported (see UnsupportedVideoError) or failed """
+    return {
+        "video_full_path": videofilename,
+        "status": "unsupported" if isinstance(error, UnsupportedVideoError) else "failed",
+        "error": str(error),
+        "error_type": type(error).__name__,
+        "error_details": error.details() if isinstance(error, ProcessError) else None,
+        "date": str(datetime.datetime.now()),
+    }
+
+
+# timeouts of the stages that run external programs as (seconds, additional seconds per MiB of the input file),
+# so that a stuck call on a truncated or pathological file is killed instead of blocking a worker forever
+PROCESS_TIMEOUTS = {
+    "probe": (30, 0.1),
+    "packets": (30, 0.5),
+    "frames": (60, 2),
+    "encode": (120, 10),
+}
+# number of retries of a failed call, calls that timed out are not retried
+PROCESS_RETRIES = 1
+
+
+def stage_timeout(stage, filename=None):
+    """ timeout in seconds of a stage (see PROCESS_TIMEOUTS), scaled by the size of the input file """
+    seconds, per_mib = PROCESS_TIMEOUTS[stage]
+    if filename is not None and os.path.isfile(filename):
+        seconds += per_mib * os.path.getsize(filename) / 1024 ** 2
+    return seconds
+
+
+def run(cmd, timeout=None, retries=PROCESS_RETRIES, parse=None, exception=ProcessError):
+    """
+    run a program without shell and return its output, it is killed if it does not finish within timeout seconds,
+    failed calls are retried up to retries times
+    @param cmd: program and command line parameter list, e.g. run(["ls", "/"])
+    @param parse: function that consumes the stdout stream while the program runs, its result is returned instead of the output
+    @return stdout of the program or the result of parse
+    @raise exception (ProcessError or a subclass) with command, return code, timeout flag, attempts and the end of stderr
+    """
+    for attempt in range(1, retries + 2):
+        # stderr is written to a file, so that a program with lots of warnings can not block on a full pipe
+        with tempfile.TemporaryFile(mode="w+") as stderr:
+            try:
+                process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, universal_newlines=True)
+            except OSError as e:
+                raise exception(f"{cmd[0]} could not be started: {e}", cmd, attempts=attempt)
+            killed = threading.Event()
+
+            def kill():
+                killed.set()
+                process.kill()
+
+            timer = threading.Timer(timeout, kill) if timeout is not None else None
+            if timer is not None:
+                timer.start()
+            try:
+                with process:
+                    try:
+                        result = parse(process.stdout) if parse is not None else process.stdout.read()
+                        # remaining output of an early returning parse function is discarded
+                        process.stdout.read()
+                    except BaseException:
+                        process.kill()
+                        raise
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            timed_out = killed.is_set()
+            if process.returncode == 0 and not timed_out:
+                return result
+            stderr.seek(0)
+            message = stderr.read()[-2000:]
+
+        if timed_out:
+            raise exception(f"{cmd[0]} timed out after {timeout:.1f}s: {' '.join(cmd)}", cmd, process.returncode, True, attempt, message)
+        logging.warning(f"{cmd[0]} failed with return code {process.returncode} (attempt {attempt}): {message.strip()}")
+    raise exception(
+        f"{cmd[0]} failed with return code {process.returncode}: {' '.join(cmd)}", cmd, process.returncode, False, attempt, message
+    )
+
+
 def file_open(filename, mode="r"):
-    """ Open a file, and if you add bz2 to filename a compressed file will be opened
+    """ Open a file, files with the extension .bz2 or .gz are opened as compressed files
     """
-    if "bz2" in filename:
+    if str(filename).endswith(".bz2"):
         return bz2.open(filename, mode + "t")
-    if "gz" in filename:
+    if str(filename).endswith(".gz"):
         return gzip.open(filename, mode + "t")
     return open(filename, mode)
 
 
-def ffprobe(filename):
-    """ run ffprobe to get some information of a given video file
+PROBE_CACHE_FILENAME = "ffprobe_cache.sqlite"
+
+
+def file_identity(filename):
+    """ identity of a file as (realpath, size, mtime_ns, inode), it changes whenever the file is modified or replaced
+    """
+    stat = os.stat(filename)
+    return (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+class ProbeCache:
+    """ persistent cache of parsed ffprobe results stored in a sqlite database,
+    entries are keyed by the file identity, expire after max_age seconds and
+    the least recently used entries are evicted if more than max_entries are stored;
+    every access opens its own connection, so the cache can be used from several processes
+    """
+
+    def __init__(self, filename, max_entries=100000, max_age=30 * 24 * 3600):
+        self._filename = filename
+        self._max_entries = max_entries
+        self._max_age = max_age
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with self._connect() as db:
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS probes (
+                    path TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER,
+                    result TEXT, created REAL, accessed REAL,
+                    PRIMARY KEY (path, size, mtime_ns, inode)
+                )"""
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS probes_accessed ON probes (accessed)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self._filename, timeout=60)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def get(self, filename):
+        key = file_identity(filename)
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT result FROM probes WHERE path=? AND size=? AND mtime_ns=? AND inode=? AND created>=?",
+                key + (now - self._max_age,),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE probes SET accessed=? WHERE path=? AND size=? AND mtime_ns=? AND inode=?", (now,) + key)
+        return json.loads(row[0])
+
+    def put(self, filename, result):
+        key = file_identity(filename)
+        now = time.time()
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?)", key + (json.dumps(result), now, now))
+            db.execute("DELETE FROM probes WHERE created<?", (now - self._max_age,))
+            db.execute(
+                "DELETE FROM probes WHERE rowid IN (SELECT rowid FROM probes ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self._max_entries,),
+            )
+
+    def __len__(self):
+        with self._connect() as db:
+            return db.execute("SELECT COUNT(*) FROM probes").fetchone()[0]
+
+
+def file_fingerprint(filename, blocks=16, block_size=64 * 1024):
+    """ fast content fingerprint of a file: its size and a hash of evenly spaced sampled blocks (the full file if it is small)
+    """
+    size = os.path.getsize(filename)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        if size <= blocks * block_size:
+            digest.update(f.read())
+        else:
+            for i in range(blocks):
+                f.seek(i * (size - block_size) // (blocks - 1))
+                digest.update(f.read(block_size))
+    return f"{size}_{digest.hexdigest()}"
+
+
+def _flatten(values, prefix=""):
+    flat = {}
+    for k, v in values.items():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, prefix + k + "/"))
+        else:
+            flat[prefix + k] = np.asarray(v)
+    return flat
+
+
+def _unflatten(flat):
+    values = {}
+    for k in flat.files:
+        *parents, name = k.split("/")
+        target = values
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[name] = flat[k].item() if flat[k].ndim == 0 else flat[k]
+    return values
+
+
+class FeatureCache:
+    """ content-addressed cache of extracted features, entries are keyed by the file fingerprint and the feature version,
+    so renamed or copied videos are found and features of other versions are never used;
+    each entry is a pickle-free .npz file with one array per (nested) value, written atomically,
+    the least recently used entries are removed if the cache grows above max_size bytes,
+    partial files older than part_max_age seconds (e.g. of killed workers) are removed as well;
+    the size of a folder is tracked per process, the folder is only scanned if the tracked size passes max_size
+    or after evict_interval puts (to account for other processes that write to the same folder)
     """
+
+    # tracked size and puts since the last scan of each cache folder, shared by all instances of a process
+    _folders = {}
+    _lock = threading.Lock()
+
+    def __init__(self, folder, version, max_size=1024 ** 3, part_max_age=3600, evict_interval=1000):
+        self._folder = folder
+        self._version = version
+        self._max_size = max_size
+        self._part_max_age = part_max_age
+        self._evict_interval = evict_interval
+
+    def filename(self, videofilename):
+        return os.path.join(self._folder, f"{self._version}_{file_fingerprint(videofilename)}.npz")
+
+    def get(self, videofilename):
+        filename = self.filename(videofilename)
+        try:
+            with np.load(filename, allow_pickle=False) as entry:
+                values = _unflatten(entry)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # a corrupt entry is a cache miss and is replaced by the next put
+            logging.warning(f"feature cache entry {filename} is corrupt, it will be removed")
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            return None
+        try:
+            # the modification time is used as last access time for the eviction
+            os.utime(filename)
+        except OSError:
+            pass
+        return values
+
+    def put(self, videofilename, values):
+        filename = self.filename(videofilename)
+        os.makedirs(self._folder, exist_ok=True)
+        # unique partial file, entries of the same content may be written by several threads at the same time
+        fd, part = tempfile.mkstemp(dir=self._folder, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as entry:
+                np.savez(entry, **_flatten(values))
+            size = os.path.getsize(part)
+            os.replace(part, filename)
+        except BaseException:
+            if os.path.isfile(part):
+                os.remove(part)
+            raise
+
+        key = os.path.realpath(self._folder)
+        with FeatureCache._lock:
+            tracked = FeatureCache._folders.get(key)
+            if tracked is not None:
+                tracked[0] += size
+                tracked[1] += 1
+        if tracked is None or tracked[0] > self._max_size or tracked[1] >= self._evict_interval:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        parts = 0
+        now = time.time()
+        for f in os.listdir(self._folder):
+            try:
+                stat = os.stat(os.path.join(self._folder, f))
+            except OSError:
+                continue
+            if f.endswith(".npz"):
+                entries.append((stat.st_mtime, stat.st_size, f))
+            elif f.endswith(".part") and now - stat.st_mtime > self._part_max_age:
+                # left behind by a killed worker
+                try:
+                    os.remove(os.path.join(self._folder, f))
+                except OSError:
+                    pass
+            elif f.endswith(".part"):
+                # still being written, counted but never removed
+                parts += stat.st_size
+        total = parts + sum(size for _, size, _ in entries)
+        if total > self._max_size:
+            # entries are removed down to 90% of max_size, so that the next puts do not scan the folder again
+            for _, size, f in sorted(entries):
+                if total <= 0.9 * self._max_size:
+                    break
+                try:
+                    os.remove(os.path.join(self._folder, f))
+                except OSError:
+                    pass
+                total -= size
+        with FeatureCache._lock:
+            FeatureCache._folders[os.path.realpath(self._folder)] = [total, 0]
+
+
+# number of external programs that a ProbeScheduler runs at the same time by default
+DEFAULT_PROBE_CONCURRENCY = 64
+
+
+class ProbeScheduler:
+    """
+    asyncio engine for external programs (e.g. ffprobe) that are started with asyncio.create_subprocess_exec,
+    at most concurrency programs run at the same time, timeouts, retries and errors are handled as by run
+    """
+
+    _default = weakref.WeakKeyDictionary()
+
+    def __init__(self, concurrency=DEFAULT_PROBE_CONCURRENCY):
+        self._concurrency = concurrency
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def default(cls):
+        """ scheduler that is shared by all calls in the running event loop """
+        loop = asyncio.get_running_loop()
+        if loop not in cls._default:
+            cls._default[loop] = cls()
+        return cls._default[loop]
+
+    def _semaphore(self):
+        # created in the running loop, before python 3.10 a semaphore is bound to the loop it was created in
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self._concurrency)
+        return self._semaphores[loop]
+
+    async def _read(self, process, parser, batch_size=4096):
+        if parser is None:
+            output = (await process.stdout.read()).decode(errors="replace")
+            await process.wait()
+            return output
+        lines = []
+        async for line in process.stdout:
+            lines.append(line.decode(errors="replace"))
+            if len(lines) >= batch_size:
+                parser.feed(lines)
+                lines = []
+        parser.feed(lines)
+        await process.wait()
+        return parser.result()
+
+    async def run(self, cmd, timeout=None, retries=PROCESS_RETRIES, parser=None, exception=ProcessError):
+        """
+        asyncio version of run
+        @param parser: factory of an incremental parser with feed(lines) and result(),
+            the stdout lines are fed in batches while the program runs
+        @return stdout of the program or the result of the parser
+        """
+        async with self._semaphore():
+            for attempt in range(1, retries + 2):
+                try:
+                    process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+                except OSError as e:
+                    raise exception(f"{cmd[0]} could not be started: {e}", cmd, attempts=attempt)
+                stderr = asyncio.ensure_future(process.stderr.read())
+                timed_out = False
+                try:
+                    result = await asyncio.wait_for(self._read(process, parser() if parser is not None else None), timeout)
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    process.kill()
+                except BaseException:
+                    # e.g. cancelled by the caller
+                    process.kill()
+                    await process.wait()
+                    stderr.cancel()
+                    raise
+                await process.wait()
+                message = (await stderr).decode(errors="replace")[-2000:]
+                if process.returncode == 0 and not timed_out:
+                    return result
+                if timed_out:
+                    raise exception(
+                        f"{cmd[0]} timed out after {timeout:.1f}s: {' '.join(cmd)}", cmd, process.returncode, True, attempt, message
+                    )
+                logging.warning(f"{cmd[0]} failed with return code {process.returncode} (attempt {attempt}): {message.strip()}")
+        raise exception(
+            f"{cmd[0]} failed with return code {process.returncode}: {' '.join(cmd)}", cmd, process.returncode, False, attempt, message
+        )
+
+
+def ffprobe(filename, cache_folder=None):
+    """ run ffprobe to get some information of a given video file,
+    if cache_folder is specified, results are cached persistently (see ProbeCache)
+    """
+    cache, needed = _ffprobe_cached(filename, cache_folder)
+    if needed is not None:
+        return needed
+    res = run(_ffprobe_cmd(filename), stage_timeout("probe", filename), exception=ProbeError)
+    return _ffprobe_store(filename, cache, res)
+
+
+async def ffprobe_async(filename, cache_folder=None, scheduler=None):
+    """ asyncio version of ffprobe, ffprobe is run by scheduler (ProbeScheduler.default() if None)
+    """
+    cache, needed = _ffprobe_cached(filename, cache_folder)
+    if needed is not None:
+        return needed
+    scheduler = scheduler or ProbeScheduler.default()
+    res = await scheduler.run(_ffprobe_cmd(filename), stage_timeout("probe", filename), exception=ProbeError)
+    return _ffprobe_store(filename, cache, res)
+
+
+def _ffprobe_cached(filename, cache_folder):
     if shutil.which("ffprobe") is None:
-        raise Exception("you need to have ffprobe installed, please read README.md.")
+        raise ProbeError("you need to have ffprobe installed, please read README.md.")
 
     if not os.path.isfile(filename):
-        raise Exception("{} is not a valid file".format(filename))
+        raise InvalidInputError("{} is not a valid file".format(filename))
+
+    cache = ProbeCache(os.path.join(cache_folder, PROBE_CACHE_FILENAME)) if cache_folder else None
+    needed = cache.get(filename) if cache is not None else None
+    if needed is not None:
+        logging.debug(f"use cached ffprobe result for {filename}")
+    return cache, needed
+
+
+def _ffprobe_cmd(filename):
+    return ["ffprobe", "-show_format", "-select_streams", "v:0", "-show_streams", "-of", "json", filename]
 
-    cmd = "ffprobe -show_format -select_streams v:0 -show_streams -of json '{filename}' 2>/dev/null".format(
-        filename=filename
-    )
 
-    res = shell_call(cmd).strip()
+def _ffprobe_store(filename, cache, res):
+    if len(res.strip()) == 0:
+        raise ProbeError("{} is somehow not valid, so ffprobe could not extract anything".format(filename))
 
-    if len(res) == 0:
-        raise Exception("{} is somehow not valid, so ffprobe could not extract anything".format(filename))
+    needed = parse_ffprobe_result(json.loads(res))
+    if cache is not None:
+        cache.put(filename, needed)
+    return needed
 
-    res = json.loads(res)
 
+def parse_ffprobe_result(res):
+    """ extract the needed stream and format information of a parsed ffprobe json result
+    """
     needed = {
         "pix_fmt": "unknown",
         "bits_per_raw_sample": "unknown",
@@ -116,3 +565,125 @@ def json_store(outputfile, jsonobject):
 def json_load(jsonfile):
     with open(jsonfile) as jfp:
         return json.load(jfp)
+
+
+def stream_reports(results, result_folder):
+    """
+    print results as one json list and store each result as `<result_folder>/<video_basename>.json`
+    as soon as it is available, results without video_basename (e.g. not processed videos) are only printed
+    @param results: iterable of results, e.g. a generator in completion order
+    @return number of stored reports
+    """
+    os.makedirs(result_folder, exist_ok=True)
+    stored = 0
+    print("[", flush=True)
+    try:
+        for i, result in enumerate(results):
+            print(("," if i > 0 else "") + json.dumps(result, indent=4, sort_keys=True), flush=True)
+            if result == {} or "video_basename" not in result:
+                continue
+            reportname = os.path.join(result_folder, os.path.splitext(result["video_basename"])[0] + ".json")
+            json_store(reportname, result)
+            stored += 1
+    finally:
+        print("]", flush=True)
+    return stored
+
+
+JOURNAL_FILENAME = "journal.ndjson"
+
+
+class Journal:
+    """
+    append-only journal of a batch run in the result folder, one json line per processed input
+    with its identity (see file_identity), the run settings and the outcome (ok, failed or unsupported);
+    a restarted run skips all inputs that are recorded for the same settings and did not change since
+    """
+
+    def __init__(self, folder, settings):
+        os.makedirs(folder, exist_ok=True)
+        self._filename = os.path.join(folder, JOURNAL_FILENAME)
+        # settings are compared as they are stored
+        self._settings = json.loads(json.dumps(settings))
+        self._recorded = {}
+        self._identities = {}
+        if not os.path.isfile(self._filename):
+            return
+        with open(self._filename) as journal:
+            content = journal.read()
+        for line in content.splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # incomplete line of an interrupted run
+                continue
+            if entry.get("settings") == self._settings:
+                self._recorded[entry["video"]] = (entry["identity"], entry["status"])
+        if content != "" and not content.endswith("\n"):
+            with open(self._filename, "a") as journal:
+                journal.write("\n")
+
+    def status(self, videofilename):
+        """ recorded status of an unchanged input, None if it has to be processed """
+        try:
+            identity = list(file_identity(videofilename))
+        except OSError:
+            return None
+        recorded = self._recorded.get(identity[0])
+        if recorded is None or recorded[0] != identity:
+            return None
+        return recorded[1]
+
+    def pending(self, videofilenames, skip_processed=True):
+        """ all inputs that are not yet processed (or all if skip_processed is False), their identities are kept for the journal entries """
+        pending = []
+        for videofilename in videofilenames:
+            status = self.status(videofilename) if skip_processed else None
+            if status is not None:
+                logging.info(f"{videofilename} is already processed ({status}), it will be skipped")
+                continue
+            try:
+                self._identities[videofilename] = list(file_identity(videofilename))
+            except OSError:
+                self._identities[videofilename] = None
+            pending.append(videofilename)
+        return pending
+
+    def record(self, videofilename, status, message=None):
+        identity = self._identities.get(videofilename)
+        entry = {
+            "video": identity[0] if identity else os.path.realpath(videofilename),
+            "identity": identity,
+            "settings": self._settings,
+            "status": status,
+            "message": message,
+            "date": str(datetime.datetime.now()),
+        }
+        with open(self._filename, "a") as journal:
+            journal.write(json.dumps(entry, sort_keys=True) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def track(self, results):
+        """
+        pass on each result of a generator, e.g. iter_predict, and record its outcome once the consumer
+        (e.g. stream_reports) asks for the next result, i.e. after it has stored the report;
+        consecutive results of one input with several variants (e.g. a manifest) are recorded once after the last one
+        """
+        # input of the variants passed on so far, as (video, status, message)
+        variants = None
+        for result in results:
+            video = result.get("video_full_path")
+            if variants is not None and variants[0] != video:
+                self.record(*variants)
+                variants = None
+            yield result
+            if video not in self._identities:
+                continue
+            status = "ok" if "per_sequence" in result else result.get("status", "failed")
+            if "variant" in result:
+                variants = (video, status, result.get("error")) if variants is None or status != "ok" else variants
+            else:
+                self.record(video, status, result.get("error"))
+        if variants is not None:
+            self.record(*variants)
@@ -0,0 +1,47 @@
+import numpy as np
+
+from bitstream_mode0.modelutils import *
+
+
+def test_r_from_mos_table_values():
+    assert np.array_equal(r_from_mos(np.array(R_FROM_MOS_KEYS)), R_FROM_MOS_VALUES)
+    assert r_from_mos(0.5) == 0
+    assert r_from_mos(5.5) == 100
+
+
+def test_scalar_and_array_results_are_identical():
+    x = np.random.default_rng(42).uniform(-10, 110, 1000)
+    for f in [mos_from_r, r_from_mos, map_to_5, map_to_45]:
+        assert np.array_equal(f(x), [f(float(v)) for v in x])
+
+
+def test_mos_from_r_scalar_reference():
+    for q in [-1, 0, 12.5, 60, 99.9, 100, 120]:
+        if q <= 0:
+            expected = MOS_MIN
+        elif q >= 100:
+            expected = MOS_MAX
+        else:
+            expected = MOS_MIN + float(MOS_MAX - MOS_MIN) * float(q) / 100.0 + float(q) * float(q - 60.0) * float(100.0 - q) * 0.000007
+        assert mos_from_r(q) == expected
+    assert map_to_5(4.6) == 5 and map_to_45(5.2) == 4.5
+
+
+def test_model_registry_reloads_changed_configs(tmp_path):
+    from bitstream_mode0.generic import DEFAULT_MODEL
+    from bitstream_mode0.utils import json_load
+    from bitstream_mode0.utils import json_store
+
+    config = json_load(DEFAULT_MODEL)
+    filename = str(tmp_path / "config.json")
+    json_store(filename, config)
+    registry = ModelRegistry()
+    coefficients = registry.coefficients(filename)
+    assert registry.coefficients(filename) is coefficients
+
+    config[DEVICE_CLASSES[0]]["params"]["upscaling_x"] += 1
+    json_store(filename, config)
+    os.utime(filename, ns=(0, 0))
+    changed = registry.coefficients(filename)
+    assert changed is not coefficients and changed.degradation[0, 0] == coefficients.degradation[0, 0] + 1
+    assert registry.model(dict) is registry.model(dict)
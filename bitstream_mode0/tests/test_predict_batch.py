@@ -0,0 +1,162 @@
+import numpy as np
+import pandas as pd
+
+from bitstream_mode0 import predict_batch
+from bitstream_mode0.model import BitstreamMode0
+from bitstream_mode0.modelutils import load_coefficients
+from bitstream_mode0.generic import DEFAULT_MODEL
+
+CODECS = ["h264", "hevc", "vp9", "h264"]
+BITRATES = [3000.0, 1500.0, 8000.0, 200.0]
+RESOLUTIONS = [1920 * 1080, 1280 * 720, 3840 * 2160, 640 * 360]
+FRAMERATES = [30.0, 60.0, 24.0, 15.0]
+
+
+def test_predict_batch_reference_values():
+    res = predict_batch(CODECS, BITRATES, RESOLUTIONS, FRAMERATES, device_type="pc")
+    np.testing.assert_allclose(
+        res["final_pred"], [3.695627929611922, 3.029107391533416, 4.274430250374373, 1.7409895313959736], rtol=1e-12
+    )
+    np.testing.assert_allclose(res["upscaling_deg"], [6.3635284487477355, 16.76711437863026, 0.0, 34.552161996309565], rtol=1e-12)
+    np.testing.assert_allclose(res["temporal_deg"], [0.0, 0.0, 0.0, 2.5981739609084173], rtol=1e-12)
+
+
+def test_predict_batch_matches_single_video_path():
+    coefficients = load_coefficients(DEFAULT_MODEL)
+    device_types = ["pc", "tv", "tablet", "mobile"]
+    res = predict_batch(CODECS, BITRATES, RESOLUTIONS, FRAMERATES, device_type=device_types)
+    for i, device_type in enumerate(device_types):
+        features = pd.DataFrame(
+            [{"Codec": CODECS[i], "Bitrate": BITRATES[i], "Resolution": RESOLUTIONS[i], "Framerate": FRAMERATES[i]}]
+        )
+        single = BitstreamMode0()._calculate(features, coefficients, 3840 * 2160, device_type)
+        for k in ["final_pred", "coding_deg", "upscaling_deg", "temporal_deg"]:
+            assert res[k][i] == single[k][0]
+
+
+def test_compiled_coefficients_are_read_only():
+    coefficients = load_coefficients(DEFAULT_MODEL)
+    assert coefficients.predqp.shape == (2, 3, 4)
+    assert not coefficients.predqp.flags.writeable
+    assert not coefficients.mos_q.flags.writeable
+
+
+def test_lookup_table_close_to_exact_path(tmp_path):
+    from bitstream_mode0.lookup import QualityLookup
+
+    axes = {"bitrate": (100, 50000, 64), "resolution": (640 * 360, 3840 * 2160, 32), "framerate": (15, 60, 16)}
+    QualityLookup.build(axes=axes, validation_samples=1000).save(str(tmp_path / "table"))
+    lookup = QualityLookup.load(str(tmp_path / "table.npy"))
+    assert lookup.header["max_abs_error"] < 0.1
+
+    exact = predict_batch(CODECS, BITRATES, RESOLUTIONS, FRAMERATES, device_type="mobile")
+    np.testing.assert_allclose(lookup.predict(CODECS, BITRATES, RESOLUTIONS, FRAMERATES, "mobile"), exact["final_pred"], atol=0.1)
+
+
+def test_ladder_pareto_front_and_convex_hull():
+    from bitstream_mode0.ladder import evaluate_ladders, pareto_front, convex_hull
+
+    rungs = [
+        {"codec": codec, "bitrate": bitrate, "width": width, "height": height, "fps": 30}
+        for codec in ["h264", "hevc"]
+        for bitrate in [300, 750, 1500, 3000, 6000]
+        for width, height in [(640, 360), (1280, 720), (1920, 1080)]
+    ]
+    scored = evaluate_ladders({"title": rungs}, device_types=["pc", "mobile"])
+    assert len(scored) == 2 * len(rungs)
+
+    front = pareto_front(scored)
+    hull = convex_hull(scored)
+    for _, group in front.groupby(["codec", "device_type"]):
+        assert np.all(np.diff(group["bitrate"].values) > 0)
+        assert np.all(np.diff(group["final_pred"].values) > 0)
+    assert set(map(tuple, hull[["codec", "device_type", "bitrate"]].values)) <= set(
+        map(tuple, front[["codec", "device_type", "bitrate"]].values)
+    )
+
+
+def test_required_bitrate_inverts_predict_batch():
+    from bitstream_mode0 import required_bitrate
+
+    targets = np.array([2.0, 3.0, 3.5, 4.0, 4.9])
+    bitrate = required_bitrate(targets, "hevc", 1920 * 1080, 30, device_type="pc")
+    assert np.isnan(bitrate[-1])
+
+    reached = predict_batch("hevc", bitrate[:-1], 1920 * 1080, 30)["final_pred"]
+    below = predict_batch("hevc", bitrate[:-1] * 0.999, 1920 * 1080, 30)["final_pred"]
+    assert np.all(reached >= targets[:-1])
+    assert np.all(below < targets[:-1])
+
+    # the search interval is passed through, targets above the upper end of it are not reachable
+    limited = required_bitrate(targets[:-1], "hevc", 1920 * 1080, 30, bitrate_range=(10, bitrate[1]), iterations=60)
+    assert np.allclose(limited[:2], bitrate[:2]) and np.all(np.isnan(limited[2:]))
+
+
+M3U8 = """#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=3200000,AVERAGE-BANDWIDTH=3072000,RESOLUTION=1920x1080,FRAME-RATE=29.970,CODECS="avc1.640028,mp4a.40.2"
+1080p/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=1536000,RESOLUTION=1280x720,FRAME-RATE=60.000,CODECS="hvc1.1.6.L93.B0"
+720p/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=128000,CODECS="mp4a.40.2"
+audio/index.m3u8
+#EXT-X-STREAM-INF:RESOLUTION=640x360,CODECS="avc1.64001e"
+360p/index.m3u8
+"""
+
+MPD = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011">
+  <Period>
+    <AdaptationSet contentType="video" codecs="vp09.00.40.08" frameRate="24">
+      <Representation id="2160p" bandwidth="8192000" width="3840" height="2160"/>
+      <Representation id="1080p" bandwidth="3072000" width="1920" height="1080" frameRate="30000/1001"/>
+      <Representation id="360p" width="640" height="360"/>
+    </AdaptationSet>
+    <AdaptationSet contentType="audio" mimeType="audio/mp4">
+      <Representation id="audio" bandwidth="128000" codecs="mp4a.40.2"/>
+    </AdaptationSet>
+  </Period>
+</MPD>
+"""
+
+
+def test_predict_manifests(tmp_path):
+    from bitstream_mode0 import predict_manifests
+
+    (tmp_path / "master.m3u8").write_text(M3U8)
+    (tmp_path / "stream.mpd").write_text(MPD)
+    results = predict_manifests([str(tmp_path / "master.m3u8"), str(tmp_path / "stream.mpd")])
+
+    variants = [r["variant"] for r in results]
+    assert [(v["codec"], v["bitrate"], v["width"], v["fps"]) for v in variants] == [
+        ("h264", 3000.0, 1920, 30.0),
+        ("hevc", 1500.0, 1280, 60.0),
+        ("vp9", 8000.0, 3840, 24.0),
+        ("vp9", 3000.0, 1920, 30.0),
+    ]
+    expected = predict_batch(["h264", "hevc", "vp9"], [3000.0, 1500.0, 8000.0], RESOLUTIONS[:3], FRAMERATES[:3])
+    assert [r["per_sequence"] for r in results[:3]] == list(expected["final_pred"])
+    assert len(set(r["video_basename"] for r in results)) == len(results)
+
+
+def test_invalid_manifests_are_isolated(tmp_path, monkeypatch):
+    from bitstream_mode0 import _predict_manifests
+    from bitstream_mode0.generic import DEFAULT_MODEL
+
+    batches = []
+    predict = BitstreamMode0.predict_batch
+
+    def counted_predict_batch(self, codec, *args):
+        batches.append(len(codec))
+        return predict(self, codec, *args)
+
+    monkeypatch.setattr(BitstreamMode0, "predict_batch", counted_predict_batch)
+    (tmp_path / "master.m3u8").write_text(M3U8)
+    (tmp_path / "stream.mpd").write_text(MPD)
+    (tmp_path / "broken.mpd").write_text("<MPD")
+    manifests = [str(tmp_path / "missing.m3u8"), str(tmp_path / "master.m3u8"), str(tmp_path / "broken.mpd"), str(tmp_path / "stream.mpd")]
+    results = list(_predict_manifests(manifests, DEFAULT_MODEL, "pc", "3840x2160", "1.5xH", 55))
+    assert [(r["video_full_path"], r.get("status")) for r in results[:2]] == [(manifests[0], "failed"), (manifests[2], "failed")]
+    assert results[0]["error_type"] == "InvalidInputError"
+    assert [r["variant"]["codec"] for r in results[2:]] == ["h264", "hevc", "vp9", "vp9"]
+    # the variants of all valid manifests are scored in one batch
+    assert batches == [4]
@@ -0,0 +1,234 @@
+import os
+import itertools
+import json
+import time
+
+from bitstream_mode0.utils import *
+
+
+def test_probe_cache_is_keyed_by_file_identity(tmp_path):
+    video = tmp_path / "video.mkv"
+    video.write_bytes(b"0" * 10)
+    cache = ProbeCache(str(tmp_path / "cache" / PROBE_CACHE_FILENAME))
+    assert cache.get(str(video)) is None
+
+    cache.put(str(video), {"codec": "h264", "fps": 30.0})
+    assert cache.get(str(video)) == {"codec": "h264", "fps": 30.0}
+    # a second instance shares the database
+    assert ProbeCache(str(tmp_path / "cache" / PROBE_CACHE_FILENAME)).get(str(video)) == {"codec": "h264", "fps": 30.0}
+
+    video.write_bytes(b"0" * 20)
+    assert cache.get(str(video)) is None
+
+
+def test_probe_cache_eviction(tmp_path):
+    cache = ProbeCache(str(tmp_path / PROBE_CACHE_FILENAME), max_entries=2)
+    videos = []
+    for i in range(3):
+        videos.append(str(tmp_path / f"video_{i}.mkv"))
+        with open(videos[-1], "w") as f:
+            f.write(str(i))
+        cache.put(videos[-1], {"i": i})
+        time.sleep(0.01)
+    assert len(cache) == 2
+    assert cache.get(videos[0]) is None
+
+    expired = ProbeCache(str(tmp_path / PROBE_CACHE_FILENAME), max_age=0)
+    assert expired.get(videos[2]) is None
+
+
+def test_feature_cache_is_keyed_by_content_and_version(tmp_path):
+    videos = [tmp_path / "a" / "video.mkv", tmp_path / "b" / "video.mkv"]
+    for i, video in enumerate(videos):
+        video.parent.mkdir()
+        video.write_bytes(str(i).encode() * 10)
+    cache = FeatureCache(str(tmp_path / "features"), "mode0_1")
+    cache.put(str(videos[0]), {"features": {"Codec": "h264", "Bitrate": 1000.0}, "ffprobe_result": {"fps": 30}})
+
+    assert cache.get(str(videos[0])) == {"features": {"Codec": "h264", "Bitrate": 1000.0}, "ffprobe_result": {"fps": 30}}
+    # same basename with a different content and other feature versions are not used
+    assert cache.get(str(videos[1])) is None
+    assert FeatureCache(str(tmp_path / "features"), "mode0_2").get(str(videos[0])) is None
+
+
+def test_feature_cache_removes_corrupt_entries_and_stale_parts(tmp_path):
+    video = tmp_path / "video.mkv"
+    video.write_bytes(b"0" * 10)
+    cache = FeatureCache(str(tmp_path / "features"), "mode0_1", max_size=1)
+    cache.put(str(video), {"features": {"Bitrate": 1000.0}})
+
+    # a truncated entry is a cache miss and is removed
+    with open(cache.filename(str(video)), "wb") as entry:
+        entry.write(b"PK\x03\x04")
+    assert cache.get(str(video)) is None
+    assert not os.path.exists(cache.filename(str(video)))
+
+    # partial files of killed workers are removed once they are old enough, fresh ones are kept
+    stale, fresh = tmp_path / "features" / "stale.npz.1.part", tmp_path / "features" / "fresh.npz.2.part"
+    stale.write_bytes(b"0" * 100)
+    fresh.write_bytes(b"0" * 100)
+    os.utime(stale, (time.time() - 7200, time.time() - 7200))
+    cache.evict()
+    assert not stale.exists() and fresh.exists()
+
+
+def test_stream_reports(tmp_path, capsys):
+    results = ({"video_basename": f"video_{i}.mkv", "per_sequence": i} for i in range(3))
+    assert stream_reports(itertools.chain(results, [{}]), str(tmp_path / "reports")) == 3
+    assert json.loads(capsys.readouterr().out)[1] == {"video_basename": "video_1.mkv", "per_sequence": 1}
+    assert json_load(str(tmp_path / "reports" / "video_2.json"))["per_sequence"] == 2
+
+
+def test_journal_skips_processed_and_unchanged_inputs(tmp_path):
+    videos = [str(tmp_path / f"video_{i}.mkv") for i in range(3)]
+    for video in videos:
+        with open(video, "w") as f:
+            f.write(video)
+    journal = Journal(str(tmp_path / "reports"), {"device_type": "pc"})
+    assert journal.pending(videos) == videos
+    results = [{"video_full_path": videos[0], "per_sequence": 3.0}, {"video_full_path": videos[1], "error": "failed"}]
+    assert list(journal.track(results)) == results
+    # an interrupted run may leave an incomplete line
+    with open(str(tmp_path / "reports" / JOURNAL_FILENAME), "a") as f:
+        f.write('{"video": ')
+
+    restarted = Journal(str(tmp_path / "reports"), {"device_type": "pc"})
+    assert restarted.status(videos[0]) == "ok" and restarted.status(videos[1]) == "failed"
+    assert restarted.pending(videos) == videos[2:]
+    assert restarted.pending(videos, skip_processed=False) == videos
+    assert Journal(str(tmp_path / "reports"), {"device_type": "tv"}).pending(videos) == videos
+    with open(videos[0], "a") as f:
+        f.write("changed")
+    assert Journal(str(tmp_path / "reports"), {"device_type": "pc"}).pending(videos) == [videos[0], videos[2]]
+
+
+def test_journal_records_only_stored_reports(tmp_path, monkeypatch, capsys):
+    import sys
+    import pytest
+
+    videos = [str(tmp_path / f"video_{i}.mkv") for i in range(2)]
+    manifest = str(tmp_path / "master.m3u8")
+    for video in videos + [manifest]:
+        with open(video, "w") as f:
+            f.write(video)
+    journal = Journal(str(tmp_path / "reports"), {"device_type": "pc"})
+    assert journal.pending(videos + [manifest]) == videos + [manifest]
+
+    # the report of the first video can not be stored, e.g. the process is killed in between
+    utils_module = sys.modules[Journal.__module__]
+    monkeypatch.setattr(utils_module, "json_store", lambda *_: (_ for _ in ()).throw(OSError("disk full")))
+    with pytest.raises(OSError):
+        stream_reports(
+            journal.track([{"video_full_path": videos[0], "video_basename": "video_0", "per_sequence": 3.0}]), str(tmp_path / "reports")
+        )
+    assert Journal(str(tmp_path / "reports"), {"device_type": "pc"}).pending(videos) == videos
+    monkeypatch.undo()
+
+    # all variants of a manifest are recorded once after the last one is stored
+    results = [
+        {"video_full_path": manifest, "video_basename": "master_1080p", "variant": {"variant": "1080p"}, "per_sequence": 4.0},
+        {"video_full_path": manifest, "video_basename": "master_720p", "variant": {"variant": "720p"}, "per_sequence": 3.5},
+        {"video_full_path": videos[1], "video_basename": "video_1", "per_sequence": 3.0},
+    ]
+    assert stream_reports(journal.track(results), str(tmp_path / "reports")) == 3
+    with open(str(tmp_path / "reports" / JOURNAL_FILENAME)) as f:
+        assert [json.loads(line)["status"] for line in f] == ["ok", "ok"]
+    assert Journal(str(tmp_path / "reports"), {"device_type": "pc"}).pending(videos + [manifest]) == videos[:1]
+
+
+def test_typed_errors_and_error_records():
+    import pytest
+
+    with pytest.raises(InvalidInputError):
+        assert_msg(False, "invalid")
+    with pytest.raises(UnsupportedVideoError):
+        assert_msg(False, "unsupported", UnsupportedVideoError)
+    assert error_record("video.mkv", UnsupportedVideoError("av1"))["status"] == "unsupported"
+    assert error_record("video.mkv", ProbeError("no ffprobe"))["status"] == "failed"
+
+
+def test_run_kills_on_timeout_and_retries(tmp_path):
+    import sys
+    import pytest
+
+    assert run([sys.executable, "-c", "print('ok')"]) == "ok\n"
+    assert run([sys.executable, "-c", "print('a\\nb')"], parse=lambda lines: [line.strip() for line in lines]) == ["a", "b"]
+
+    start = time.monotonic()
+    with pytest.raises(ProbeError) as e:
+        run([sys.executable, "-c", "import time; time.sleep(10)"], timeout=0.5, exception=ProbeError)
+    assert e.value.timed_out and e.value.attempts == 1 and time.monotonic() - start < 5
+
+    with pytest.raises(ProcessError) as e:
+        run([sys.executable, "-c", "import sys; sys.exit('broken')"], retries=2)
+    assert e.value.returncode == 1 and e.value.attempts == 3 and "broken" in e.value.stderr
+    assert error_record("video.mkv", e.value)["error_details"]["returncode"] == 1
+
+
+def test_probe_scheduler_limits_concurrency_and_kills_on_timeout():
+    import asyncio
+    import sys
+    import pytest
+
+    async def probes():
+        scheduler = ProbeScheduler(concurrency=2)
+        assert ProbeScheduler.default() is ProbeScheduler.default()
+        start = time.monotonic()
+        cmd = [sys.executable, "-c", "import time; time.sleep(0.5); print('ok')"]
+        outputs = await asyncio.gather(*[scheduler.run(cmd) for _ in range(4)])
+        # 4 calls of 0.5s with 2 at a time take at least 2 rounds
+        assert outputs == ["ok\n"] * 4 and time.monotonic() - start >= 1.0
+
+        with pytest.raises(ProbeError) as e:
+            await scheduler.run([sys.executable, "-c", "import time; time.sleep(10)"], timeout=0.5, exception=ProbeError)
+        assert e.value.timed_out and e.value.attempts == 1
+
+        with pytest.raises(ProcessError) as e:
+            await scheduler.run([sys.executable, "-c", "import sys; sys.exit('broken')"], retries=1)
+        assert e.value.returncode == 1 and e.value.attempts == 2 and "broken" in e.value.stderr
+
+    asyncio.run(probes())
+
+    # a scheduler created outside of an event loop can be used in several loops
+    scheduler = ProbeScheduler(concurrency=1)
+
+    async def contended():
+        cmd = [sys.executable, "-c", "print('ok')"]
+        return await asyncio.wait_for(asyncio.gather(scheduler.run(cmd), scheduler.run(cmd)), 10)
+
+    for _ in range(2):
+        assert asyncio.run(contended()) == ["ok\n"] * 2
+
+
+def test_feature_cache_scans_only_above_max_size(tmp_path, monkeypatch):
+    import threading
+
+    scans = []
+    evict = FeatureCache.evict
+    monkeypatch.setattr(FeatureCache, "evict", lambda self: scans.append(1) or evict(self))
+    videos = []
+    for i in range(10):
+        videos.append(tmp_path / f"video_{i}.mkv")
+        videos[-1].write_bytes(str(i).encode() * 10)
+
+    cache = FeatureCache(str(tmp_path / "features"), "mode0_1")
+    for video in videos:
+        cache.put(str(video), {"features": {"Bitrate": 1000.0}})
+    # only the first put of the process scans the folder
+    assert len(scans) == 1
+
+    # a put that passes max_size scans and removes the least recently used entries
+    entry_size = os.path.getsize(cache.filename(str(videos[0])))
+    small = FeatureCache(str(tmp_path / "features"), "mode0_1", max_size=int(9.5 * entry_size))
+    small.put(str(videos[0]), {"features": {"Bitrate": 1000.0}})
+    # entries are removed down to 90% of max_size
+    assert len(scans) == 2 and len(os.listdir(tmp_path / "features")) == 8
+
+    # the same content can be written by several threads at the same time
+    threads = [threading.Thread(target=cache.put, args=(str(videos[1]), {"features": {"Bitrate": float(i)}})) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.get(str(videos[1]))["features"]["Bitrate"] in range(8)
+    assert not [f for f in os.listdir(tmp_path / "features") if f.endswith(".part")]
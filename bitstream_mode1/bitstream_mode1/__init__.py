@@ -6,9 +6,13 @@ import json
 import multiprocessing
 import logging
 import itertools
+import asyncio
 
 from bitstream_mode1.utils import *
 from bitstream_mode1.model import BitstreamMode1
+from bitstream_mode1.extract_video_frame_info import ffprobe_stream_and_frame_table_async
+from bitstream_mode1.modelutils import MODEL_REGISTRY
+from bitstream_mode1.modelutils import init_worker
 from bitstream_mode1.generic import *
 
 
@@ -20,9 +24,11 @@ def predict_quality(
     viewing_distance="1.5xH",
     display_size=55,
     temporary_folder="tmp",
-    cache_features=True
+    cache_features=True,
+    frame_info="frames",
+    store_frame_info=False,
 ):
-    return BitstreamMode1().predict_quality(
+    return MODEL_REGISTRY.model(BitstreamMode1).predict_quality(
         videofilename,
         model_config_filename,
         device_type,
@@ -30,10 +36,109 @@ def predict_quality(
         viewing_distance,
         display_size,
         temporary_folder,
-        cache_features
+        cache_features,
+        frame_info,
+        store_frame_info,
     )
 
 
+def _predict(params):
+    return MODEL_REGISTRY.model(BitstreamMode1)._predict_probed(*params)
+
+
+async def predict_quality_async(
+    videofilename,
+    model_config_filename,
+    device_type="pc",
+    device_resolution="3840x2160",
+    viewing_distance="1.5xH",
+    display_size=55,
+    temporary_folder="tmp",
+    cache_features=True,
+    frame_info="frames",
+    store_frame_info=False,
+    scheduler=None,
+    executor=None,
+):
+    """
+    asyncio version of predict_quality, ffprobe is run by scheduler (utils.ProbeScheduler.default() if None),
+    feature extraction and scoring run in executor, e.g. a small concurrent.futures.ProcessPoolExecutor
+    (the default executor of the event loop if None)
+    """
+    model = MODEL_REGISTRY.model(BitstreamMode1)
+    device_type = model._check_settings(
+        videofilename, model_config_filename, device_type, device_resolution, viewing_distance, display_size, frame_info
+    )
+    os.makedirs(temporary_folder, exist_ok=True)
+    loop = asyncio.get_running_loop()
+
+    feature_cache = model._feature_cache(temporary_folder, frame_info) if cache_features else None
+    cached = await loop.run_in_executor(None, feature_cache.get, videofilename) if feature_cache is not None else None
+    if cached is not None:
+        logging.info("features are already cached, extraction skipped")
+        params = (videofilename, model_config_filename, device_type, device_resolution, cached["ffprobe_result"], None, cached["features"])
+        return await loop.run_in_executor(executor, _predict, params)
+
+    ffprobe_result, frame_table = await ffprobe_stream_and_frame_table_async(
+        videofilename, frame_info, temporary_folder, temporary_folder if store_frame_info else None, scheduler
+    )
+    params = (videofilename, model_config_filename, device_type, device_resolution, ffprobe_result, frame_table, None, feature_cache)
+    return await loop.run_in_executor(executor, _predict, params)
+
+
+def _predict_quality(params):
+    # one video that can not be processed must not stop the whole batch
+    try:
+        return predict_quality(*params)
+    except ModelError as e:
+        logging.error(f"{params[0]} could not be processed: {e}")
+        return error_record(params[0], e)
+    except Exception as e:
+        logging.exception(f"{params[0]} could not be processed")
+        return error_record(params[0], e)
+
+
+def iter_predict(
+    videofilenames,
+    model_config_filename=DEFAULT_MODEL,
+    device_type="pc",
+    device_resolution="3840x2160",
+    viewing_distance="1.5xH",
+    display_size=55,
+    temporary_folder="tmp",
+    cache_features=True,
+    frame_info="frames",
+    store_frame_info=False,
+    cpu_count=multiprocessing.cpu_count(),
+):
+    """
+    predict the quality of many videos with cpu_count worker processes
+    @return generator of the results (see predict_quality) in completion order,
+        for videos that could not be processed an error record (see utils.error_record) is yielded
+    """
+    params = [
+        (
+            video,
+            model_config_filename,
+            device_type,
+            device_resolution,
+            viewing_distance,
+            display_size,
+            temporary_folder,
+            cache_features,
+            frame_info,
+            store_frame_info,
+        )
+        for video in videofilenames
+    ]
+    if cpu_count > 1 and len(params) > 1:
+        # each worker loads and compiles the model config once
+        with multiprocessing.Pool(min(cpu_count, len(params)), init_worker, (model_config_filename,)) as pool:
+            yield from pool.imap_unordered(_predict_quality, params)
+    else:
+        yield from map(_predict_quality, params)
+
+
 def main(_=[]):
     # argument parsing
     parser = argparse.ArgumentParser(
@@ -46,7 +151,7 @@ def main(_=[]):
     parser.add_argument(
         "--model",
         type=str,
-        default=os.path.join(os.path.dirname(__file__), "models/bitstream_mode1/config.json"),
+        default=DEFAULT_MODEL,
         help="model config file to be used for prediction",
     )
     parser.add_argument("--cpu_count", type=int, default=multiprocessing.cpu_count(), help="thread/cpu count")
@@ -72,39 +177,54 @@ def main(_=[]):
         default="./tmp",
         help="temporary folder to store bitstream stats and other intermediate results",
     )
+    parser.add_argument(
+        "--frame_info",
+        choices=FRAME_INFO_METHODS,
+        default="frames",
+        help="extract frame sizes and I frames from packet headers (fast) or from decoded frames",
+    )
+    parser.add_argument(
+        "--store_frame_info",
+        action="store_true",
+        help="store the extracted frame tables in binary form in the temporary folder and reuse them",
+    )
+    parser.add_argument(
+        "--no_feature_cache",
+        action="store_true",
+        help="do not read or store extracted features in the feature cache of the temporary folder",
+    )
+    parser.add_argument(
+        "--rerun",
+        action="store_true",
+        help="process all inputs again, also the ones that are already recorded in the journal of the result folder",
+    )
 
     a = vars(parser.parse_args())
     logging.basicConfig(level=logging.DEBUG)
 
     assert_file(a["model"], "model folder is not valid")
     logging.info(f"handle the following videos (# {len(a['video'])}): \n  " + "\n  ".join(a["video"]))
-    params = [
-        (
-            video,
-            a["model"],
-            a["device_type"],
-            a["device_resolution"],
-            a["viewing_distance"],
-            a["display_size"],
-            a["tmp"],
-        )
-        for video in a["video"]
-    ]
-    if a["cpu_count"] > 1:
-        pool = multiprocessing.Pool(a["cpu_count"])
-        results = pool.starmap(predict_quality, params)
-    else:
-        results = list(itertools.starmap(predict_quality, params))
-
-    print(json.dumps(results, indent=4, sort_keys=True))
+    # inputs that are already processed with the same settings and did not change since are skipped
+    settings = {k: a[k] for k in ["device_type", "device_resolution", "viewing_distance", "display_size", "frame_info"]}
+    settings["model"] = list(file_identity(a["model"]))
+    settings["version"] = __version__
+    journal = Journal(a["result_folder"], settings)
+    results = iter_predict(
+        journal.pending(a["video"], not a["rerun"]),
+        a["model"],
+        a["device_type"],
+        a["device_resolution"],
+        a["viewing_distance"],
+        a["display_size"],
+        a["tmp"],
+        not a["no_feature_cache"],
+        a["frame_info"],
+        a["store_frame_info"],
+        a["cpu_count"],
+    )
+    # results are printed and stored as soon as a video is processed
     logging.info(f"""store all results to {a["result_folder"]}""")
-    os.makedirs(a["result_folder"], exist_ok=True)
-    for result in results:
-        if result == {} or "video_basename" not in result:
-            # in case the video could not be processed, just ignore it
-            continue
-        reportname = os.path.join(a["result_folder"], os.path.splitext(result["video_basename"])[0] + ".json")
-        json_store(reportname, result)
+    stream_reports(journal.track(results), a["result_folder"])
 
 
 if __name__ == "__main__":
@@ -5,18 +5,31 @@ import logging
 import shutil
 import subprocess
 import json
+import array
 
-from bitstream_mode1.utils import shell_call
+import numpy as np
+
+from bitstream_mode1.utils import run
+from bitstream_mode1.utils import stage_timeout
+from bitstream_mode1.utils import InvalidInputError
+from bitstream_mode1.utils import ProbeError
+from bitstream_mode1.utils import parse_ffprobe_result
+from bitstream_mode1.utils import ProbeCache
+from bitstream_mode1.utils import ProbeScheduler
+from bitstream_mode1.utils import PROBE_CACHE_FILENAME
+from bitstream_mode1.generic import PACKET_KEYFRAME_CODECS
+from bitstream_mode1.frame_table import load_frame_table
+from bitstream_mode1.frame_table import save_frame_table
 
 
 def ffprobe_frame_info(video_segment_file, output_dir_full_path, skipexisting=True):  #(filename):
     """ run ffprobe to get some information of a given video file
     """
     if shutil.which("ffprobe") is None:
-        raise Exception("you need to have ffprobe installed, please read README.md.")
+        raise ProbeError("you need to have ffprobe installed, please read README.md.")
 
     if not os.path.isfile(video_segment_file):
-        raise Exception("{} is not a valid file".format(filename))
+        raise InvalidInputError("{} is not a valid file".format(video_segment_file))
 
     # ffprobe -loglevel error -select_streams v -show_frames -show_entries
     # frame=pkt_pts_time,pkt_dts_time,pkt_duration_time,pkt_size,pict_type -of json
@@ -30,14 +43,225 @@ def ffprobe_frame_info(video_segment_file, output_dir_full_path, skipexisting=Tr
     if skipexisting and os.path.isfile(report_file_name):
         return report_file_name
 
-    cmd = "ffprobe -loglevel error -select_streams v -show_frames -show_entries frame=pkt_pts_time,pkt_dts_time,pkt_duration_time,pkt_size,pict_type -of json '{filename}' >>{report_file_name}".format(
-        filename=video_segment_file, report_file_name=report_file_name
+    cmd = [
+        "ffprobe",
+        "-loglevel",
+        "error",
+        "-select_streams",
+        "v",
+        "-show_frames",
+        "-show_entries",
+        "frame=pkt_pts_time,pkt_dts_time,pkt_duration_time,pkt_size,pict_type",
+        "-of",
+        "json",
+        video_segment_file,
+    ]
+    res = run(cmd, stage_timeout("frames", video_segment_file), exception=ProbeError)
+
+    if res.strip() == "":
+        raise ProbeError("{} is somehow not valid, so ffprobe could not extract anything".format(video_segment_file))
+    # the report is written atomically, so that an interrupted run never leaves a partial report that is skipped later
+    with open(report_file_name + ".part", "w") as report:
+        report.write(res)
+    os.replace(report_file_name + ".part", report_file_name)
+    return report_file_name
+
+
+# entries of the stream and format sections that are needed for utils.parse_ffprobe_result
+STREAM_ENTRIES = "stream=codec_name,profile,pix_fmt,bits_per_raw_sample,width,height,avg_frame_rate:format=bit_rate,duration"
+# entries of the packet and frame sections, newer ffmpeg versions use pts_time/duration_time instead of pkt_pts_time/pkt_duration_time
+FRAME_INFO_ENTRIES = {
+    "packets": "packet=pts_time,dts_time,duration_time,size,flags",
+    "frames": "frame=pts_time,pkt_pts_time,pkt_dts_time,duration_time,pkt_duration_time,pkt_size,pict_type",
+}
+
+
+def _number(value, default, dtype=float):
+    if value is None or value == "N/A":
+        return default
+    return dtype(value)
+
+
+def _frame_table(size, pict_type, pts_time, dts_time, duration_time):
+    return {
+        "size": np.frombuffer(size, dtype=np.int64),
+        "pict_type": np.frombuffer(pict_type, dtype=np.uint8),
+        "pts_time": np.frombuffer(pts_time, dtype=np.float64),
+        "dts_time": np.frombuffer(dts_time, dtype=np.float64),
+        "duration_time": np.frombuffer(duration_time, dtype=np.float64),
+    }
+
+
+def iter_frame_info(lines, res, chunk_size=None):
+    """ parse the compact ffprobe output of ffprobe_stream_and_frame_table line by line
+    and yield frame tables of at most chunk_size frames (all frames if chunk_size is None),
+    stream and format information (as parsed by `ffprobe -of json`) is added to res
+    """
+    res.setdefault("streams", [])
+    res.setdefault("format", {})
+    columns = [array.array("q"), array.array("B"), array.array("d"), array.array("d"), array.array("d")]
+    size, pict_type, pts_time, dts_time, duration_time = columns
+    for line in lines:
+        section, *fields = line.rstrip("\n").split("|")
+        values = dict(field.split("=", 1) for field in fields if "=" in field)
+        if section == "packet":
+            size.append(_number(values.get("size"), 0, int))
+            pict_type.append(ord("I") if "K" in values.get("flags", "") else ord("?"))
+        elif section == "frame":
+            size.append(_number(values.get("pkt_size"), 0, int))
+            pict_type.append(ord(values.get("pict_type", "?")[:1] or "?"))
+        elif section == "stream":
+            for k in ["width", "height"]:
+                if k in values:
+                    values[k] = _number(values[k], "unknown", int)
+            res["streams"].append(values)
+            continue
+        elif section == "format":
+            res["format"] = values
+            continue
+        else:
+            continue
+        pts_time.append(_number(values.get("pts_time", values.get("pkt_pts_time")), np.nan))
+        dts_time.append(_number(values.get("dts_time", values.get("pkt_dts_time")), np.nan))
+        duration_time.append(_number(values.get("duration_time", values.get("pkt_duration_time")), np.nan))
+        if chunk_size is not None and len(size) >= chunk_size:
+            yield _frame_table(*columns)
+            columns = [array.array(column.typecode) for column in columns]
+            size, pict_type, pts_time, dts_time, duration_time = columns
+    if chunk_size is None or len(size) > 0:
+        yield _frame_table(*columns)
+
+
+def parse_frame_info(lines):
+    """ parse the compact ffprobe output of ffprobe_stream_and_frame_table line by line,
+    only the typed columns of the frame table grow with the number of frames
+    @return (stream and format information as parsed by `ffprobe -of json`, frame table)
+    """
+    res = {}
+    frame_table = next(iter_frame_info(lines, res))
+    return res, frame_table
+
+
+def ffprobe_stream_and_frame_table(video_segment_file, method="frames", cache_folder=None, frame_info_folder=None):
+    """ run one ffprobe call to get the stream/format information (see utils.ffprobe)
+    and the frame table of a given video file, the video is only opened and demuxed once,
+    the compact ffprobe output is parsed while it is read from the pipe
+
+    for method "packets" the frame sizes and I frames (keyframe flag) are taken from the packet headers without decoding,
+    if the codec is not part of PACKET_KEYFRAME_CODECS or no keyframe flag is found, "frames" is used instead,
+    with method "frames" every frame is decoded to get the picture type
+
+    if cache_folder is specified, the stream/format information is added to the ffprobe cache,
+    if frame_info_folder is specified, the frame table is stored there in binary form (see frame_table.py)
+    and reused in later calls as long as the video is unchanged
+    @return (ffprobe result, frame table with the method used and the columns size, pict_type, pts_time, dts_time and duration_time)
+    """
+    stored_frame_table, stored = _check_video_and_stored_frame_table(video_segment_file, method, frame_info_folder)
+    if stored is not None:
+        return stored
+
+    logging.info("run stream and framesize extraction based on {} for {}".format(method, video_segment_file))
+    # the frame table is parsed while ffprobe runs, the timeout depends on the method and the file size
+    res, frame_table = run(
+        _frame_info_cmd(video_segment_file, method), stage_timeout(method, video_segment_file), parse=parse_frame_info, exception=ProbeError
     )
+    ffprobe_result, frame_table = _complete_frame_info(video_segment_file, method, res, frame_table)
+    if frame_table is None:
+        ffprobe_result, frame_table = ffprobe_stream_and_frame_table(video_segment_file, "frames")
+    return _store_frame_info(video_segment_file, ffprobe_result, frame_table, cache_folder, stored_frame_table)
 
-    # print(cmd)
-    res = shell_call(cmd).strip()
 
-    if os.path.getsize(report_file_name) == 0:
-        raise Exception("{} is somehow not valid, so ffprobe could not extract anything".format(filename))
-        return ""
-    return report_file_name
+async def ffprobe_stream_and_frame_table_async(
+    video_segment_file, method="frames", cache_folder=None, frame_info_folder=None, scheduler=None
+):
+    """ asyncio version of ffprobe_stream_and_frame_table, ffprobe is run by scheduler (utils.ProbeScheduler.default() if None),
+    the output is parsed in batches of lines while it is read (see FrameInfoParser)
+    """
+    stored_frame_table, stored = _check_video_and_stored_frame_table(video_segment_file, method, frame_info_folder)
+    if stored is not None:
+        return stored
+
+    logging.info("run stream and framesize extraction based on {} for {}".format(method, video_segment_file))
+    scheduler = scheduler or ProbeScheduler.default()
+    res, frame_table = await scheduler.run(
+        _frame_info_cmd(video_segment_file, method), stage_timeout(method, video_segment_file), parser=FrameInfoParser, exception=ProbeError
+    )
+    ffprobe_result, frame_table = _complete_frame_info(video_segment_file, method, res, frame_table)
+    if frame_table is None:
+        ffprobe_result, frame_table = await ffprobe_stream_and_frame_table_async(video_segment_file, "frames", scheduler=scheduler)
+    return _store_frame_info(video_segment_file, ffprobe_result, frame_table, cache_folder, stored_frame_table)
+
+
+class FrameInfoParser:
+    """ incremental parser of the compact ffprobe output of ffprobe_stream_and_frame_table (see iter_frame_info),
+    lines are fed in batches, only the typed columns of the frame table are kept
+    """
+
+    def __init__(self):
+        self._res = {}
+        self._tables = []
+        self.feed([])
+
+    def feed(self, lines):
+        self._tables.extend(iter_frame_info(lines, self._res))
+
+    def result(self):
+        """ @return (stream and format information as parsed by `ffprobe -of json`, frame table) """
+        return self._res, {column: np.concatenate([table[column] for table in self._tables]) for column in self._tables[0]}
+
+
+def _check_video_and_stored_frame_table(video_segment_file, method, frame_info_folder):
+    """ @return (filename of the stored frame table or None, stored (ffprobe result, frame table) or None) """
+    if shutil.which("ffprobe") is None:
+        raise ProbeError("you need to have ffprobe installed, please read README.md.")
+
+    if not os.path.isfile(video_segment_file):
+        raise InvalidInputError("{} is not a valid file".format(video_segment_file))
+
+    if frame_info_folder is None:
+        return None, None
+    stored_frame_table = os.path.join(
+        frame_info_folder, os.path.splitext(os.path.basename(video_segment_file))[0] + "_frames_" + method + ".npy"
+    )
+    stored = load_frame_table(stored_frame_table, video_segment_file)
+    if stored is not None:
+        logging.info("use stored frame table {} for {}".format(stored_frame_table, video_segment_file))
+    return stored_frame_table, stored
+
+
+def _frame_info_cmd(video_segment_file, method):
+    return [
+        "ffprobe",
+        "-loglevel",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        STREAM_ENTRIES + ":" + FRAME_INFO_ENTRIES[method],
+        "-of",
+        "compact=p=1:nk=0",
+        video_segment_file,
+    ]
+
+
+def _complete_frame_info(video_segment_file, method, res, frame_table):
+    """ @return (ffprobe result, frame table), the frame table is None if the packets can not be used and frames are needed """
+    if len(res["streams"]) == 0 or len(frame_table["size"]) == 0:
+        raise ProbeError("{} is somehow not valid, so ffprobe could not extract anything".format(video_segment_file))
+
+    ffprobe_result = parse_ffprobe_result(res)
+    frame_table["method"] = method
+    if method == "packets":
+        keyframes = np.any(frame_table["pict_type"] == ord("I"))
+        if ffprobe_result["codec"] not in PACKET_KEYFRAME_CODECS or not keyframes:
+            logging.info("packets of {} can not be used to classify I frames, frames are used".format(video_segment_file))
+            return ffprobe_result, None
+    return ffprobe_result, frame_table
+
+
+def _store_frame_info(video_segment_file, ffprobe_result, frame_table, cache_folder, stored_frame_table):
+    if cache_folder is not None:
+        ProbeCache(os.path.join(cache_folder, PROBE_CACHE_FILENAME)).put(video_segment_file, ffprobe_result)
+    if stored_frame_table is not None:
+        save_frame_table(stored_frame_table, frame_table, ffprobe_result, video_segment_file)
+    return ffprobe_result, frame_table
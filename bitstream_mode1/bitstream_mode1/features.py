@@ -4,10 +4,15 @@ import json
 
 import numpy as np
 import pandas as pd
-import scipy.stats
 
 from bitstream_mode1.utils import assert_msg
 from bitstream_mode1.utils import file_open
+from bitstream_mode1.frame_table import load_frame_table
+from bitstream_mode1.frame_table import frame_sizes
+
+
+# version of the extracted features, it has to be increased whenever the feature extraction changes, see utils.FeatureCache
+FEATURE_VERSION = 1
 
 
 def extract_features(videofilename, used_features, ffprobe_result, framesizeinfo_result_file):
@@ -22,34 +27,57 @@ def extract_features(videofilename, used_features, ffprobe_result, framesizeinfo
 
 
 class PVS:
-    """ Wrapper to access ffprobe / framesize statistics internally """
+    """ Wrapper to access ffprobe / framesize statistics internally,
+    framesize information is either a frame table, a stored binary frame table or a json file of ffprobe
+    """
 
     def __init__(self, videofilename, ffprobe_result, framesizeinfo_result_file):
         self._videofilename = videofilename
         self._ffprobe_result = ffprobe_result
         self._framesizeinfo_result_file = framesizeinfo_result_file
 
-    def get_frames_from_framesize_info(self):
-        frame_info_list = []
-        framesize_info_stats = {}
-        with file_open(self._framesizeinfo_result_file) as framestat:
-            # framesize_info_stats = json.load(framestat)
-            # print(framesize_info_stats)
+    def get_frame_table(self):
+        """ frame table with the columns size, pict_type, pts_time, dts_time and duration_time """
+        framesize_info = self._framesizeinfo_result_file
+        if isinstance(framesize_info, str) and framesize_info.endswith(".npy"):
+            # binary frame table, see frame_table.save_frame_table
+            return load_frame_table(framesize_info)[1]
+        if isinstance(framesize_info, dict):
+            # frame table as returned by extract_video_frame_info.ffprobe_stream_and_frame_table
+            return framesize_info
+
+        with file_open(framesize_info) as framestat:
             val = json.load(framestat)
 
-            frame_info_list = [x for x in val["frames"]]
+        if "packets" in val:
+            # packet based frame information, I frames are marked with the keyframe flag, other picture types are unknown
+            df = pd.DataFrame(val["packets"])
+            pict_type = np.where(df["flags"].str.contains("K"), "I", "?")
+            columns = {"size": "size", "pts_time": "pts_time", "dts_time": "dts_time", "duration_time": "duration_time"}
+        else:
+            df = pd.DataFrame(val["frames"])
+            pict_type = df["pict_type"].values
+            columns = {"size": "pkt_size", "pts_time": "pkt_pts_time", "dts_time": "pkt_dts_time", "duration_time": "pkt_duration_time"}
+
+        def column(name):
+            if columns[name] in df.columns:
+                return pd.to_numeric(df[columns[name]], errors="coerce").values.astype(np.float64)
+            if name in df.columns:
+                return pd.to_numeric(df[name], errors="coerce").values.astype(np.float64)
+            return np.full(len(df), np.nan)
 
-            df = pd.DataFrame(frame_info_list)
-            df = df[["pict_type", "pkt_size"]]
-            df["pkt_size"] = pd.to_numeric(df["pkt_size"])
-
-            df_i = df[df["pict_type"] == "I"]
-            df_non_i = df[df["pict_type"] != "I"]
+        return {
+            "size": column("size").astype(np.int64),
+            "pict_type": np.array([ord(str(t)[:1] or "?") for t in pict_type], dtype=np.uint8),
+            "pts_time": column("pts_time"),
+            "dts_time": column("dts_time"),
+            "duration_time": column("duration_time"),
+        }
 
-        framesize_info_stats["iframesizes"] = df_i["pkt_size"]
-        framesize_info_stats["noni_framesizes"] = df_non_i["pkt_size"]
-        # return needed
-        return framesize_info_stats
+    def get_frames_from_framesize_info(self):
+        """ sizes of I frames and non-I frames as numpy arrays """
+        iframesizes, noni_framesizes = frame_sizes(self.get_frame_table())
+        return {"iframesizes": iframesizes, "noni_framesizes": noni_framesizes}
 
     def __str__(self):
         return self._videofilename
@@ -135,48 +163,85 @@ class NonIframeSizes:
             "version": 1
         }
 
+def sorted_percentiles(sorted_values, q):
+    """
+    percentiles q (0..100) of an already sorted array with linear interpolation as done by np.percentile,
+    all percentiles are calculated with one vectorized call, nan for empty arrays
+    """
+    q = np.asarray(q, dtype=np.float64)
+    if len(sorted_values) == 0:
+        return np.full(q.shape, np.nan)
+    rank = q / 100 * (len(sorted_values) - 1)
+    lower = np.floor(rank).astype(np.int64)
+    upper = np.ceil(rank).astype(np.int64)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+def moments(values):
+    """
+    mean, standard deviation and fisher kurtosis (as scipy.stats.kurtosis) of an array, nan for empty arrays
+    """
+    if len(values) == 0:
+        return np.nan, np.nan, np.nan
+    mean = values.mean()
+    squared_deviation = (values - mean) ** 2
+    m2 = squared_deviation.mean()
+    kurtosis = np.mean(squared_deviation ** 2) / m2 ** 2 - 3 if m2 > 0 else np.nan
+    return mean, np.sqrt(m2), kurtosis
+
+
 class IFrameRatio:
     """
-    iframe_sizes / non_iframe_sizes based features
+    iframe_sizes / non_iframe_sizes based features,
+    each frame class is sorted once, all order statistics are taken from the sorted sizes and moments are calculated once
     """
+
+    PERCENTILES = [round(10 * i, 1) for i in range(11)]
+
     def calculate(self, processed_video_sequence):
         framesize_info_stats = processed_video_sequence.get_frames_from_framesize_info()
-        iframesizes = framesize_info_stats["iframesizes"] #IframeSizes().calculate(processed_video_sequence)
-        non_iframesizes = framesize_info_stats["noni_framesizes"] #NonIframeSizes().calculate(processed_video_sequence)
+        iframesizes = np.sort(np.asarray(framesize_info_stats["iframesizes"], dtype=np.float64))
+        non_iframesizes = np.sort(np.asarray(framesize_info_stats["noni_framesizes"], dtype=np.float64))
+
+        # quartiles followed by all reported percentiles
+        q = [25, 50, 75] + self.PERCENTILES
+        i_percentiles = sorted_percentiles(iframesizes, q)
+        noni_percentiles = sorted_percentiles(non_iframesizes, q)
+        i_mean, i_std, i_kurtosis = moments(iframesizes)
+        noni_mean, noni_std, noni_kurtosis = moments(non_iframesizes)
+        i_median, noni_median = i_percentiles[1], noni_percentiles[1]
+
+        all_sizes = np.concatenate([iframesizes, non_iframesizes])
+        all_max = all_sizes.max() if len(all_sizes) > 0 else np.nan
+        all_mean, all_std, _ = moments(all_sizes)
+
         result = {}
-        result["ratio_mean"] = np.mean(iframesizes) / ((np.mean(non_iframesizes) + np.mean(iframesizes)))
-        result["ratio_median"] = np.median(iframesizes) / ((np.median(non_iframesizes) + np.median(iframesizes)))
-        result["ratio_std"] = np.std(iframesizes) / ((np.std(non_iframesizes) + np.std(iframesizes)))
-        all_sizes = np.array(iframesizes + non_iframesizes)
-        result["norm_std_all"] = np.std(all_sizes / all_sizes.max())
-        result["norm_mean_all"] = np.mean(all_sizes / all_sizes.max())
-        result["iframe_noniframe_ratio_mean"] = np.mean(iframesizes) / np.mean(non_iframesizes)
-        result["iframe_noniframe_ratio_median"] = np.median(iframesizes) / np.median(non_iframesizes)
-        result["iframe_noniframe_ratio_std"] = np.std(iframesizes) / np.std(non_iframesizes)
-        result["mean_iframesize"] = np.mean(iframesizes)
-        result["median_iframesize"] = np.median(iframesizes)
-        # result["max_iframesize"] = np.amax(iframesizes)
-        # result["min_iframesize"] = np.min(iframesizes, axis=0)
-        result["std_iframesize"] = np.std(iframesizes)
-        result["mean_noniframesize"] = np.mean(non_iframesizes)
-        result["median_noniframesize"] = np.median(non_iframesizes)
-        result["std_noniframesize"] = np.std(non_iframesizes)
-        # result["max_noniframesize"] = np.max(non_iframesizes)
-        # result["min_noniframesize"] = np.min(non_iframesizes)
-
-        result["kurtosis_iframesize"] = float(scipy.stats.kurtosis(iframesizes))
-        result["iqr_iframesize"] = float(scipy.stats.iqr(iframesizes))
-
-        result["kurtosis_noniframesize"] = float(scipy.stats.kurtosis(non_iframesizes))
-        result["iqr_noniframesize"] = float(scipy.stats.iqr(non_iframesizes))
-
-        for i in range(11):
-            percentile = round(10 * i, 1)
-            result["{}_percentile_iframesize".format(percentile)] = np.percentile(iframesizes, percentile, axis=0)
-
-        for i in range(11):
-            percentile = round(10 * i, 1)
-            result["{}_percentile_noniframesize".format(percentile)] = np.percentile(non_iframesizes, percentile, axis=0)
+        result["ratio_mean"] = i_mean / (noni_mean + i_mean)
+        result["ratio_median"] = i_median / (noni_median + i_median)
+        result["ratio_std"] = i_std / (noni_std + i_std)
+        result["norm_std_all"] = all_std / all_max
+        result["norm_mean_all"] = all_mean / all_max
+        result["iframe_noniframe_ratio_mean"] = i_mean / noni_mean
+        result["iframe_noniframe_ratio_median"] = i_median / noni_median
+        result["iframe_noniframe_ratio_std"] = i_std / noni_std
+        result["mean_iframesize"] = i_mean
+        result["median_iframesize"] = i_median
+        result["std_iframesize"] = i_std
+        result["mean_noniframesize"] = noni_mean
+        result["median_noniframesize"] = noni_median
+        result["std_noniframesize"] = noni_std
+
+        result["kurtosis_iframesize"] = float(i_kurtosis)
+        result["iqr_iframesize"] = float(i_percentiles[2] - i_percentiles[0])
+
+        result["kurtosis_noniframesize"] = float(noni_kurtosis)
+        result["iqr_noniframesize"] = float(noni_percentiles[2] - noni_percentiles[0])
+
+        for k, percentile in enumerate(self.PERCENTILES):
+            result["{}_percentile_iframesize".format(percentile)] = i_percentiles[3 + k]
+
+        for k, percentile in enumerate(self.PERCENTILES):
+            result["{}_percentile_noniframesize".format(percentile)] = noni_percentiles[3 + k]
 
         return result
 
@@ -186,3 +251,297 @@ class IFrameRatio:
             "version": 1
         }
 
+
+def segment_sum(values, starts):
+    """
+    sums of consecutive segments of values, segment i starts at index starts[i] (sorted) and ends at the next start,
+    empty segments sum up to 0
+    """
+    # a zero is appended, so that trailing empty segments can start at len(values)
+    sums = np.add.reduceat(np.append(values, 0), starts)
+    return np.where(np.diff(np.append(starts, len(values))) == 0, 0, sums)
+
+
+def frame_times(frame_table):
+    """
+    presentation timestamps of all frames of a frame table,
+    decoding timestamps or accumulated frame durations are used for frames without a presentation timestamp
+    """
+    times = np.asarray(frame_table["pts_time"], dtype=np.float64)
+    times = np.where(np.isnan(times), np.asarray(frame_table["dts_time"], dtype=np.float64), times)
+    accumulated = np.cumsum(np.nan_to_num(np.asarray(frame_table["duration_time"], dtype=np.float64)))
+    return np.where(np.isnan(times), accumulated, times)
+
+
+def per_interval_frame_sizes(frame_table, duration=None, interval=1):
+    """
+    windowed frame size features that are used by the mode 1 model (mean_noniframesize and iframe_noniframe_ratio_mean)
+    for consecutive intervals of `interval` seconds, frames are assigned to intervals based on their timestamps,
+    the last incomplete interval is merged into the previous one, as done for the per second scores;
+    intervals without I frames or non-I frames use the mean I or non-I frame size of the whole video
+    @return dictionary with one array per feature and interval
+    """
+    times = frame_times(frame_table)
+    if duration is None or duration <= 0:
+        duration = np.max(times) - np.min(times)
+    intervals = max(1, int(duration / interval))
+
+    order = np.argsort(times, kind="stable")
+    window = np.minimum(((times[order] - times[order[0]]) // interval).astype(np.int64), intervals - 1)
+    starts = np.searchsorted(window, np.arange(intervals))
+
+    def interval_sum(values):
+        return segment_sum(values, starts)
+
+    sizes = np.asarray(frame_table["size"], dtype=np.float64)[order]
+    iframes = np.asarray(frame_table["pict_type"])[order] == ord("I")
+    iframe_count = interval_sum(iframes.astype(np.float64))
+    noniframe_count = interval_sum((~iframes).astype(np.float64))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_iframesize = np.where(
+            iframe_count > 0, interval_sum(sizes * iframes) / iframe_count, sizes[iframes].mean() if iframes.any() else np.nan
+        )
+        mean_noniframesize = np.where(
+            noniframe_count > 0, interval_sum(sizes * ~iframes) / noniframe_count, sizes[~iframes].mean() if (~iframes).any() else np.nan
+        )
+    return {
+        "mean_noniframesize": mean_noniframesize,
+        "iframe_noniframe_ratio_mean": mean_iframesize / mean_noniframesize,
+    }
+
+
+class IFrameRatioPerSecond:
+    """
+    per second mean_noniframesize and iframe_noniframe_ratio_mean, see per_interval_frame_sizes
+    """
+
+    def calculate(self, processed_video_sequence):
+        duration = float(processed_video_sequence._ffprobe_result.get("duration", 0))
+        per_second = per_interval_frame_sizes(processed_video_sequence.get_frame_table(), duration, 1)
+        return {k: v.tolist() for k, v in per_second.items()}
+
+    def valid_for(self):
+        return {"mode": [1], "version": 1}
+
+
+def segmented_frame_size_statistics(sizes, iframes, offsets):
+    """
+    mean and std based IFrameRatio features of many videos at once,
+    frame sizes and I frame flags of all videos are concatenated, video i uses the frames offsets[i]:offsets[i + 1]
+    @param sizes concatenated frame sizes
+    @param iframes concatenated boolean flags, True for I frames
+    @param offsets start index of each video followed by len(sizes)
+    @return dictionary with one array per feature and video
+    """
+    sizes = np.asarray(sizes, dtype=np.float64)
+    iframes = np.asarray(iframes, dtype=bool)
+    starts = np.asarray(offsets[:-1], dtype=np.int64)
+    lengths = np.diff(offsets)
+
+    result = {}
+    for name, selected in [("iframesize", iframes), ("noniframesize", ~iframes)]:
+        count = segment_sum(selected.astype(np.float64), starts)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = segment_sum(sizes * selected, starts) / count
+            # two pass variance, the mean of each video is repeated for its frames
+            deviation = (sizes - np.repeat(mean, lengths)) * selected
+            std = np.sqrt(segment_sum(deviation ** 2, starts) / count)
+        result["mean_" + name] = mean
+        result["std_" + name] = std
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result["ratio_mean"] = result["mean_iframesize"] / (result["mean_noniframesize"] + result["mean_iframesize"])
+        result["ratio_std"] = result["std_iframesize"] / (result["std_noniframesize"] + result["std_iframesize"])
+        result["iframe_noniframe_ratio_mean"] = result["mean_iframesize"] / result["mean_noniframesize"]
+        result["iframe_noniframe_ratio_std"] = result["std_iframesize"] / result["std_noniframesize"]
+    return result
+
+
+def extract_features_batch(videofilenames, ffprobe_results, frame_tables):
+    """
+    extract the features of many videos at once without one PVS and IFrameRatio per video,
+    all frame tables are concatenated and the IFrameRatio features are calculated with segmented reductions,
+    only the mean and std based IFrameRatio features are calculated (see segmented_frame_size_statistics)
+    @return dataframe with one row per video that can be used with BitstreamMode1._calculate
+    """
+    lengths = [len(frame_table["size"]) for frame_table in frame_tables]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    sizes = np.concatenate([np.asarray(frame_table["size"]) for frame_table in frame_tables]) if len(frame_tables) > 0 else np.zeros(0)
+    iframes = (
+        np.concatenate([np.asarray(frame_table["pict_type"]) == ord("I") for frame_table in frame_tables])
+        if len(frame_tables) > 0
+        else np.zeros(0, dtype=bool)
+    )
+    statistics = segmented_frame_size_statistics(sizes, iframes, offsets)
+
+    features = pd.DataFrame(
+        {
+            "videofilename": videofilenames,
+            "Bitrate": [float(r["bitrate"]) / 1024 for r in ffprobe_results],
+            "Framerate": [float(r["avg_frame_rate"]) if r["avg_frame_rate"] != "unknown" else 60.0 for r in ffprobe_results],
+            "Resolution": [r["width"] * r["height"] for r in ffprobe_results],
+            "Codec": [r["codec"] for r in ffprobe_results],
+            "duration": [float(r["duration"]) for r in ffprobe_results],
+        }
+    )
+    for k, v in statistics.items():
+        features["IFrameRatio_" + k] = v
+    return features
+
+
+class FrameSizeStatistics:
+    """
+    mergeable statistics of a stream of frame sizes with bounded memory,
+    mean, std and kurtosis are based on central moments that are updated chunk-wise (Welford/Pébay),
+    percentiles are estimated with a fixed-bin histogram with log2-spaced bins (about 0.5% bin width)
+    """
+
+    BINS_PER_OCTAVE = 128
+    OCTAVES = 32
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.m3 = 0.0
+        self.m4 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.histogram = np.zeros(self.BINS_PER_OCTAVE * self.OCTAVES, dtype=np.int64)
+
+    def _bins(self, sizes):
+        bins = np.floor(np.log2(np.maximum(sizes, 1)) * self.BINS_PER_OCTAVE).astype(np.int64)
+        return np.clip(bins, 0, len(self.histogram) - 1)
+
+    def update(self, sizes):
+        """ add a chunk of frame sizes """
+        sizes = np.asarray(sizes, dtype=np.float64)
+        if len(sizes) == 0:
+            return self
+        chunk = FrameSizeStatistics.__new__(FrameSizeStatistics)
+        chunk.count = len(sizes)
+        chunk.mean = sizes.mean()
+        deviation = sizes - chunk.mean
+        chunk.m2 = np.sum(deviation ** 2)
+        chunk.m3 = np.sum(deviation ** 3)
+        chunk.m4 = np.sum(deviation ** 4)
+        chunk.min = sizes.min()
+        chunk.max = sizes.max()
+        chunk.histogram = np.bincount(self._bins(sizes), minlength=len(self.histogram))
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """ merge the statistics of another stream of frame sizes, e.g. of another chunk or segment """
+        if other.count == 0:
+            return self
+        na, nb = self.count, other.count
+        n = na + nb
+        delta = other.mean - self.mean
+        m2 = self.m2 + other.m2 + delta ** 2 * na * nb / n
+        m3 = self.m3 + other.m3 + delta ** 3 * na * nb * (na - nb) / n ** 2 + 3 * delta * (na * other.m2 - nb * self.m2) / n
+        m4 = (
+            self.m4
+            + other.m4
+            + delta ** 4 * na * nb * (na ** 2 - na * nb + nb ** 2) / n ** 3
+            + 6 * delta ** 2 * (na ** 2 * other.m2 + nb ** 2 * self.m2) / n ** 2
+            + 4 * delta * (na * other.m3 - nb * self.m3) / n
+        )
+        self.mean = self.mean + delta * nb / n
+        self.count, self.m2, self.m3, self.m4 = n, m2, m3, m4
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.histogram = self.histogram + other.histogram
+        return self
+
+    def get_mean(self):
+        return self.mean if self.count > 0 else np.nan
+
+    def get_std(self):
+        return np.sqrt(self.m2 / self.count) if self.count > 0 else np.nan
+
+    def get_kurtosis(self):
+        """ fisher kurtosis as calculated by scipy.stats.kurtosis """
+        if self.count == 0 or self.m2 == 0:
+            return np.nan
+        return self.count * self.m4 / self.m2 ** 2 - 3
+
+    def _value_at_rank(self, rank):
+        cumulative = np.cumsum(self.histogram)
+        bins = np.searchsorted(cumulative, rank, side="right")
+        within = (rank - (cumulative[bins] - self.histogram[bins]) + 0.5) / self.histogram[bins]
+        values = np.clip(2 ** ((bins + within) / self.BINS_PER_OCTAVE), self.min, self.max)
+        values = np.where(rank == 0, self.min, values)
+        return np.where(rank == self.count - 1, self.max, values)
+
+    def get_percentile(self, q):
+        """ estimated percentiles with linear interpolation between ranks as done by np.percentile """
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan)
+        rank = q / 100 * (self.count - 1)
+        lower = np.floor(rank).astype(np.int64)
+        upper = np.ceil(rank).astype(np.int64)
+        fraction = rank - lower
+        return (1 - fraction) * self._value_at_rank(lower) + fraction * self._value_at_rank(upper)
+
+
+class IFrameRatioAccumulator:
+    """
+    streaming version of IFrameRatio, frame sizes can be added chunk-wise,
+    accumulators of chunks or segments can be merged,
+    moments are exact, percentiles (including median and iqr) are estimated (see FrameSizeStatistics)
+    """
+
+    def __init__(self):
+        self.iframes = FrameSizeStatistics()
+        self.noniframes = FrameSizeStatistics()
+
+    def update(self, iframesizes, noni_framesizes):
+        self.iframes.update(iframesizes)
+        self.noniframes.update(noni_framesizes)
+        return self
+
+    def update_frame_table(self, frame_table):
+        """ add all frames of a frame table, see extract_video_frame_info.iter_frame_info """
+        return self.update(*frame_sizes(frame_table))
+
+    def merge(self, other):
+        self.iframes.merge(other.iframes)
+        self.noniframes.merge(other.noniframes)
+        return self
+
+    def calculate(self):
+        """ IFrameRatio features of all frames that were added so far """
+        i, noni = self.iframes, self.noniframes
+        all_sizes = FrameSizeStatistics().merge(i).merge(noni)
+        percentiles = [round(10 * k, 1) for k in range(11)]
+        i_percentiles = i.get_percentile([25, 50, 75] + percentiles)
+        noni_percentiles = noni.get_percentile([25, 50, 75] + percentiles)
+
+        result = {}
+        result["ratio_mean"] = i.get_mean() / (noni.get_mean() + i.get_mean())
+        result["ratio_median"] = i_percentiles[1] / (noni_percentiles[1] + i_percentiles[1])
+        result["ratio_std"] = i.get_std() / (noni.get_std() + i.get_std())
+        result["norm_std_all"] = all_sizes.get_std() / all_sizes.max
+        result["norm_mean_all"] = all_sizes.get_mean() / all_sizes.max
+        result["iframe_noniframe_ratio_mean"] = i.get_mean() / noni.get_mean()
+        result["iframe_noniframe_ratio_median"] = i_percentiles[1] / noni_percentiles[1]
+        result["iframe_noniframe_ratio_std"] = i.get_std() / noni.get_std()
+        result["mean_iframesize"] = i.get_mean()
+        result["median_iframesize"] = i_percentiles[1]
+        result["std_iframesize"] = i.get_std()
+        result["mean_noniframesize"] = noni.get_mean()
+        result["median_noniframesize"] = noni_percentiles[1]
+        result["std_noniframesize"] = noni.get_std()
+
+        result["kurtosis_iframesize"] = float(i.get_kurtosis())
+        result["iqr_iframesize"] = float(i_percentiles[2] - i_percentiles[0])
+
+        result["kurtosis_noniframesize"] = float(noni.get_kurtosis())
+        result["iqr_noniframesize"] = float(noni_percentiles[2] - noni_percentiles[0])
+
+        for k, percentile in enumerate(percentiles):
+            result["{}_percentile_iframesize".format(percentile)] = i_percentiles[3 + k]
+        for k, percentile in enumerate(percentiles):
+            result["{}_percentile_noniframesize".format(percentile)] = noni_percentiles[3 + k]
+        return result
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+live scoring of growing HLS outputs or segment folders with the bitstream mode 1 model,
+every new segment is probed once, the IFrameRatio state is kept over all segments
+
+style: black -l 140 follow.py
+"""
+import argparse
+import copy
+import datetime
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+import pandas as pd
+
+from bitstream_mode1 import __version__
+from bitstream_mode1.extract_video_frame_info import ffprobe_stream_and_frame_table
+from bitstream_mode1.features import PVS
+from bitstream_mode1.features import Bitrate
+from bitstream_mode1.features import Codec
+from bitstream_mode1.features import Framerate
+from bitstream_mode1.features import Resolution
+from bitstream_mode1.features import IFrameRatioAccumulator
+from bitstream_mode1.features import IFrameRatioPerSecond
+from bitstream_mode1.generic import *
+from bitstream_mode1.model import BitstreamMode1
+from bitstream_mode1.modelutils import load_coefficients
+from bitstream_mode1.utils import assert_file
+from bitstream_mode1.utils import assert_msg
+from bitstream_mode1.utils import error_record
+from bitstream_mode1.utils import ModelError
+from bitstream_mode1.utils import UnsupportedVideoError
+
+# file extensions of segments that are picked up in a folder
+SEGMENT_EXTENSIONS = [".ts", ".mp4", ".mkv", ".webm"]
+
+
+def _playlist_segments(playlist):
+    """
+    segments of an HLS media playlist
+    @return (segment filenames, init segment filename or None, True if the playlist is finished)
+    """
+    segments, init, finished = [], None, False
+    if not os.path.isfile(playlist):
+        return segments, init, finished
+    folder = os.path.dirname(playlist)
+    with open(playlist) as lines:
+        for line in lines:
+            line = line.strip()
+            if line.startswith("#EXT-X-MAP:") and 'URI="' in line:
+                init = os.path.join(folder, line.split('URI="')[1].split('"')[0])
+            elif line.startswith("#EXT-X-ENDLIST"):
+                finished = True
+            elif line != "" and not line.startswith("#"):
+                segments.append(os.path.join(folder, line))
+    return segments, init, finished
+
+
+def _folder_segments(folder):
+    segments = []
+    for f in os.listdir(folder):
+        if os.path.splitext(f)[1].lower() not in SEGMENT_EXTENSIONS or f.startswith("."):
+            continue
+        try:
+            segments.append((os.path.getmtime(os.path.join(folder, f)), os.path.join(folder, f)))
+        except OSError:
+            # removed in the meantime, e.g. by a live encoder with a sliding window
+            continue
+    return [segment for _, segment in sorted(segments)]
+
+
+def iter_segments(source, poll_interval=0.5, idle_timeout=None):
+    """
+    yield (segment, init segment or None) for each new segment of an HLS media playlist or a folder,
+    segments in a folder are only used once their size did not change between two polls,
+    stops at #EXT-X-ENDLIST or if no new segment appeared for idle_timeout seconds (None: never)
+    """
+    seen = set()
+    pending = {}
+    last_segment = time.monotonic()
+    while True:
+        if os.path.isdir(source):
+            candidates, init, finished = _folder_segments(source), None, False
+        else:
+            candidates, init, finished = _playlist_segments(source)
+
+        new_segments = False
+        for segment in candidates:
+            if segment in seen or not os.path.isfile(segment):
+                continue
+            if os.path.isdir(source):
+                try:
+                    stat = os.stat(segment)
+                except OSError:
+                    pending.pop(segment, None)
+                    continue
+                if pending.get(segment) != (stat.st_size, stat.st_mtime_ns):
+                    pending[segment] = (stat.st_size, stat.st_mtime_ns)
+                    continue
+                del pending[segment]
+            seen.add(segment)
+            new_segments = True
+            yield segment, init
+
+        if new_segments:
+            last_segment = time.monotonic()
+        if finished and all(segment in seen for segment in candidates):
+            return
+        if idle_timeout is not None and time.monotonic() - last_segment > idle_timeout:
+            return
+        time.sleep(poll_interval)
+
+
+def _probe_segment(segment, init, frame_info, temporary_folder):
+    if init is None:
+        return ffprobe_stream_and_frame_table(segment, frame_info, temporary_folder)
+    # fragmented mp4 segments can only be probed together with their init segment
+    combined = os.path.join(temporary_folder, "follow_" + os.path.basename(segment))
+    with open(combined, "wb") as output:
+        for part in [init, segment]:
+            with open(part, "rb") as media:
+                shutil.copyfileobj(media, output)
+    try:
+        return ffprobe_stream_and_frame_table(combined, frame_info)
+    finally:
+        os.remove(combined)
+
+
+def follow(
+    source,
+    model_config_filename=DEFAULT_MODEL,
+    device_type="pc",
+    device_resolution="3840x2160",
+    temporary_folder="tmp",
+    frame_info="frames",
+    poll_interval=0.5,
+    idle_timeout=None,
+):
+    """
+    score every new segment of an HLS media playlist or a folder as soon as it is complete
+    @return generator of one report per segment, with the segment score (per_sequence, per_second)
+        and the running score over all segments so far (running_per_sequence),
+        or an error record (see utils.error_record) for segments that can not be processed
+    """
+    device_type = device_type.lower()
+    assert_msg(
+        device_type in DEVICE_TYPES,
+        f"specified device_type '{device_type}' is not supported, only {DEVICE_TYPES} possible",
+    )
+    assert_msg(
+        device_resolution in DEVICE_RESOLUTIONS,
+        f"specified device_resolution '{device_resolution}' is not supported, only {DEVICE_RESOLUTIONS} possible",
+    )
+    assert_msg(
+        frame_info in FRAME_INFO_METHODS,
+        f"specified frame_info '{frame_info}' is not supported, only {FRAME_INFO_METHODS} possible",
+    )
+    assert_file(model_config_filename, f"{model_config_filename} does not exist, please check")
+    os.makedirs(temporary_folder, exist_ok=True)
+
+    model = BitstreamMode1()
+    coefficients = load_coefficients(model_config_filename)
+    display_res = float(device_resolution.split("x")[0]) * float(device_resolution.split("x")[1])
+
+    running = IFrameRatioAccumulator()
+    running_duration = 0.0
+    for index, (segment, init) in enumerate(iter_segments(source, poll_interval, idle_timeout)):
+        # a segment that can not be processed is reported and does not stop following,
+        # the running state is only updated by segments that were scored
+        try:
+            ffprobe_result, frame_table = _probe_segment(segment, init, frame_info, temporary_folder)
+            assert_msg(
+                ffprobe_result["codec"] in CODECS_SUPPORTED,
+                f"segment {segment} uses a video codec that is not supported: {ffprobe_result['codec']}",
+                UnsupportedVideoError,
+            )
+
+            pvs = PVS(segment, ffprobe_result, frame_table)
+            segment_features = {
+                str(f.__name__): f().calculate(pvs) for f in [Bitrate, Framerate, Resolution, Codec, IFrameRatioPerSecond]
+            }
+            accumulator = IFrameRatioAccumulator().update_frame_table(frame_table)
+            updated_running = copy.deepcopy(running).merge(accumulator)
+
+            # segment and running state are scored in one call, the running state uses the current codec, resolution and framerate
+            features = pd.DataFrame(
+                [
+                    dict(segment_features, IFrameRatio=accumulator.calculate()),
+                    dict(segment_features, IFrameRatio=updated_running.calculate()),
+                ]
+            )
+            scores = model._calculate(features, coefficients, display_res, device_type)
+            per_second = model._per_second(features, coefficients, display_res, device_type)
+
+            duration = float(ffprobe_result["duration"])
+            report = {
+                "segment": segment,
+                "segment_index": index,
+                "start": running_duration,
+                "duration": duration,
+                "per_sequence": float(scores["final_pred"][0]),
+                "per_second": [float(x) for x in per_second],
+                "running_per_sequence": float(scores["final_pred"][1]),
+                "running_duration": running_duration + duration,
+                "debug": {
+                    "coding_deg": float(scores["debug"]["coding_deg"][0]),
+                    "upscaling_deg": float(scores["debug"]["upscaling_deg"][0]),
+                    "temporal_deg": float(scores["debug"]["temporal_deg"][0]),
+                },
+                "date": str(datetime.datetime.now()),
+                "model": "bitstream_mode1",
+                "version": __version__,
+            }
+        except ModelError as e:
+            logging.warning(f"{e}, it will be ignored")
+            yield dict(error_record(segment, e), segment=segment, segment_index=index)
+            continue
+        except Exception as e:
+            logging.exception(f"segment {segment} could not be processed, it will be ignored")
+            yield dict(error_record(segment, e), segment=segment, segment_index=index)
+            continue
+
+        running = updated_running
+        running_duration += duration
+        yield report
+
+
+def main(_=[]):
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        description="follow a growing HLS media playlist or segment folder and score each new segment with the bitstream mode 1 model, one json report per line",
+        epilog="rrao, stg7 2022",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("source", type=str, help="HLS media playlist (.m3u8) or folder that contains the segments")
+    parser.add_argument("--model", type=str, default=DEFAULT_MODEL, help="model config file to be used for prediction")
+    parser.add_argument("--device_type", choices=DEVICE_TYPES, default="pc", help="device that is used for playout")
+    parser.add_argument(
+        "--device_resolution",
+        choices=DEVICE_RESOLUTIONS,
+        default="3840x2160",
+        help="resolution of the output device (width x height)",
+    )
+    parser.add_argument(
+        "--tmp",
+        type=str,
+        default="./tmp",
+        help="temporary folder to store bitstream stats and other intermediate results",
+    )
+    parser.add_argument(
+        "--frame_info",
+        choices=FRAME_INFO_METHODS,
+        default="frames",
+        help="extract frame sizes and I frames from packet headers (fast) or from decoded frames",
+    )
+    parser.add_argument("--poll_interval", type=float, default=0.5, help="seconds between two checks for new segments")
+    parser.add_argument("--idle_timeout", type=float, default=None, help="stop if no new segment appeared for this many seconds")
+
+    a = vars(parser.parse_args())
+    logging.basicConfig(level=logging.INFO)
+
+    for report in follow(
+        a["source"], a["model"], a["device_type"], a["device_resolution"], a["tmp"], a["frame_info"], a["poll_interval"], a["idle_timeout"]
+    ):
+        print(json.dumps(report, sort_keys=True), flush=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
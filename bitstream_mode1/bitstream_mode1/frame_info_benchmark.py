@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+benchmark and equivalence report of the packet and frame based frame information extraction
+
+style: black -l 140 frame_info_benchmark.py
+"""
+import argparse
+import logging
+import sys
+import time
+
+import numpy as np
+
+from bitstream_mode1 import __version__
+from bitstream_mode1.extract_video_frame_info import ffprobe_stream_and_frame_table
+from bitstream_mode1.features import PVS
+from bitstream_mode1.features import IFrameRatio
+from bitstream_mode1.generic import *
+from bitstream_mode1.utils import assert_file
+from bitstream_mode1.utils import json_store
+
+
+def compare_frame_info(videofilename):
+    """
+    run the packet and frame based extraction for one video and compare the resulting IFrameRatio features
+    @return dictionary with runtimes, number of I frames and the relative differences of all IFrameRatio features
+    """
+    assert_file(videofilename, f"{videofilename} does not exist, please check")
+    report = {"video_full_path": videofilename}
+    features = {}
+    for method in FRAME_INFO_METHODS:
+        start = time.perf_counter()
+        ffprobe_result, frame_table = ffprobe_stream_and_frame_table(videofilename, method)
+        report[f"{method}_duration"] = time.perf_counter() - start
+        # packets may fall back to frames for codecs without usable keyframe flags
+        report[f"{method}_used"] = frame_table["method"]
+
+        pvs = PVS(videofilename, ffprobe_result, frame_table)
+        report[f"{method}_iframes"] = len(pvs.get_frames_from_framesize_info()["iframesizes"])
+        features[method] = IFrameRatio().calculate(pvs)
+
+    report["speedup"] = report["frames_duration"] / report["packets_duration"]
+    differences = {}
+    for k in features["frames"]:
+        reference, value = float(features["frames"][k]), float(features["packets"][k])
+        if np.isnan(reference) and np.isnan(value):
+            differences[k] = 0.0
+            continue
+        differences[k] = abs(value - reference) / max(abs(reference), np.finfo(float).eps)
+    report["relative_differences"] = differences
+    report["max_relative_difference"] = max(differences.values())
+    return report
+
+
+def main(_=[]):
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        description="benchmark of packet vs frame based frame information extraction for the bitstream mode 1 model",
+        epilog="rrao, stg7 2022",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("video", type=str, nargs="+", help="input videos")
+    parser.add_argument("--report", type=str, default="frame_info_benchmark.json", help="file to store the equivalence report")
+
+    a = vars(parser.parse_args())
+    logging.basicConfig(level=logging.INFO)
+
+    reports = [compare_frame_info(video) for video in a["video"]]
+    for report in reports:
+        logging.info(
+            f"""{report["video_full_path"]}: packets {report["packets_duration"]:.2f}s, frames {report["frames_duration"]:.2f}s, """
+            f"""speedup {report["speedup"]:.1f}, I frames {report["packets_iframes"]}/{report["frames_iframes"]}, """
+            f"""max relative IFrameRatio difference {report["max_relative_difference"]:.2e}"""
+        )
+    json_store(a["report"], {"version": __version__, "videos": reports})
+    logging.info(f"""equivalence report stored as {a["report"]}""")
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+binary storage of frame tables (see extract_video_frame_info.ffprobe_stream_and_frame_table),
+a table is stored as one memory-mappable `.npy` record array and a small `.json` header
+
+style: black -l 140 frame_table.py
+"""
+import os
+
+import numpy as np
+
+from bitstream_mode1.utils import file_identity
+from bitstream_mode1.utils import json_load
+from bitstream_mode1.utils import json_store
+
+FRAME_TABLE_VERSION = 1
+# columns of a frame table, pict_type is the character code of the picture type ("?" if unknown)
+FRAME_TABLE_DTYPE = np.dtype(
+    [
+        ("size", np.int64),
+        ("pict_type", np.uint8),
+        ("pts_time", np.float64),
+        ("dts_time", np.float64),
+        ("duration_time", np.float64),
+    ]
+)
+
+
+def save_frame_table(filename, frame_table, ffprobe_result, videofilename):
+    """
+    store a frame table as `<filename>.npy` and a header with the method, the ffprobe result and
+    the identity of the video as `<filename>.json`, both files are written atomically
+    """
+    basename = os.path.splitext(filename)[0]
+    os.makedirs(os.path.dirname(os.path.abspath(basename)), exist_ok=True)
+    records = np.empty(len(frame_table["size"]), dtype=FRAME_TABLE_DTYPE)
+    for column in FRAME_TABLE_DTYPE.names:
+        records[column] = frame_table[column]
+    with open(basename + ".npy.part", "wb") as table:
+        np.save(table, records)
+    os.replace(basename + ".npy.part", basename + ".npy")
+
+    header = {
+        "version": FRAME_TABLE_VERSION,
+        "method": frame_table["method"],
+        "frames": len(records),
+        "video": list(file_identity(videofilename)),
+        "ffprobe_result": ffprobe_result,
+    }
+    json_store(basename + ".json.part", header)
+    os.replace(basename + ".json.part", basename + ".json")
+
+
+def load_frame_table(filename, videofilename=None, mmap=True):
+    """
+    load a frame table stored with save_frame_table, the columns are memory-mapped by default,
+    if videofilename is specified, the table is only used if it was extracted from the unchanged video
+    @return (ffprobe result, frame table) or None if no valid table is stored
+    """
+    basename = os.path.splitext(filename)[0]
+    if not os.path.isfile(basename + ".json") or not os.path.isfile(basename + ".npy"):
+        return None
+    header = json_load(basename + ".json")
+    if header.get("version") != FRAME_TABLE_VERSION:
+        return None
+    if videofilename is not None and header["video"] != list(file_identity(videofilename)):
+        return None
+    records = np.load(basename + ".npy", mmap_mode="r" if mmap else None)
+    if records.dtype != FRAME_TABLE_DTYPE or len(records) != header["frames"]:
+        return None
+    frame_table = {column: records[column] for column in FRAME_TABLE_DTYPE.names}
+    frame_table["method"] = header["method"]
+    return header["ffprobe_result"], frame_table
+
+
+def frame_sizes(frame_table):
+    """
+    sizes of all I frames and all non-I frames of a frame table
+    @return (I frame sizes, non-I frame sizes) as numpy arrays
+    """
+    iframes = np.asarray(frame_table["pict_type"]) == ord("I")
+    sizes = np.asarray(frame_table["size"])
+    return sizes[iframes], sizes[~iframes]
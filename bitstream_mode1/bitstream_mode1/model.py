@@ -7,10 +7,14 @@ import json
 import os
 import datetime
 
+import numpy as np
+
 from bitstream_mode1 import __version__
 from bitstream_mode1.utils import assert_file
 from bitstream_mode1.utils import assert_msg
+from bitstream_mode1.utils import UnsupportedVideoError
 from bitstream_mode1.utils import ffprobe
+from bitstream_mode1.utils import FeatureCache
 from bitstream_mode1.utils import json_load
 from bitstream_mode1.modelutils import map_to_45
 from bitstream_mode1.modelutils import map_to_5
@@ -19,7 +23,10 @@ from bitstream_mode1.modelutils import mos_from_r
 from bitstream_mode1.modelutils import load_serialized
 from bitstream_mode1.modelutils import binarize_column
 from bitstream_mode1.modelutils import load_dict_values
-from bitstream_mode1.modelutils import per_sample_interval_function
+from bitstream_mode1.modelutils import load_coefficients
+from bitstream_mode1.modelutils import device_class_ids
+from bitstream_mode1.modelutils import predicted_qp
+from bitstream_mode1.modelutils import to_ids
 from bitstream_mode1.generic import *
 
 import bitstream_mode1.features as features
@@ -36,137 +43,48 @@ class BitstreamMode1:
     def __init__(self):
         self.display_res = 3840 * 2160
 
-    def _calculate(self, prediction_features, params, display_res, device_type):
-        def mos_q_baseline_pc(features, a, b, c, d):
-            print("a = {}, b = {}, c = {}, d = {}".format(a, b, c, d))
-            quant = features["quant"]
-            mos_q = a + b * np.exp(c * quant + d)
-            mos_q = np.clip(mos_q, 1, 5)
-            mos_q = np.vectorize(r_from_mos)(mos_q)
-            cod_deg = 100 - mos_q
-            cod_deg = np.clip(cod_deg, 0, 100)
-            return cod_deg
-
+    def _calculate(self, prediction_features, coefficients, display_res, device_type):
         prediction_features = prediction_features.copy()
 
         prediction_features = load_dict_values(prediction_features, "IFrameRatio")
         # print(prediction_features.columns)
 
-        # change this to different things for mobile and pc
-        def predqp_pc(row):
-            if row["Codec"] not in ["h264", "hevc", "vp9"]:
-                return -1
-            if row["Codec"] == "h264":
-                e = -5.45370021
-                d = 0.24788992
-                c = 5.78207198
-                b = -7.39512320
-                a = 28.4333174
-            if row["Codec"] == "hevc":
-                e = -2.28896532
-                d = -0.89995975
-                c = 5.15729271
-                b = -6.52974529
-                a = 22.3936569
-            if row["Codec"] == "vp9":
-                e = -18.7808971
-                d = -10.2195346
-                c = 40.6831660
-                b = -51.1209683
-                a = 92.1245351
-            pred_qp = (
-                a
-                + b * np.log(row["IFrameRatio_mean_noniframesize"])
-                + c * np.log(row["Resolution"])
-                + d * np.log(row["Framerate"])
-                + e * np.log(row["IFrameRatio_iframe_noniframe_ratio_mean"])
-            )
-            return pred_qp
-
-        def predqp_mobile(row):
-            if row["Codec"] not in ["h264", "hevc", "vp9"]:
-                return -1
-            if row["Codec"] == "h264":
-                e = -6.51258585
-                d = -0.86271189
-                c = 6.11739209
-                b = -7.40096124
-                a = 30.6150034
-            if row["Codec"] == "hevc":
-                e = -3.83762247
-                d = -3.04775031
-                c = 5.77213226
-                b = -7.05771310
-                a = 29.6766107
-            if row["Codec"] == "vp9":
-                e = -24.9768715
-                d = 1.83157999
-                c = 34.3946143
-                b = -49.8642457
-                a = 145.132249
-            pred_qp = (
-                a
-                + b * np.log(row["IFrameRatio_mean_noniframesize"])
-                + c * np.log(row["Resolution"])
-                + d * np.log(row["Framerate"])
-                + e * np.log(row["IFrameRatio_iframe_noniframe_ratio_mean"])
-            )
-            return pred_qp
-
-        if device_type.lower() in ["pc", "tv"]:
-            prediction_features["pred_qp"] = prediction_features.apply(predqp_pc, axis=1)
-        else:
-            prediction_features["pred_qp"] = prediction_features.apply(predqp_mobile, axis=1)
-
-        def norm_qp(row):
-            if row["Codec"] == "h264":
-                return row["pred_qp"] / 63
-            if row["Codec"] == "hevc":
-                return row["pred_qp"] / 63
-            if row["Codec"] == "vp9":
-                return row["pred_qp"] / 255
-            return -1
-
-        prediction_features["quant"] = prediction_features.apply(norm_qp, axis=1)
-
-        prediction_features = binarize_column(prediction_features, "Codec")
+        rows = len(prediction_features)
+        codec_id = to_ids(prediction_features["Codec"].values, CODECS_SUPPORTED)
+        device_id = device_class_ids(np.full(rows, device_type))
+        resolution = prediction_features["Resolution"].values.astype(float)
+        framerate = prediction_features["Framerate"].values.astype(float)
 
-        codecs = prediction_features["Codec"].unique()
-
-        cod_deg = sum(
+        quant = predicted_qp(
+            coefficients,
+            device_id,
+            codec_id,
             [
-                prediction_features[c]
-                * mos_q_baseline_pc(prediction_features, params[c + "_a"], params[c + "_b"], params[c + "_c"], params[c + "_d"])
-                for c in codecs
-            ]
+                np.log(prediction_features["IFrameRatio_mean_noniframesize"].values.astype(float)),
+                np.log(resolution),
+                np.log(framerate),
+                np.log(prediction_features["IFrameRatio_iframe_noniframe_ratio_mean"].values.astype(float)),
+            ],
         )
 
-        if device_type.lower() in ["pc", "tv"]:
-            x = -12.8292
-            y = 2.4358
-            z = -41.0545
-            k = 3.7547
-        else:
-            x = -10.4174
-            y = 2.2679
-            z = -57.1618
-            k = 3.5766
-
-        print("x = {}, y = {}, z = {}, k = {}".format(x, y, z, k))
-        print("quant = {}".format(prediction_features["quant"]))
-        print("display_res = {}".format(display_res))
-        resolution = x * np.log(y * (prediction_features["Resolution"] / display_res))
+        a, b, c, d = coefficients.mos_q[device_id, codec_id].T
+        mos_q = a + b * np.exp(c * quant + d)
+        mos_q = np.clip(mos_q, 1, 5)
+        mos_q = r_from_mos(mos_q)
+        cod_deg = np.clip(100 - mos_q, 0, 100)
+
+        x, y, z, k = coefficients.degradation[device_id].T
+        resolution = x * np.log(y * (resolution / display_res))
         resolution = np.clip(resolution, 0, 100)
 
-        framerate = z * np.log(k * prediction_features["Framerate"] / 60)
+        framerate = z * np.log(k * framerate / 60)
         framerate = np.clip(framerate, 0, 100)
 
         pred = 100 - (cod_deg + resolution + framerate)
-        pred = np.vectorize(mos_from_r)(pred)
+        pred = mos_from_r(pred)
         pred = np.clip(pred, 1, 5)
-        predicted_score = np.vectorize(map_to_5)(pred)
-        initial_predicted_score = np.vectorize(map_to_5)(pred)
-        prediction_features["predicted_mos_mode1_baseline"] = initial_predicted_score
+        predicted_score = map_to_5(pred)
+        prediction_features["predicted_mos_mode1_baseline"] = predicted_score
 
         result = {
             "final_pred": predicted_score,
@@ -175,31 +93,47 @@ class BitstreamMode1:
                 "coding_deg": cod_deg,
                 "upscaling_deg": resolution,
                 "temporal_deg": framerate,
-                # "rf_pred": prediction_features_rf["rf_pred"],
-                # "rf_pred": prediction_features["rf_pred"],
             },
-            # "features": feature_values
         }
         return result
 
+    def _per_second(self, prediction_features, coefficients, display_res, device_type):
+        """
+        per second scores based on the windowed frame size features (IFrameRatioPerSecond),
+        all seconds are predicted with one call of the model equations
+        """
+        per_second = prediction_features["IFrameRatioPerSecond"].values[0]
+        seconds = len(per_second["mean_noniframesize"])
+        per_second_features = pd.DataFrame(
+            {
+                "Codec": np.repeat(prediction_features["Codec"].values[0], seconds),
+                "Resolution": np.repeat(prediction_features["Resolution"].values[0], seconds),
+                "Framerate": np.repeat(prediction_features["Framerate"].values[0], seconds),
+                "IFrameRatio_mean_noniframesize": per_second["mean_noniframesize"],
+                "IFrameRatio_iframe_noniframe_ratio_mean": per_second["iframe_noniframe_ratio_mean"],
+            }
+        )
+        return np.clip(self._calculate(per_second_features, coefficients, display_res, device_type)["final_pred"], 1, 5)
+
     def valid_for(self):
         return {"mode": [1], "version": 1}
 
     def features_used(self):
-        return [features.Bitrate, features.Framerate, features.Resolution, features.Codec, features.IFrameRatio]
-
-    def predict_quality(
-        self,
-        videofilename,
-        model_config_filename,
-        device_type="pc",
-        device_resolution="3840x2160",
-        viewing_distance="1.5xH",
-        display_size=55,
-        temporary_folder="tmp",
-        cache_features=True,
+        return [
+            features.Bitrate,
+            features.Framerate,
+            features.Resolution,
+            features.Codec,
+            features.IFrameRatio,
+            features.IFrameRatioPerSecond,
+        ]
+
+    def _check_settings(
+        self, videofilename, model_config_filename, device_type, device_resolution, viewing_distance, display_size, frame_info
     ):
-
+        """ validate all settings of a prediction
+        @return lower case device type
+        """
         assert_file(videofilename, f"{videofilename} does not exist, please check")
         assert_file(model_config_filename, f"{model_config_filename} does not exist, please check")
 
@@ -220,63 +154,99 @@ class BitstreamMode1:
             display_size in DISPLAY_SIZES,
             f"specified display_size '{display_size}' is not supported, only {DISPLAY_SIZES} possible",
         )
-
-        ffprobe_result = ffprobe(videofilename)
         assert_msg(
-            ffprobe_result["codec"] in CODECS_SUPPORTED,
-            f"your video codec is not supported by the model: {ffprobe_result['codec']}",
+            frame_info in FRAME_INFO_METHODS,
+            f"specified frame_info '{frame_info}' is not supported, only {FRAME_INFO_METHODS} possible",
         )
+        return device_type
 
-        model_config = json_load(model_config_filename)
+    def _feature_cache(self, temporary_folder, frame_info):
+        return FeatureCache(os.path.join(temporary_folder, "features"), f"mode1_{__version__}_{FEATURE_VERSION}_{frame_info}")
 
-        device_type = "pc" if device_type in ["pc", "tv"] else "mobile"
+    def predict_quality(
+        self,
+        videofilename,
+        model_config_filename,
+        device_type="pc",
+        device_resolution="3840x2160",
+        viewing_distance="1.5xH",
+        display_size=55,
+        temporary_folder="tmp",
+        cache_features=True,
+        frame_info="frames",
+        store_frame_info=False,
+    ):
+        device_type = self._check_settings(
+            videofilename, model_config_filename, device_type, device_resolution, viewing_distance, display_size, frame_info
+        )
+        os.makedirs(temporary_folder, exist_ok=True)
+
+        feature_cache = self._feature_cache(temporary_folder, frame_info) if cache_features else None
+        cached = feature_cache.get(videofilename) if feature_cache is not None else None
+        if cached is not None:
+            logging.info("features are already cached, extraction skipped")
+            return self._predict_probed(
+                videofilename, model_config_filename, device_type, device_resolution, cached["ffprobe_result"], extracted=cached["features"]
+            )
 
-        # select only the required config for the device type
-        model_config = model_config[device_type]
+        # stream/format and framesize info extraction with one ffprobe call
+        ffprobe_result, frame_table = ffprobe_stream_and_frame_table(
+            videofilename, frame_info, temporary_folder, temporary_folder if store_frame_info else None
+        )
+        return self._predict_probed(
+            videofilename, model_config_filename, device_type, device_resolution, ffprobe_result, frame_table, feature_cache=feature_cache
+        )
 
-        # assume the RF model part is locally stored in the path of model_config_filename
-        # rf_model = os.path.join(os.path.dirname(model_config_filename), model_config["rf"])
+    def _predict_probed(
+        self,
+        videofilename,
+        model_config_filename,
+        device_type,
+        device_resolution,
+        ffprobe_result,
+        frame_table=None,
+        extracted=None,
+        feature_cache=None,
+    ):
+        """ predict the quality of a probed video, the features are extracted from the frame table
+        and stored in the feature cache unless they are already extracted (e.g. cached)
+        """
+        assert_msg(
+            ffprobe_result["codec"] in CODECS_SUPPORTED,
+            f"your video codec is not supported by the model: {ffprobe_result['codec']}",
+            UnsupportedVideoError,
+        )
 
-        # load parametetric model coefficients
-        model_coefficients = model_config["params"]
+        # load the compiled parametric model coefficients of all device classes
+        coefficients = load_coefficients(model_config_filename)
 
         display_res = float(device_resolution.split("x")[0]) * float(device_resolution.split("x")[1])
 
         self.display_res = display_res
 
-        os.makedirs(temporary_folder, exist_ok=True)
-
-        feature_cache = os.path.join(temporary_folder, os.path.splitext(os.path.basename(videofilename))[0] + "_feat.pkl")
-        logging.info(f"use feature cache file {feature_cache}")
-        if not os.path.isfile(feature_cache):
-            # run framesize info extraction
-            framesizeinfo_result_file = ffprobe_frame_info(videofilename, temporary_folder)
-            if framesizeinfo_result_file == "":
-                logging.error(f"no framsize information file for {videofilename}")
-                return {}
-
+        if extracted is None:
             # calculate features
-            features = pd.DataFrame([extract_features(videofilename, self.features_used(), ffprobe_result, framesizeinfo_result_file)])
-            features.to_pickle(feature_cache)
-        else:
-            logging.info("features are already cached, extraction skipped")
-            features = pd.read_pickle(feature_cache)
+            extracted = extract_features(videofilename, self.features_used(), ffprobe_result, frame_table)
+            if feature_cache is not None:
+                feature_cache.put(videofilename, {"features": extracted, "ffprobe_result": ffprobe_result})
+        extracted["videofilename"] = videofilename
+        features = pd.DataFrame([extracted])
 
         logging.info("features extracted")
 
         # per_sequence = self._calculate(features, model_coefficients, rf_model, display_res, device_type)
-        per_sequence = self._calculate(features, model_coefficients, display_res, device_type)
+        per_sequence = self._calculate(features, coefficients, display_res, device_type)
 
-        per_second = per_sample_interval_function(per_sequence["final_pred"], features)
+        per_second = self._per_second(features, coefficients, display_res, device_type)
         return {
             "video_full_path": videofilename,
             "video_basename": os.path.basename(videofilename),
             "per_second": [float(x) for x in per_second],
-            "per_sequence": float(per_sequence["final_pred"]),
+            "per_sequence": float(per_sequence["final_pred"][0]),
             "debug": {
-                "coding_deg": float(per_sequence["debug"]["coding_deg"]),
-                "upscaling_deg": float(per_sequence["debug"]["upscaling_deg"]),
-                "temporal_deg": float(per_sequence["debug"]["temporal_deg"]),
+                "coding_deg": float(per_sequence["debug"]["coding_deg"][0]),
+                "upscaling_deg": float(per_sequence["debug"]["upscaling_deg"][0]),
+                "temporal_deg": float(per_sequence["debug"]["temporal_deg"][0]),
             },
             "date": str(datetime.datetime.now()),
             "model": "bitstream_mode1",
@@ -1,5 +1,351 @@
+import os
+import numpy as np
+import pandas as pd
+
 from bitstream_mode1 import __version__
+from bitstream_mode1.generic import DEFAULT_MODEL
+from bitstream_mode1.model import BitstreamMode1
+from bitstream_mode1.modelutils import load_coefficients
 
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def test_calculate_reference_values():
+    features = pd.DataFrame(
+        [
+            {
+                "Codec": codec,
+                "Resolution": resolution,
+                "Framerate": framerate,
+                "IFrameRatio": {"mean_noniframesize": noni_mean, "iframe_noniframe_ratio_mean": ratio},
+            }
+            for codec, resolution, framerate, noni_mean, ratio in [
+                ("h264", 1920 * 1080, 30.0, 5000.0, 8.0),
+                ("hevc", 1280 * 720, 60.0, 2500.0, 5.5),
+                ("vp9", 3840 * 2160, 24.0, 20000.0, 12.0),
+            ]
+        ]
+    )
+    res = BitstreamMode1()._calculate(features, load_coefficients(DEFAULT_MODEL), 3840 * 2160, "pc")
+    np.testing.assert_allclose(res["final_pred"], [2.9143807989054342, 2.741677838379958, 4.038112428926439], rtol=1e-12)
+    np.testing.assert_allclose(res["debug"]["coding_deg"], [45.874793087505076, 38.208367073076204, 34.507566813271055], rtol=1e-12)
+
+
+def test_r_from_mos_is_array_native():
+    from bitstream_mode1.modelutils import R_FROM_MOS_KEYS, R_FROM_MOS_VALUES, r_from_mos, mos_from_r
+
+    assert np.array_equal(r_from_mos(np.array(R_FROM_MOS_KEYS)), R_FROM_MOS_VALUES)
+    x = np.linspace(-5, 105, 101)
+    assert np.array_equal(mos_from_r(x), [mos_from_r(float(v)) for v in x])
+
+
+def test_probe_cache(tmp_path):
+    from bitstream_mode1.utils import ProbeCache
+
+    video = tmp_path / "video.mkv"
+    video.write_bytes(b"0" * 10)
+    cache = ProbeCache(str(tmp_path / "ffprobe_cache.sqlite"))
+    assert cache.get(str(video)) is None
+    cache.put(str(video), {"codec": "hevc"})
+    assert cache.get(str(video)) == {"codec": "hevc"}
+    os.utime(video, ns=(0, 0))
+    assert cache.get(str(video)) is None
+
+
+def test_feature_cache(tmp_path):
+    from bitstream_mode1.utils import FeatureCache
+
+    video = tmp_path / "video.mkv"
+    video.write_bytes(b"0" * 10)
+    cache = FeatureCache(str(tmp_path / "features"), "v1")
+    assert cache.get(str(video)) is None
+    cache.put(str(video), {"features": {"Codec": "h264", "IFrameRatio": {"mean": 1.5}, "sizes": np.arange(3)}, "duration": 10})
+
+    # entries are content addressed, a copy of the video is found, other versions and contents are not
+    copy = tmp_path / "copy.mkv"
+    copy.write_bytes(b"0" * 10)
+    entry = cache.get(str(copy))
+    assert entry["features"]["Codec"] == "h264" and entry["features"]["IFrameRatio"]["mean"] == 1.5 and entry["duration"] == 10
+    assert np.array_equal(entry["features"]["sizes"], np.arange(3))
+    assert FeatureCache(str(tmp_path / "features"), "v2").get(str(video)) is None
+    video.write_bytes(b"1" * 10)
+    assert cache.get(str(video)) is None
+
+    # least recently used entries are removed above max_size
+    small = FeatureCache(str(tmp_path / "features"), "v1", max_size=1)
+    small.put(str(video), {"duration": 20})
+    assert len(os.listdir(tmp_path / "features")) == 0
+
+
+def test_packet_and_frame_info_are_equivalent(tmp_path):
+    from bitstream_mode1.features import PVS, IFrameRatio
+    from bitstream_mode1.utils import json_store
+
+    rng = np.random.default_rng(0)
+    keyframes = np.arange(240) % 48 == 0
+    sizes = np.where(keyframes, rng.integers(40000, 90000, 240), rng.integers(2000, 9000, 240))
+    json_store(tmp_path / "frames.json", {"frames": [{"pict_type": "I" if k else "P", "pkt_size": str(s)} for k, s in zip(keyframes, sizes)]})
+    json_store(tmp_path / "packets.json", {"packets": [{"flags": "K_" if k else "__", "size": str(s)} for k, s in zip(keyframes, sizes)]})
+
+    frames = IFrameRatio().calculate(PVS("video.mkv", {}, str(tmp_path / "frames.json")))
+    packets = IFrameRatio().calculate(PVS("video.mkv", {}, str(tmp_path / "packets.json")))
+    assert frames.keys() == packets.keys()
+    for k in frames:
+        assert np.allclose(frames[k], packets[k], equal_nan=True)
+
+
+def test_parse_frame_info():
+    from bitstream_mode1.extract_video_frame_info import parse_frame_info
+    from bitstream_mode1.utils import parse_ffprobe_result
+
+    lines = [
+        "packet|pts_time=0.000000|dts_time=-0.040000|duration_time=0.040000|size=50000|flags=K_\n",
+        "packet|pts_time=0.080000|dts_time=0.000000|duration_time=0.040000|size=4000|flags=__\n",
+        "packet|pts_time=N/A|dts_time=0.040000|duration_time=0.040000|size=3000|flags=__\n",
+        "stream|codec_name=hevc|profile=Main|width=1280|height=720|pix_fmt=yuv420p|avg_frame_rate=25/1|bits_per_raw_sample=N/A\n",
+        "format|duration=0.120000|bit_rate=1000000\n",
+    ]
+    res, frame_table = parse_frame_info(lines)
+    assert frame_table["size"].tolist() == [50000, 4000, 3000]
+    assert bytes(frame_table["pict_type"]) == b"I??"
+    assert np.isnan(frame_table["pts_time"][2])
+    ffprobe_result = parse_ffprobe_result(res)
+    assert ffprobe_result["codec"] == "hevc"
+    assert ffprobe_result["width"] * ffprobe_result["height"] == 1280 * 720
+    assert ffprobe_result["avg_frame_rate"] == 25
+
+
+def test_frame_table_roundtrip(tmp_path):
+    from bitstream_mode1.features import PVS, IFrameRatio
+    from bitstream_mode1.frame_table import save_frame_table, load_frame_table
+
+    video = tmp_path / "video.mkv"
+    video.write_bytes(b"0")
+    rng = np.random.default_rng(0)
+    keyframes = np.arange(240) % 48 == 0
+    frame_table = {
+        "size": np.where(keyframes, rng.integers(40000, 90000, 240), rng.integers(2000, 9000, 240)),
+        "pict_type": np.where(keyframes, ord("I"), ord("P")).astype(np.uint8),
+        "pts_time": np.arange(240) / 24,
+        "dts_time": np.arange(240) / 24,
+        "duration_time": np.full(240, 1 / 24),
+        "method": "frames",
+    }
+    save_frame_table(str(tmp_path / "video_frames.npy"), frame_table, {"codec": "h264"}, str(video))
+    ffprobe_result, stored = load_frame_table(str(tmp_path / "video_frames.npy"), str(video))
+    assert ffprobe_result == {"codec": "h264"}
+    assert stored["method"] == "frames"
+    for column in ["size", "pict_type", "pts_time", "dts_time", "duration_time"]:
+        assert np.array_equal(stored[column], frame_table[column])
+
+    features = IFrameRatio().calculate(PVS(str(video), ffprobe_result, frame_table))
+    assert features == IFrameRatio().calculate(PVS(str(video), ffprobe_result, str(tmp_path / "video_frames.npy")))
+
+    video.write_bytes(b"01")
+    assert load_frame_table(str(tmp_path / "video_frames.npy"), str(video)) is None
+
+
+def test_iframe_ratio_accumulator_matches_exact_features():
+    from bitstream_mode1.features import PVS, IFrameRatio, IFrameRatioAccumulator
+
+    rng = np.random.default_rng(1)
+    keyframes = np.arange(20000) % 60 == 0
+    frame_table = {
+        "size": np.where(keyframes, rng.lognormal(11, 0.3, 20000), rng.lognormal(8.5, 0.8, 20000)).astype(np.int64),
+        "pict_type": np.where(keyframes, ord("I"), ord("P")).astype(np.uint8),
+    }
+    exact = IFrameRatio().calculate(PVS("video.mkv", {}, frame_table))
+
+    accumulators = [
+        IFrameRatioAccumulator().update_frame_table({k: v[start : start + 3000] for k, v in frame_table.items()})
+        for start in range(0, 20000, 3000)
+    ]
+    accumulator = accumulators[0]
+    for other in accumulators[1:]:
+        accumulator.merge(other)
+    streamed = accumulator.calculate()
+
+    assert streamed.keys() == exact.keys()
+    for k in exact:
+        # moments are exact, percentiles are estimated
+        tolerance = 1e-9 if "percentile" not in k and "median" not in k and "iqr" not in k else 1e-2
+        assert np.isclose(streamed[k], exact[k], rtol=tolerance), k
+
+
+def test_iter_frame_info_chunks():
+    from bitstream_mode1.extract_video_frame_info import iter_frame_info
+
+    lines = [f"packet|pts_time={i / 25}|dts_time={i / 25}|duration_time=0.04|size={i + 1}|flags={'K_' if i % 10 == 0 else '__'}" for i in range(25)]
+    res = {}
+    chunks = list(iter_frame_info(lines + ["stream|codec_name=h264|width=640|height=360|avg_frame_rate=25/1"], res, chunk_size=10))
+    assert [len(chunk["size"]) for chunk in chunks] == [10, 10, 5]
+    assert np.concatenate([chunk["size"] for chunk in chunks]).tolist() == list(range(1, 26))
+    assert res["streams"][0]["width"] == 640
+
+
+def test_iter_segments(tmp_path):
+    from bitstream_mode1.follow import iter_segments
+
+    for name in ["init.mp4", "seg_1.mp4", "seg_2.mp4"]:
+        (tmp_path / name).write_bytes(b"0")
+    playlist = tmp_path / "live.m3u8"
+    playlist.write_text('#EXTM3U\n#EXT-X-MAP:URI="init.mp4"\n#EXTINF:4.0,\nseg_1.mp4\n#EXTINF:4.0,\nseg_2.mp4\n#EXT-X-ENDLIST\n')
+    segments = list(iter_segments(str(playlist), poll_interval=0.01))
+    assert segments == [(str(tmp_path / "seg_1.mp4"), str(tmp_path / "init.mp4")), (str(tmp_path / "seg_2.mp4"), str(tmp_path / "init.mp4"))]
+
+    # segments of a folder are used once their size is stable
+    folder = tmp_path / "segments"
+    folder.mkdir()
+    (folder / "seg_1.ts").write_bytes(b"0")
+    assert [s for s, _ in iter_segments(str(folder), poll_interval=0.01, idle_timeout=0.1)] == [str(folder / "seg_1.ts")]
+
+
+def test_per_interval_frame_sizes():
+    from bitstream_mode1.features import per_interval_frame_sizes
+
+    rng = np.random.default_rng(2)
+    frames = 250
+    keyframes = np.arange(frames) % 48 == 0
+    frame_table = {
+        "size": rng.integers(1000, 90000, frames),
+        "pict_type": np.where(keyframes, ord("I"), ord("P")).astype(np.uint8),
+        # decoding order with b-frames, presentation timestamps are not sorted
+        "pts_time": (np.arange(frames) + np.where(np.arange(frames) % 3 == 1, 1, np.where(np.arange(frames) % 3 == 2, -1, 0))) / 25,
+        "dts_time": np.arange(frames) / 25,
+        "duration_time": np.full(frames, 1 / 25),
+    }
+    res = per_interval_frame_sizes(frame_table, duration=10.0, interval=2)
+    assert len(res["mean_noniframesize"]) == 5
+
+    times = frame_table["pts_time"] - frame_table["pts_time"].min()
+    window = np.minimum(times // 2, 4)
+    sizes = frame_table["size"]
+    for w in range(5):
+        noni = sizes[(window == w) & ~keyframes]
+        i = sizes[(window == w) & keyframes]
+        i_mean = i.mean() if len(i) > 0 else sizes[keyframes].mean()
+        assert np.isclose(res["mean_noniframesize"][w], noni.mean())
+        assert np.isclose(res["iframe_noniframe_ratio_mean"][w], i_mean / noni.mean())
+
+
+def test_iframe_ratio_matches_numpy_and_scipy():
+    import scipy.stats
+    from bitstream_mode1.features import PVS, IFrameRatio
+
+    rng = np.random.default_rng(3)
+    keyframes = np.arange(5000) % 60 == 0
+    frame_table = {"size": rng.integers(100, 90000, 5000), "pict_type": np.where(keyframes, ord("I"), ord("P")).astype(np.uint8)}
+    res = IFrameRatio().calculate(PVS("video.mkv", {}, frame_table))
+    for name, sizes in [("iframesize", frame_table["size"][keyframes]), ("noniframesize", frame_table["size"][~keyframes])]:
+        assert np.isclose(res[f"mean_{name}"], np.mean(sizes), rtol=1e-12)
+        assert np.isclose(res[f"std_{name}"], np.std(sizes), rtol=1e-12)
+        assert np.isclose(res[f"median_{name}"], np.median(sizes), rtol=1e-12)
+        assert np.isclose(res[f"kurtosis_{name}"], scipy.stats.kurtosis(sizes), rtol=1e-9)
+        assert np.isclose(res[f"iqr_{name}"], scipy.stats.iqr(sizes), rtol=1e-12)
+        for percentile in range(0, 101, 10):
+            assert np.isclose(res[f"{percentile}_percentile_{name}"], np.percentile(sizes, percentile), rtol=1e-12)
+    assert np.isclose(res["norm_mean_all"], np.mean(frame_table["size"] / frame_table["size"].max()), rtol=1e-12)
+
+
+def test_extract_features_batch_matches_single_videos():
+    from bitstream_mode1.features import PVS, IFrameRatio, extract_features_batch
+
+    rng = np.random.default_rng(4)
+    frame_tables, ffprobe_results = [], []
+    for i in range(30):
+        frames = int(rng.integers(1, 200))
+        keyframes = np.arange(frames) % 24 == 0
+        frame_tables.append({"size": rng.integers(500, 90000, frames), "pict_type": np.where(keyframes, ord("I"), ord("P")).astype(np.uint8)})
+        ffprobe_results.append({"bitrate": "1000000", "avg_frame_rate": 24, "width": 1280, "height": 720, "codec": "vp9", "duration": "8"})
+    features = extract_features_batch([f"video_{i}.mkv" for i in range(30)], ffprobe_results, frame_tables)
+    assert len(features) == 30
+
+    for i, frame_table in enumerate(frame_tables):
+        single = IFrameRatio().calculate(PVS(f"video_{i}.mkv", ffprobe_results[i], frame_table))
+        for k in ["mean_iframesize", "std_noniframesize", "iframe_noniframe_ratio_mean", "ratio_std"]:
+            assert np.isclose(features["IFrameRatio_" + k].values[i], single[k], rtol=1e-12, equal_nan=True)
+    assert features["Resolution"].values[0] == 1280 * 720
+
+
+def test_invalid_inputs_raise_and_are_isolated_in_batches(tmp_path):
+    import pytest
+    from bitstream_mode1 import iter_predict
+    from bitstream_mode1 import predict_quality
+    from bitstream_mode1.utils import InvalidInputError
+
+    missing = str(tmp_path / "missing.mkv")
+    with pytest.raises(InvalidInputError):
+        predict_quality(missing, DEFAULT_MODEL, temporary_folder=str(tmp_path))
+    with pytest.raises(InvalidInputError):
+        BitstreamMode1().predict_quality(missing, DEFAULT_MODEL, device_type="unknown", temporary_folder=str(tmp_path))
+
+    results = list(iter_predict([missing, missing], DEFAULT_MODEL, temporary_folder=str(tmp_path), cpu_count=2))
+    assert [r["status"] for r in results] == ["failed", "failed"]
+    assert results[0]["video_full_path"] == missing and results[0]["error_type"] == "InvalidInputError"
+
+
+def test_frame_info_parser_matches_parse_frame_info(tmp_path):
+    import asyncio
+    import sys
+    from bitstream_mode1.extract_video_frame_info import FrameInfoParser, parse_frame_info
+    from bitstream_mode1.utils import ProbeScheduler
+
+    lines = [f"packet|pts_time={i / 25:.6f}|dts_time={i / 25:.6f}|duration_time=0.040000|size={1000 + i}|flags=__\n" for i in range(10000)]
+    lines.append("stream|codec_name=h264|profile=High|width=1920|height=1080|pix_fmt=yuv420p|avg_frame_rate=25/1|bits_per_raw_sample=8\n")
+    lines.append("format|duration=400.000000|bit_rate=1000000\n")
+    res, frame_table = parse_frame_info(lines)
+
+    # the output of a program is parsed in batches while it runs
+    (tmp_path / "frame_info.txt").write_text("".join(lines))
+    cmd = [sys.executable, "-c", "import sys; sys.stdout.write(open(sys.argv[1]).read())", str(tmp_path / "frame_info.txt")]
+    parsed_res, parsed_table = asyncio.run(ProbeScheduler().run(cmd, parser=FrameInfoParser))
+    assert parsed_res == res
+    for column in frame_table:
+        assert np.array_equal(parsed_table[column], frame_table[column])
+
+
+def test_follow_survives_deleted_and_failing_segments(tmp_path, monkeypatch):
+    from bitstream_mode1 import follow as follow_module
+    from bitstream_mode1.extract_video_frame_info import parse_frame_info
+    from bitstream_mode1.utils import parse_ffprobe_result
+
+    folder = tmp_path / "segments"
+    folder.mkdir()
+    for name in ["seg_1.ts", "seg_2.ts", "seg_3.ts"]:
+        (folder / name).write_bytes(b"0")
+
+    # seg_3.ts is removed by the encoder (sliding window) while the folder is listed
+    getmtime = os.path.getmtime
+
+    def deleted_getmtime(f):
+        if f.endswith("seg_3.ts"):
+            raise FileNotFoundError(f)
+        return getmtime(f)
+
+    monkeypatch.setattr(follow_module.os.path, "getmtime", deleted_getmtime)
+
+    sizes = [50000 + 100 * i if i % 25 == 0 else 4000 + 10 * i for i in range(100)]
+    lines = [
+        f"packet|pts_time={i / 25:.6f}|dts_time={i / 25:.6f}|duration_time=0.040000|size={size}|flags=__\n" for i, size in enumerate(sizes)
+    ]
+    lines += [
+        "stream|codec_name=h264|profile=High|width=1920|height=1080|pix_fmt=yuv420p|avg_frame_rate=25/1|bits_per_raw_sample=8\n",
+        "format|duration=4.000000|bit_rate=1000000\n",
+    ]
+    res, frame_table = parse_frame_info(lines)
+    frame_table["pict_type"] = np.where(np.arange(100) % 25 == 0, ord("I"), ord("P")).astype(np.uint8)
+    ffprobe_result = parse_ffprobe_result(res)
+
+    def probe_segment(segment, init, frame_info, temporary_folder):
+        if segment.endswith("seg_1.ts"):
+            # fails after probing, during the feature extraction
+            return dict(ffprobe_result, duration=None), frame_table
+        return ffprobe_result, frame_table
+
+    monkeypatch.setattr(follow_module, "_probe_segment", probe_segment)
+    reports = list(follow_module.follow(str(folder), temporary_folder=str(tmp_path / "tmp"), poll_interval=0.01, idle_timeout=0.1))
+    assert [(r["segment_index"], r.get("status")) for r in reports] == [(0, "failed"), (1, None)]
+    # the failed segment does not count for the running state
+    assert reports[1]["start"] == 0 and reports[1]["running_per_sequence"] == reports[1]["per_sequence"]
@@ -10,7 +10,211 @@ import sys
 import shutil
 import json
 import logging
+import datetime
 import subprocess
+import tempfile
+import threading
+import asyncio
+import weakref
+
+
+class HybridError(Exception):
+    """ base class of all errors for inputs that can not be handled, one failing video never stops a batch """
+
+
+class InvalidInputError(HybridError, ValueError):
+    """ missing input file or invalid parameter """
+
+
+class UnsupportedVideoError(HybridError):
+    """ valid video that is not supported, e.g. because of its video codec """
+
+
+class ProcessError(HybridError):
+    """ external program (e.g. ffmpeg) failed or timed out, see run """
+
+    def __init__(self, message, cmd=None, returncode=None, timed_out=False, attempts=0, stderr=""):
+        super().__init__(message)
+        self.cmd = cmd
+        self.returncode = returncode
+        self.timed_out = timed_out
+        self.attempts = attempts
+        self.stderr = stderr
+
+    def details(self):
+        return {
+            "cmd": self.cmd,
+            "returncode": self.returncode,
+            "timed_out": self.timed_out,
+            "attempts": self.attempts,
+            "stderr": self.stderr,
+        }
+
+
+def error_record(videofilename, error):
+    """ result of an input that could not be processed, with status unsupported (see UnsupportedVideoError) or failed """
+    return {
+        "video_full_path": videofilename,
+        "status": "unsupported" if isinstance(error, UnsupportedVideoError) else "failed",
+        "error": str(error),
+        "error_type": type(error).__name__,
+        "error_details": error.details() if isinstance(error, ProcessError) else None,
+        "date": str(datetime.datetime.now()),
+    }
+
+
+# timeouts of the stages that run external programs as (seconds, additional seconds per MiB of the input file),
+# so that a stuck call on a truncated or pathological file is killed instead of blocking a worker forever
+PROCESS_TIMEOUTS = {
+    "encode": (120, 10),
+}
+# number of retries of a failed call, calls that timed out are not retried
+PROCESS_RETRIES = 1
+
+
+def stage_timeout(stage, filename=None):
+    """ timeout in seconds of a stage (see PROCESS_TIMEOUTS), scaled by the size of the input file """
+    seconds, per_mib = PROCESS_TIMEOUTS[stage]
+    if filename is not None and os.path.isfile(filename):
+        seconds += per_mib * os.path.getsize(filename) / 1024 ** 2
+    return seconds
+
+
+def run(cmd, timeout=None, retries=PROCESS_RETRIES, parse=None, exception=ProcessError):
+    """
+    run a program without shell and return its output, it is killed if it does not finish within timeout seconds,
+    failed calls are retried up to retries times
+    @param cmd: program and command line parameter list, e.g. run(["ls", "/"])
+    @param parse: function that consumes the stdout stream while the program runs, its result is returned instead of the output
+    @return stdout of the program or the result of parse
+    @raise exception (ProcessError or a subclass) with command, return code, timeout flag, attempts and the end of stderr
+    """
+    for attempt in range(1, retries + 2):
+        # stderr is written to a file, so that a program with lots of warnings can not block on a full pipe
+        with tempfile.TemporaryFile(mode="w+") as stderr:
+            try:
+                process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, universal_newlines=True)
+            except OSError as e:
+                raise exception(f"{cmd[0]} could not be started: {e}", cmd, attempts=attempt)
+            killed = threading.Event()
+
+            def kill():
+                killed.set()
+                process.kill()
+
+            timer = threading.Timer(timeout, kill) if timeout is not None else None
+            if timer is not None:
+                timer.start()
+            try:
+                with process:
+                    try:
+                        result = parse(process.stdout) if parse is not None else process.stdout.read()
+                        # remaining output of an early returning parse function is discarded
+                        process.stdout.read()
+                    except BaseException:
+                        process.kill()
+                        raise
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            timed_out = killed.is_set()
+            if process.returncode == 0 and not timed_out:
+                return result
+            stderr.seek(0)
+            message = stderr.read()[-2000:]
+
+        if timed_out:
+            raise exception(f"{cmd[0]} timed out after {timeout:.1f}s: {' '.join(cmd)}", cmd, process.returncode, True, attempt, message)
+        logging.warning(f"{cmd[0]} failed with return code {process.returncode} (attempt {attempt}): {message.strip()}")
+    raise exception(
+        f"{cmd[0]} failed with return code {process.returncode}: {' '.join(cmd)}", cmd, process.returncode, False, attempt, message
+    )
+
+
+# number of external programs that a ProbeScheduler runs at the same time by default
+DEFAULT_PROBE_CONCURRENCY = 64
+# number of re-encodings that an EncodeScheduler runs at the same time by default,
+# each re-encoding uses 4 threads (see hybrid.re_encode_video)
+DEFAULT_ENCODE_CONCURRENCY = max(1, (os.cpu_count() or 1) // 4)
+
+
+class ProbeScheduler:
+    """
+    asyncio engine for external programs (e.g. ffmpeg) that are started with asyncio.create_subprocess_exec,
+    at most concurrency programs run at the same time, timeouts, retries and errors are handled as by run
+    """
+
+    _default = weakref.WeakKeyDictionary()
+
+    def __init__(self, concurrency=DEFAULT_PROBE_CONCURRENCY):
+        self._concurrency = concurrency
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def default(cls):
+        """ scheduler that is shared by all calls in the running event loop """
+        loop = asyncio.get_running_loop()
+        if loop not in cls._default:
+            cls._default[loop] = cls()
+        return cls._default[loop]
+
+    def _semaphore(self):
+        # created in the running loop, before python 3.10 a semaphore is bound to the loop it was created in
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self._concurrency)
+        return self._semaphores[loop]
+
+    async def _read(self, process):
+        output = (await process.stdout.read()).decode(errors="replace")
+        await process.wait()
+        return output
+
+    async def run(self, cmd, timeout=None, retries=PROCESS_RETRIES, exception=ProcessError):
+        """
+        asyncio version of run
+        @return stdout of the program
+        """
+        async with self._semaphore():
+            for attempt in range(1, retries + 2):
+                try:
+                    process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+                except OSError as e:
+                    raise exception(f"{cmd[0]} could not be started: {e}", cmd, attempts=attempt)
+                stderr = asyncio.ensure_future(process.stderr.read())
+                timed_out = False
+                try:
+                    result = await asyncio.wait_for(self._read(process), timeout)
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    process.kill()
+                except BaseException:
+                    # e.g. cancelled by the caller
+                    process.kill()
+                    await process.wait()
+                    stderr.cancel()
+                    raise
+                await process.wait()
+                message = (await stderr).decode(errors="replace")[-2000:]
+                if process.returncode == 0 and not timed_out:
+                    return result
+                if timed_out:
+                    raise exception(
+                        f"{cmd[0]} timed out after {timeout:.1f}s: {' '.join(cmd)}", cmd, process.returncode, True, attempt, message
+                    )
+                logging.warning(f"{cmd[0]} failed with return code {process.returncode} (attempt {attempt}): {message.strip()}")
+        raise exception(
+            f"{cmd[0]} failed with return code {process.returncode}: {' '.join(cmd)}", cmd, process.returncode, False, attempt, message
+        )
+
+
+class EncodeScheduler(ProbeScheduler):
+    """ ProbeScheduler for cpu bound programs (e.g. ffmpeg re-encodings), bounded by the cpu count by default """
+
+    _default = weakref.WeakKeyDictionary()
+
+    def __init__(self, concurrency=DEFAULT_ENCODE_CONCURRENCY):
+        super().__init__(concurrency)
 
 
 def get_basename(filename):
@@ -26,3 +230,132 @@ def flat_name(filename):
     converts a given filename to a version without pathes
     """
     return filename.replace("../", "").replace("/", "_").replace("./", "").replace(".", "")
+
+
+def stream_reports(results, result_folder):
+    """
+    print results as one json list and store each result as `<result_folder>/<video_basename>.json`
+    as soon as it is available, results without video_basename (e.g. not processed videos) are only printed
+    @return number of stored reports
+    """
+    os.makedirs(result_folder, exist_ok=True)
+    stored = 0
+    print("[", flush=True)
+    try:
+        for i, result in enumerate(results):
+            print(("," if i > 0 else "") + json.dumps(result, indent=4, sort_keys=True), flush=True)
+            if result == {} or "video_basename" not in result:
+                continue
+            reportname = os.path.join(result_folder, os.path.splitext(result["video_basename"])[0] + ".json")
+            with open(reportname, "w") as report:
+                json.dump(result, report, indent=4, sort_keys=True)
+            stored += 1
+    finally:
+        print("]", flush=True)
+    return stored
+
+
+def file_identity(filename):
+    """ identity of a file as (realpath, size, mtime_ns, inode), it changes whenever the file is modified or replaced
+    """
+    stat = os.stat(filename)
+    return (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+JOURNAL_FILENAME = "journal.ndjson"
+
+
+class Journal:
+    """
+    append-only journal of a batch run in the result folder, one json line per processed input
+    with its identity (see file_identity), the run settings and the outcome (ok, failed or unsupported);
+    a restarted run skips all inputs that are recorded for the same settings and did not change since
+    """
+
+    def __init__(self, folder, settings):
+        os.makedirs(folder, exist_ok=True)
+        self._filename = os.path.join(folder, JOURNAL_FILENAME)
+        # settings are compared as they are stored
+        self._settings = json.loads(json.dumps(settings))
+        self._recorded = {}
+        self._identities = {}
+        if not os.path.isfile(self._filename):
+            return
+        with open(self._filename) as journal:
+            content = journal.read()
+        for line in content.splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # incomplete line of an interrupted run
+                continue
+            if entry.get("settings") == self._settings:
+                self._recorded[entry["video"]] = (entry["identity"], entry["status"])
+        if content != "" and not content.endswith("\n"):
+            with open(self._filename, "a") as journal:
+                journal.write("\n")
+
+    def status(self, videofilename):
+        """ recorded status of an unchanged input, None if it has to be processed """
+        try:
+            identity = list(file_identity(videofilename))
+        except OSError:
+            return None
+        recorded = self._recorded.get(identity[0])
+        if recorded is None or recorded[0] != identity:
+            return None
+        return recorded[1]
+
+    def pending(self, videofilenames, skip_processed=True):
+        """ all inputs that are not yet processed (or all if skip_processed is False), their identities are kept for the journal entries """
+        pending = []
+        for videofilename in videofilenames:
+            status = self.status(videofilename) if skip_processed else None
+            if status is not None:
+                logging.info(f"{videofilename} is already processed ({status}), it will be skipped")
+                continue
+            try:
+                self._identities[videofilename] = list(file_identity(videofilename))
+            except OSError:
+                self._identities[videofilename] = None
+            pending.append(videofilename)
+        return pending
+
+    def record(self, videofilename, status, message=None):
+        identity = self._identities.get(videofilename)
+        entry = {
+            "video": identity[0] if identity else os.path.realpath(videofilename),
+            "identity": identity,
+            "settings": self._settings,
+            "status": status,
+            "message": message,
+            "date": str(datetime.datetime.now()),
+        }
+        with open(self._filename, "a") as journal:
+            journal.write(json.dumps(entry, sort_keys=True) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def track(self, results):
+        """
+        pass on each result of a generator, e.g. iter_predict, and record its outcome once the consumer
+        (e.g. stream_reports) asks for the next result, i.e. after it has stored the report;
+        consecutive results of one input with several variants (e.g. a manifest) are recorded once after the last one
+        """
+        # input of the variants passed on so far, as (video, status, message)
+        variants = None
+        for result in results:
+            video = result.get("video_full_path")
+            if variants is not None and variants[0] != video:
+                self.record(*variants)
+                variants = None
+            yield result
+            if video not in self._identities:
+                continue
+            status = "ok" if "per_sequence" in result else result.get("status", "failed")
+            if "variant" in result:
+                variants = (video, status, result.get("error")) if variants is None or status != "ok" else variants
+            else:
+                self.record(video, status, result.get("error"))
+        if variants is not None:
+            self.record(*variants)
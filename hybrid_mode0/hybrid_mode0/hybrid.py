@@ -9,6 +9,7 @@ import json
 import multiprocessing
 import logging
 import itertools
+import asyncio
 
 from .file_utils import *
 from . import __version__
@@ -19,6 +20,54 @@ from p1204_3.generic import *
 
 from p1204_3.utils import *
 
+# error handling of this package, imported after p1204_3.utils so that it is not shadowed
+from .file_utils import HybridError
+from .file_utils import ProcessError
+from .file_utils import InvalidInputError
+from .file_utils import EncodeScheduler
+from .file_utils import UnsupportedVideoError
+from .file_utils import error_record
+from .file_utils import file_identity
+from .file_utils import run
+from .file_utils import stage_timeout
+
+
+def _re_encode_cmd(videofilename, encoder, video_bitrate, video_width, video_height, video_framerate, output_video):
+    return [
+        "ffmpeg",
+        "-nostdin",
+        "-loglevel",
+        "error",
+        "-threads",
+        "4",
+        "-y",
+        "-i",
+        videofilename,
+        "-c:v",
+        encoder,
+        "-b:v",
+        str(video_bitrate),
+        "-vf",
+        f"scale={video_width}:{video_height}",
+        "-r",
+        str(video_framerate),
+        "-pix_fmt",
+        "yuv420p",
+        "-an",
+        output_video,
+    ]
+
+
+def _partial_video(videofilename, re_encoded_video):
+    """ partial file of a re-encoding, None if the video has already been re-encoded """
+    if os.path.isfile(re_encoded_video):
+        logging.warn(
+            f"{videofilename} has been alreadyy reencoded with these settings, see {re_encoded_video}; please check, encoding settings may vary, however the encoding step will be skipped"
+        )
+        return None
+    # the video is encoded to a partial file first, so that a killed or failed encoding is never used as cached re-encode
+    return os.path.splitext(re_encoded_video)[0] + ".part" + os.path.splitext(re_encoded_video)[1]
+
 
 def re_encode_video(
     videofilename,
@@ -29,58 +78,59 @@ def re_encode_video(
     video_framerate,
     re_encoded_video,
 ):
-    if os.path.isfile(re_encoded_video):
-        logging.warn(
-            f"{videofilename} has been alreadyy reencoded with these settings, see {re_encoded_video}; please check, encoding settings may vary, however the encoding step will be skipped"
-        )
+    partial_video = _partial_video(videofilename, re_encoded_video)
+    if partial_video is None:
         return
-    cmd = " ".join(
-        f"""
-        ffmpeg -nostdin -loglevel quiet -threads 4 -y -i
-        '{videofilename}'
-        -c:v {encoder}
-        -b:v {video_bitrate}
-        -vf scale="{video_width}:{video_height}"
-        -r {video_framerate}
-        -pix_fmt yuv420p
-        -an "{re_encoded_video}" 2>/dev/null
-    """.split()
-    )
+    cmd = _re_encode_cmd(videofilename, encoder, video_bitrate, video_width, video_height, video_framerate, partial_video)
 
     logging.debug(f"encoding command = {cmd}")
-    res = shell_call(cmd).strip()
+    try:
+        res = run(cmd, stage_timeout("encode", videofilename)).strip()
+    except ProcessError:
+        if os.path.isfile(partial_video):
+            os.remove(partial_video)
+        raise
+    os.replace(partial_video, re_encoded_video)
     return res
 
 
-def hyn0_predict(
+async def re_encode_video_async(
     videofilename,
-    model,
-    device_type,
-    device_resolution,
-    viewing_distance,
-    display_size,
-    temporary_folder,
-    cache_features,
+    encoder,
     video_bitrate,
     video_width,
     video_height,
     video_framerate,
-    video_codec,
-    temporary_re_encoded_video_folder,
-    cache_reencodes,
-    hybrid_model_type,
+    re_encoded_video,
+    scheduler=None,
 ):
-    logging.info(f"handle videofilename = {videofilename}")
+    """ asyncio version of re_encode_video, ffmpeg is run by scheduler (EncodeScheduler.default() if None) """
+    partial_video = _partial_video(videofilename, re_encoded_video)
+    if partial_video is None:
+        return
+    cmd = _re_encode_cmd(videofilename, encoder, video_bitrate, video_width, video_height, video_framerate, partial_video)
 
-    assert_msg(
-        hybrid_model_type in [1, 2],
-        f"hybrid_model_type={hybrid_model_type} not valid, must be in [1,2]",
-    )
-    assert_file(videofilename, f"videofilename={videofilename} does not exist")
-    assert_msg(
-        not (hybrid_model_type == 1 and video_codec is None),
-        f"for hybrid_model_type 1 you need to specify a vidoe_codec",
-    )
+    logging.debug(f"encoding command = {cmd}")
+    scheduler = scheduler or EncodeScheduler.default()
+    try:
+        res = (await scheduler.run(cmd, stage_timeout("encode", videofilename))).strip()
+    except BaseException:
+        # also a cancelled encoding must not leave a partial file behind
+        if os.path.isfile(partial_video):
+            os.remove(partial_video)
+        raise
+    os.replace(partial_video, re_encoded_video)
+    return res
+
+
+def _encoder(videofilename, video_codec, hybrid_model_type):
+    """ check the hybrid settings and select the encoder of the re-encoding """
+    if hybrid_model_type not in [1, 2]:
+        raise InvalidInputError(f"hybrid_model_type={hybrid_model_type} not valid, must be in [1,2]")
+    if not os.path.isfile(videofilename):
+        raise InvalidInputError(f"videofilename={videofilename} does not exist")
+    if hybrid_model_type == 1 and video_codec is None:
+        raise InvalidInputError(f"for hybrid_model_type 1 you need to specify a vidoe_codec")
 
     encoder_mapping = {
         "h264": "libx264",
@@ -90,43 +140,39 @@ def hyn0_predict(
     }
 
     # hybrid_model_type == 2 uses h265 as target video codec
-    encoder = "libx265" if hybrid_model_type == 2 else encoder_mapping[video_codec]
+    encoder = "libx265" if hybrid_model_type == 2 else encoder_mapping.get(video_codec)
+
+    if encoder is None:
+        raise UnsupportedVideoError(f"video_codec={video_codec} not yet supported, use hybrid_model_type = 2")
+    return encoder
 
-    assert_msg(
-        encoder is not None,
-        f"video_codec={video_codec} not yet supported, use hybrid_model_type = 2",
-    )
 
-    encoding_params = "_".join(map(str, [video_bitrate, video_width, video_height, video_framerate, encoder]))
+def _encoding_params(video_bitrate, video_width, video_height, video_framerate, encoder):
+    return "_".join(map(str, [video_bitrate, video_width, video_height, video_framerate, encoder]))
 
+
+def _re_encoded_video(videofilename, encoding_params, temporary_re_encoded_video_folder):
     re_encoded_video = os.path.join(
         temporary_re_encoded_video_folder,
         flat_name(get_basename(videofilename)) + "_settings_" + encoding_params + ".mkv",
     )
     logging.info(f"re_encoded_video = {re_encoded_video}")
+    return re_encoded_video
 
-    re_encode_video(
-        videofilename,
-        encoder,
-        video_bitrate,
-        video_width,
-        video_height,
-        video_framerate,
-        re_encoded_video,
-    )
-
-    logging.info(f"predict quality of {re_encoded_video}")
-    prediction = p1204_3_predict_quality(
-        re_encoded_video,
-        model,
-        device_type,
-        device_resolution,
-        viewing_distance,
-        display_size,
-        temporary_folder,
-        cache_features,
-    )
 
+def _hybrid_prediction(
+    prediction,
+    videofilename,
+    video_bitrate,
+    video_width,
+    video_height,
+    video_framerate,
+    video_codec,
+    encoder,
+    hybrid_model_type,
+):
+    """ report of the hybrid model based on the p1204_3 prediction of the re-encoded video """
+    encoding_params = _encoding_params(video_bitrate, video_width, video_height, video_framerate, encoder)
     prediction["model"] = "hybrid_type_" + str(hybrid_model_type)
     prediction["version"] = __version__
     prediction["video_basename"] = os.path.basename(videofilename) + encoding_params
@@ -142,9 +188,6 @@ def hyn0_predict(
 
     logging.debug(prediction)
 
-    if not cache_reencodes:
-        os.remove(re_encoded_video)
-
     if hybrid_model_type == 1:
         # for hybrid_model_type 1 no correction is performed
         return prediction
@@ -173,6 +216,206 @@ def hyn0_predict(
     return prediction
 
 
+def hyn0_predict(
+    videofilename,
+    model,
+    device_type,
+    device_resolution,
+    viewing_distance,
+    display_size,
+    temporary_folder,
+    cache_features,
+    video_bitrate,
+    video_width,
+    video_height,
+    video_framerate,
+    video_codec,
+    temporary_re_encoded_video_folder,
+    cache_reencodes,
+    hybrid_model_type,
+):
+    logging.info(f"handle videofilename = {videofilename}")
+
+    encoder = _encoder(videofilename, video_codec, hybrid_model_type)
+    encoding_params = _encoding_params(video_bitrate, video_width, video_height, video_framerate, encoder)
+    re_encoded_video = _re_encoded_video(videofilename, encoding_params, temporary_re_encoded_video_folder)
+
+    re_encode_video(
+        videofilename,
+        encoder,
+        video_bitrate,
+        video_width,
+        video_height,
+        video_framerate,
+        re_encoded_video,
+    )
+
+    logging.info(f"predict quality of {re_encoded_video}")
+    prediction = p1204_3_predict_quality(
+        re_encoded_video,
+        model,
+        device_type,
+        device_resolution,
+        viewing_distance,
+        display_size,
+        temporary_folder,
+        cache_features,
+    )
+
+    if not cache_reencodes:
+        os.remove(re_encoded_video)
+
+    return _hybrid_prediction(
+        prediction,
+        videofilename,
+        video_bitrate,
+        video_width,
+        video_height,
+        video_framerate,
+        video_codec,
+        encoder,
+        hybrid_model_type,
+    )
+
+
+async def predict_quality_async(
+    videofilename,
+    model,
+    device_type,
+    device_resolution,
+    viewing_distance,
+    display_size,
+    temporary_folder,
+    cache_features,
+    video_bitrate,
+    video_width,
+    video_height,
+    video_framerate,
+    video_codec,
+    temporary_re_encoded_video_folder,
+    cache_reencodes,
+    hybrid_model_type,
+    scheduler=None,
+    executor=None,
+):
+    """
+    asyncio version of hyn0_predict, the re-encoding is run by scheduler (EncodeScheduler.default() if None),
+    the p1204_3 prediction of the re-encoded video runs in executor (default executor of the event loop if None),
+    e.g. a concurrent.futures.ProcessPoolExecutor
+    """
+    logging.info(f"handle videofilename = {videofilename}")
+
+    encoder = _encoder(videofilename, video_codec, hybrid_model_type)
+    encoding_params = _encoding_params(video_bitrate, video_width, video_height, video_framerate, encoder)
+    re_encoded_video = _re_encoded_video(videofilename, encoding_params, temporary_re_encoded_video_folder)
+
+    await re_encode_video_async(
+        videofilename,
+        encoder,
+        video_bitrate,
+        video_width,
+        video_height,
+        video_framerate,
+        re_encoded_video,
+        scheduler,
+    )
+
+    logging.info(f"predict quality of {re_encoded_video}")
+    prediction = await asyncio.get_running_loop().run_in_executor(
+        executor,
+        p1204_3_predict_quality,
+        re_encoded_video,
+        model,
+        device_type,
+        device_resolution,
+        viewing_distance,
+        display_size,
+        temporary_folder,
+        cache_features,
+    )
+
+    if not cache_reencodes:
+        os.remove(re_encoded_video)
+
+    return _hybrid_prediction(
+        prediction,
+        videofilename,
+        video_bitrate,
+        video_width,
+        video_height,
+        video_framerate,
+        video_codec,
+        encoder,
+        hybrid_model_type,
+    )
+
+
+def _hyn0_predict(params):
+    # one video that can not be processed must not stop the whole batch
+    try:
+        return hyn0_predict(*params)
+    except HybridError as e:
+        logging.error(f"{params[0]} could not be processed: {e}")
+        return error_record(params[0], e)
+    except (Exception, SystemExit) as e:
+        # validation errors of p1204_3 exit, they must not end or wedge a pool worker
+        logging.exception(f"{params[0]} could not be processed")
+        return error_record(params[0], e)
+
+
+def iter_predict(
+    videofilenames,
+    model,
+    device_type,
+    device_resolution,
+    viewing_distance,
+    display_size,
+    temporary_folder,
+    cache_features,
+    video_bitrate,
+    video_width,
+    video_height,
+    video_framerate,
+    video_codec,
+    temporary_re_encoded_video_folder,
+    cache_reencodes,
+    hybrid_model_type,
+    cpu_count=multiprocessing.cpu_count(),
+):
+    """
+    re-encode and predict the quality of many videos with cpu_count worker processes, see hyn0_predict
+    @return generator of the predictions in completion order,
+        for videos that could not be processed an error record (see file_utils.error_record) is yielded
+    """
+    params = [
+        (
+            video,
+            model,
+            device_type,
+            device_resolution,
+            viewing_distance,
+            display_size,
+            temporary_folder,
+            cache_features,
+            video_bitrate,
+            video_width,
+            video_height,
+            video_framerate,
+            video_codec,
+            temporary_re_encoded_video_folder,
+            cache_reencodes,
+            hybrid_model_type,
+        )
+        for video in videofilenames
+    ]
+    logging.debug(params)
+    if cpu_count > 1 and len(params) > 1:
+        with multiprocessing.Pool(min(cpu_count, len(params))) as pool:
+            yield from pool.imap_unordered(_hyn0_predict, params)
+    else:
+        yield from map(_hyn0_predict, params)
+
+
 def main(_=[]):
     # argument parsing
     parser = argparse.ArgumentParser(
@@ -292,6 +535,11 @@ def main(_=[]):
         action="store_true",
         help="caching reencoded videos",
     )
+    parser.add_argument(
+        "--rerun",
+        action="store_true",
+        help="process all inputs again, also the ones that are already recorded in the journal of the result folder",
+    )
     parser.add_argument(
         "-q",
         "--quiet",
@@ -311,43 +559,47 @@ def main(_=[]):
 
     logging.info(f"handle the following videos (# {len(a['video'])}): \n  " + "\n  ".join(a["video"]))
     os.makedirs(a["tmp_reencoded"], exist_ok=True)
-    params = [
-        (
-            video,
-            a["model"],
-            a["device_type"],
-            a["device_resolution"],
-            a["viewing_distance"],
-            a["display_size"],
-            a["tmp"],
-            not a["nocached_features"],
-            a["re_encoding_bitrate"],
-            a["re_encoding_width"],
-            a["re_encoding_height"],
-            a["re_encoding_framerate"],
-            a["re_encoding_codec"],
-            a["tmp_reencoded"],
-            a["cache_reencodes"],
-            a["hybrid_model_type"],
-        )
-        for video in a["video"]
-    ]
-    logging.debug(params)
-    if a["cpu_count"] > 1:
-        pool = multiprocessing.Pool(a["cpu_count"])
-        results = pool.starmap(hyn0_predict, params)
-    else:
-        results = list(itertools.starmap(hyn0_predict, params))
-
-    print(json.dumps(results, indent=4, sort_keys=True))
+    # inputs that are already processed with the same settings and did not change since are skipped
+    settings = {
+        k: a[k]
+        for k in [
+            "device_type",
+            "device_resolution",
+            "viewing_distance",
+            "display_size",
+            "re_encoding_bitrate",
+            "re_encoding_width",
+            "re_encoding_height",
+            "re_encoding_framerate",
+            "re_encoding_codec",
+            "hybrid_model_type",
+        ]
+    }
+    settings["model"] = list(file_identity(a["model"]))
+    settings["version"] = __version__
+    journal = Journal(a["result_folder"], settings)
+    results = iter_predict(
+        journal.pending(a["video"], not a["rerun"]),
+        a["model"],
+        a["device_type"],
+        a["device_resolution"],
+        a["viewing_distance"],
+        a["display_size"],
+        a["tmp"],
+        not a["nocached_features"],
+        a["re_encoding_bitrate"],
+        a["re_encoding_width"],
+        a["re_encoding_height"],
+        a["re_encoding_framerate"],
+        a["re_encoding_codec"],
+        a["tmp_reencoded"],
+        a["cache_reencodes"],
+        a["hybrid_model_type"],
+        a["cpu_count"],
+    )
+    # results are printed and stored as soon as a video is processed
     logging.info(f"""store all results to {a["result_folder"]}""")
-    os.makedirs(a["result_folder"], exist_ok=True)
-    for result in results:
-        if result == {} or "video_basename" not in result:
-            # in case the video could not be processed, just ignore it
-            continue
-        reportname = os.path.join(a["result_folder"], os.path.splitext(result["video_basename"])[0] + ".json")
-        json_store(reportname, result)
+    stream_reports(journal.track(results), a["result_folder"])
 
 
 if __name__ == "__main__":